@@ -16,51 +16,61 @@ from models import (
     WhatsAppMessage,
     Usuario,
     PedidoEntreNaves,
+    CampanaEnvio,
+    OutboxMensaje,
+    OutboxFallido,
+    LeaseProceso,
+    WebhookEntrante,
+    WhatsAppMedia,
+    EstadoEntrega,
+    normalizar_telefono,
 )
-from twilio_sender import enviar_whatsapp, configurar_twilio, twilio_sender
-from datetime import datetime, date, timezone
+from twilio_sender import enviar_whatsapp, configurar_twilio, twilio_sender, ResultadoEnvio
+from twilio_async_sender import twilio_async_sender
+from plantillas import obtener_plan, validar_plantilla, PlantillaInvalida
+from rate_limiter import LimitadorGCRA
+from datetime import datetime, date, timezone, timedelta
+import atexit
+import hashlib
+import heapq
+import json
 import os
+import queue
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import uuid
 import threading
 import time as _time
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait
 import requests
-from sqlalchemy import text, inspect, func, select, and_
+from sqlalchemy import text, inspect, func, select, update, bindparam, and_, or_, case, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.util import identity_key
 from werkzeug.utils import secure_filename
 import base64
 import io
 from zoneinfo import ZoneInfo
-from collections import UserDict, defaultdict
+from collections import OrderedDict, defaultdict
 
 app = Flask(__name__)
 
-# Rate limiting para webhooks - Protección contra spam
-# Estructura: {ip: [(timestamp1, timestamp2, ...)]}
-_webhook_rate_limit = defaultdict(list)
-_rate_limit_lock = threading.Lock()
-_RATE_LIMIT_WINDOW = 60  # Ventana de tiempo en segundos (1 minuto)
-_RATE_LIMIT_MAX_REQUESTS = 100  # Máximo de requests por ventana de tiempo
+# Rate limiting para webhooks - Protección contra spam. El estado es compartido
+# por todos los workers de la máquina (ver rate_limiter.LimitadorGCRA)
+_RATE_LIMIT_WINDOW = int(os.environ.get('WEBHOOK_RATE_LIMIT_VENTANA_SEG', 60))  # Ventana de tiempo en segundos
+_RATE_LIMIT_MAX_REQUESTS = int(os.environ.get('WEBHOOK_RATE_LIMIT_MAX', 100))  # Máximo de requests por ventana
+_webhook_rate_limit = LimitadorGCRA('webhook', _RATE_LIMIT_MAX_REQUESTS, _RATE_LIMIT_WINDOW)
 
 def _check_rate_limit(ip_address: str) -> bool:
     """
     Verifica si una IP ha excedido el límite de rate.
     Retorna True si está permitido, False si excedió el límite.
     """
-    current_time = _time.time()
-    
-    with _rate_limit_lock:
-        # Limpiar timestamps antiguos (fuera de la ventana)
-        _webhook_rate_limit[ip_address] = [
-            ts for ts in _webhook_rate_limit[ip_address]
-            if current_time - ts < _RATE_LIMIT_WINDOW
-        ]
-        
-        # Verificar si excedió el límite
-        if len(_webhook_rate_limit[ip_address]) >= _RATE_LIMIT_MAX_REQUESTS:
-            return False
-        
-        # Registrar esta solicitud
-        _webhook_rate_limit[ip_address].append(current_time)
-        return True
+    return _webhook_rate_limit.permitir(ip_address)
 
 def _get_client_ip() -> str:
     """Obtiene la IP del cliente, considerando proxies"""
@@ -76,7 +86,8 @@ def _get_client_ip() -> str:
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'tu_clave_secreta_aqui')
 
 # Configuración de base de datos - Siempre SQLite
-database_url = 'sqlite:///recambios.db'
+# SQLITE_DATABASE_URL solo se usa para apuntar a otra base SQLite (p. ej. 'sqlite://' en memoria en los tests)
+database_url = os.environ.get('SQLITE_DATABASE_URL', 'sqlite:///recambios.db')
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
@@ -89,18 +100,34 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 }
 print("✅ Configurado SQLite: recambios.db")
 
+
+@event.listens_for(Engine, 'connect')
+def _configurar_conexion_sqlite(dbapi_connection, connection_record):
+    """
+    WAL: las lecturas no bloquean a la escritura ni al revés, así el webhook puede
+    insertar mientras el consumidor o el worker tienen una transacción abierta.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
 app.config['DEBUG'] = os.environ.get('DEBUG', 'False').lower() == 'true'
 
 # Configuración común
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['WHATSAPP_UPLOAD_FOLDER'] = 'static/whatsapp_uploads'
 app.config['PEDIDOS_UPLOAD_FOLDER'] = 'static/pedidos_uploads'
+# Adjuntos recibidos por WhatsApp, fuera de static: se sirven por /whatsapp/media/<id>
+app.config['WHATSAPP_MEDIA_FOLDER'] = os.environ.get('WHATSAPP_MEDIA_DIR', os.path.join(app.instance_path, 'whatsapp_media'))
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
 # Crear directorio de uploads si no existe  
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['WHATSAPP_UPLOAD_FOLDER'], exist_ok=True)
 os.makedirs(app.config['PEDIDOS_UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['WHATSAPP_MEDIA_FOLDER'], exist_ok=True)
 
 db.init_app(app)
 
@@ -172,6 +199,144 @@ with app.app_context():
             import traceback
             print(traceback.format_exc())
         
+        try:
+            if 'mensaje_enviado' in inspector.get_table_names():
+                mensaje_enviado_columns = {col['name'] for col in inspector.get_columns('mensaje_enviado')}
+                if 'campana_id' not in mensaje_enviado_columns:
+                    with db.engine.begin() as conn:
+                        conn.execute(text("ALTER TABLE mensaje_enviado ADD COLUMN campana_id INTEGER"))
+                        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_mensaje_enviado_campana_id ON mensaje_enviado(campana_id)"))
+                        print("✅ Columna 'campana_id' añadida a la tabla 'mensaje_enviado'")
+        except Exception as e:
+            print(f"⚠️ Error añadiendo columna campana_id a mensaje_enviado: {e}")
+
+        try:
+            if 'mensaje_enviado' in inspector.get_table_names():
+                with db.engine.begin() as conn:
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_mensaje_enviado_supresion "
+                        "ON mensaje_enviado(cliente_id, plantilla_id, fecha_envio)"
+                    ))
+        except Exception as e:
+            print(f"⚠️ Error creando índice de supresión en mensaje_enviado: {e}")
+
+        try:
+            # SIDs de Twilio únicos para que los reintentos del webhook no dupliquen mensajes.
+            # Antes de crear el índice se quitan los duplicados que ya hubiera (se conserva
+            # el primero y las respuestas a un duplicado pasan al original)
+            for tabla, columna in (('mensaje_recibido', 'id_mensaje_whatsapp'), ('whatsapp_message', 'external_id')):
+                if tabla not in inspector.get_table_names():
+                    continue
+                indice = f"ix_{tabla}_{columna}"
+                if any(ix['name'] == indice and ix['unique'] for ix in inspector.get_indexes(tabla)):
+                    continue
+                with db.engine.begin() as conn:
+                    conn.execute(text(f"UPDATE {tabla} SET {columna} = NULL WHERE {columna} = ''"))
+                    if tabla == 'mensaje_recibido':
+                        conn.execute(text(
+                            "UPDATE respuesta_mensaje SET mensaje_recibido_id = ("
+                            " SELECT MIN(original.id) FROM mensaje_recibido original"
+                            " JOIN mensaje_recibido duplicado ON duplicado.id_mensaje_whatsapp = original.id_mensaje_whatsapp"
+                            " WHERE duplicado.id = respuesta_mensaje.mensaje_recibido_id)"
+                            " WHERE mensaje_recibido_id IN (SELECT id FROM mensaje_recibido WHERE id_mensaje_whatsapp IS NOT NULL)"
+                        ))
+                    eliminados = conn.execute(text(
+                        f"DELETE FROM {tabla} WHERE {columna} IS NOT NULL AND id NOT IN "
+                        f"(SELECT MIN(id) FROM {tabla} WHERE {columna} IS NOT NULL GROUP BY {columna})"
+                    )).rowcount
+                    conn.execute(text(f"DROP INDEX IF EXISTS {indice}"))
+                    conn.execute(text(f"CREATE UNIQUE INDEX {indice} ON {tabla}({columna})"))
+                print(f"✅ Índice único '{indice}' creado ({eliminados} duplicado(s) eliminado(s))")
+        except Exception as e:
+            print(f"⚠️ Error creando índices únicos de SID de Twilio: {e}")
+
+        try:
+            # Estados de entrega (StatusCallback de Twilio)
+            for tabla in ('mensaje_enviado', 'whatsapp_message'):
+                if tabla not in inspector.get_table_names():
+                    continue
+                columnas = {col['name'] for col in inspector.get_columns(tabla)}
+                with db.engine.begin() as conn:
+                    if tabla == 'mensaje_enviado' and 'sid' not in columnas:
+                        conn.execute(text("ALTER TABLE mensaje_enviado ADD COLUMN sid VARCHAR(64)"))
+                        print("✅ Columna 'sid' añadida a la tabla 'mensaje_enviado'")
+                    if 'estado_entrega' not in columnas:
+                        conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN estado_entrega VARCHAR(20)"))
+                        conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN estado_entrega_at DATETIME"))
+                        print(f"✅ Columnas de estado de entrega añadidas a la tabla '{tabla}'")
+                    if tabla == 'mensaje_enviado':
+                        conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_mensaje_enviado_sid ON mensaje_enviado(sid)"))
+            if 'webhook_entrante' in inspector.get_table_names():
+                webhook_columns = {col['name'] for col in inspector.get_columns('webhook_entrante')}
+                if 'tipo' not in webhook_columns:
+                    with db.engine.begin() as conn:
+                        conn.execute(text("ALTER TABLE webhook_entrante ADD COLUMN tipo VARCHAR(20) NOT NULL DEFAULT 'mensaje'"))
+                    print("✅ Columna 'tipo' añadida a la tabla 'webhook_entrante'")
+        except Exception as e:
+            print(f"⚠️ Error añadiendo columnas de estado de entrega: {e}")
+
+        try:
+            # Almacén único de mensajes entrantes: lo que solo guardaba MensajeRecibido
+            if 'whatsapp_message' in inspector.get_table_names():
+                whatsapp_columns = {col['name'] for col in inspector.get_columns('whatsapp_message')}
+                with db.engine.begin() as conn:
+                    if 'cliente_id' not in whatsapp_columns:
+                        conn.execute(text("ALTER TABLE whatsapp_message ADD COLUMN cliente_id INTEGER REFERENCES cliente(id)"))
+                        print("✅ Columna 'cliente_id' añadida a la tabla 'whatsapp_message'")
+                    if 'respondido' not in whatsapp_columns:
+                        conn.execute(text("ALTER TABLE whatsapp_message ADD COLUMN respondido BOOLEAN NOT NULL DEFAULT 0"))
+                        print("✅ Columna 'respondido' añadida a la tabla 'whatsapp_message'")
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_whatsapp_message_recibidos "
+                        "ON whatsapp_message(sender_type, is_read, sent_at)"
+                    ))
+        except Exception as e:
+            print(f"⚠️ Error añadiendo columnas de mensajes recibidos a whatsapp_message: {e}")
+
+        try:
+            if 'programacion_masiva' in inspector.get_table_names():
+                programacion_columns = {col['name'] for col in inspector.get_columns('programacion_masiva')}
+                if 'ventana_minutos' not in programacion_columns:
+                    with db.engine.begin() as conn:
+                        conn.execute(text("ALTER TABLE programacion_masiva ADD COLUMN ventana_minutos INTEGER NOT NULL DEFAULT 0"))
+                    print("✅ Columna 'ventana_minutos' añadida a la tabla 'programacion_masiva'")
+        except Exception as e:
+            print(f"⚠️ Error añadiendo columna ventana_minutos a programacion_masiva: {e}")
+
+        try:
+            if 'campana_envio' in inspector.get_table_names():
+                campana_columns = {col['name'] for col in inspector.get_columns('campana_envio')}
+                with db.engine.begin() as conn:
+                    if 'programacion_id' not in campana_columns:
+                        conn.execute(text("ALTER TABLE campana_envio ADD COLUMN programacion_id INTEGER"))
+                        print("✅ Columna 'programacion_id' añadida a la tabla 'campana_envio'")
+                    if 'fecha_programada' not in campana_columns:
+                        conn.execute(text("ALTER TABLE campana_envio ADD COLUMN fecha_programada DATE"))
+                        print("✅ Columna 'fecha_programada' añadida a la tabla 'campana_envio'")
+                    if 'ultimo_cliente_id' not in campana_columns:
+                        conn.execute(text("ALTER TABLE campana_envio ADD COLUMN ultimo_cliente_id INTEGER"))
+                        print("✅ Columna 'ultimo_cliente_id' añadida a la tabla 'campana_envio'")
+                    conn.execute(text(
+                        "CREATE UNIQUE INDEX IF NOT EXISTS uq_campana_envio_programacion_fecha "
+                        "ON campana_envio(programacion_id, fecha_programada)"
+                    ))
+        except Exception as e:
+            print(f"⚠️ Error añadiendo columnas de programación a campana_envio: {e}")
+
+        try:
+            if 'outbox_mensaje' in inspector.get_table_names():
+                outbox_columns = {col['name'] for col in inspector.get_columns('outbox_mensaje')}
+                with db.engine.begin() as conn:
+                    if 'disponible_en' not in outbox_columns:
+                        conn.execute(text("ALTER TABLE outbox_mensaje ADD COLUMN disponible_en DATETIME"))
+                        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_outbox_mensaje_disponible_en ON outbox_mensaje(disponible_en)"))
+                        print("✅ Columna 'disponible_en' añadida a la tabla 'outbox_mensaje'")
+                    if 'codigo_error' not in outbox_columns:
+                        conn.execute(text("ALTER TABLE outbox_mensaje ADD COLUMN codigo_error INTEGER"))
+                        print("✅ Columna 'codigo_error' añadida a la tabla 'outbox_mensaje'")
+        except Exception as e:
+            print(f"⚠️ Error añadiendo columnas de reintento a outbox_mensaje: {e}")
+        
         try:
             if 'cliente' in inspector.get_table_names():
                 cliente_columns = {col['name'] for col in inspector.get_columns('cliente')}
@@ -181,7 +346,37 @@ with app.app_context():
                         print("✅ Columna 'codigo' añadida a la tabla 'cliente'")
         except Exception as e:
             print(f"⚠️ Error añadiendo columna codigo a cliente: {e}")
-        
+
+        try:
+            if 'cliente' in inspector.get_table_names():
+                cliente_columns = {col['name'] for col in inspector.get_columns('cliente')}
+                with db.engine.begin() as conn:
+                    if 'telefono_normalizado' not in cliente_columns:
+                        conn.execute(text("ALTER TABLE cliente ADD COLUMN telefono_normalizado VARCHAR(20)"))
+                        print("✅ Columna 'telefono_normalizado' añadida a la tabla 'cliente'")
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_cliente_telefono_normalizado ON cliente(telefono_normalizado)"
+                    ))
+                    # La normalización vive en Python (normalizar_telefono), así que se rellena fila a fila.
+                    # Los de 9 dígitos se revisan también: antes solo los que empiezan por 6 llevaban el 34
+                    pendientes = conn.execute(text(
+                        "SELECT id, telefono, telefono_normalizado FROM cliente "
+                        "WHERE telefono IS NOT NULL AND (telefono_normalizado IS NULL OR length(telefono_normalizado) = 9)"
+                    )).fetchall()
+                    valores = [
+                        {'id': cliente_id, 'normalizado': normalizar_telefono(telefono)}
+                        for cliente_id, telefono, actual in pendientes
+                        if normalizar_telefono(telefono) and normalizar_telefono(telefono) != actual
+                    ]
+                    if valores:
+                        conn.execute(
+                            text("UPDATE cliente SET telefono_normalizado = :normalizado WHERE id = :id"),
+                            valores,
+                        )
+                        print(f"✅ Teléfono normalizado calculado para {len(valores)} cliente(s)")
+        except Exception as e:
+            print(f"⚠️ Error añadiendo telefono_normalizado a cliente: {e}")
+
         # Migraciones para whatsapp_conversation
         try:
             if 'whatsapp_conversation' in inspector.get_table_names():
@@ -202,6 +397,44 @@ with app.app_context():
             print(f"⚠️ Error añadiendo columnas a whatsapp_conversation: {e}")
             import traceback
             print(traceback.format_exc())
+
+        try:
+            # Resumen desnormalizado para el listado de conversaciones
+            if 'whatsapp_conversation' in inspector.get_table_names() and 'whatsapp_message' in inspector.get_table_names():
+                conversation_columns = {col['name'] for col in inspector.get_columns('whatsapp_conversation')}
+                with db.engine.begin() as conn:
+                    conn.execute(text(
+                        "CREATE INDEX IF NOT EXISTS ix_whatsapp_message_conversacion_orden "
+                        "ON whatsapp_message(conversation_id, sent_at, id)"
+                    ))
+                    if 'unread_count' not in conversation_columns:
+                        conn.execute(text("ALTER TABLE whatsapp_conversation ADD COLUMN last_message_id INTEGER"))
+                        conn.execute(text("ALTER TABLE whatsapp_conversation ADD COLUMN last_message_at DATETIME"))
+                        conn.execute(text("ALTER TABLE whatsapp_conversation ADD COLUMN unread_count INTEGER NOT NULL DEFAULT 0"))
+                        conn.execute(text("ALTER TABLE whatsapp_conversation ADD COLUMN last_agent_usuario_id INTEGER REFERENCES usuario(id)"))
+                        conn.execute(text(
+                            "CREATE INDEX IF NOT EXISTS ix_whatsapp_conversation_last_message_at "
+                            "ON whatsapp_conversation(last_message_at)"
+                        ))
+                        ultimo = (
+                            "(SELECT m.{} FROM whatsapp_message m"
+                            " WHERE m.conversation_id = whatsapp_conversation.id{}"
+                            " ORDER BY m.sent_at DESC, m.id DESC LIMIT 1)"
+                        )
+                        conn.execute(text(
+                            "UPDATE whatsapp_conversation SET"
+                            " last_message_id = " + ultimo.format('id', '') + ","
+                            " last_message_at = " + ultimo.format('sent_at', '') + ","
+                            " unread_count = (SELECT COUNT(*) FROM whatsapp_message m"
+                            " WHERE m.conversation_id = whatsapp_conversation.id"
+                            " AND m.sender_type = 'customer' AND m.is_read = :falso),"
+                            " last_agent_usuario_id = " + ultimo.format('usuario_id', " AND m.sender_type = 'agent'")
+                        ), {'falso': False})
+                        print("✅ Resumen de conversaciones añadido a la tabla 'whatsapp_conversation'")
+        except Exception as e:
+            print(f"⚠️ Error añadiendo el resumen a whatsapp_conversation: {e}")
+            import traceback
+            print(traceback.format_exc())
         
         # Verificar y crear tabla de pedidos_entre_naves si no existe
         try:
@@ -268,13 +501,6 @@ def _to_local_time(utc_dt: datetime | None) -> datetime | None:
     return utc_dt.astimezone(_scheduler_tz)
 
 
-class _FormatoSeguro(UserDict):
-    """Permite usar str.format_map sin lanzar KeyError cuando faltan llaves."""
-
-    def __missing__(self, key):
-        return ""
-
-
 def _chat_display(value: str) -> str:
     if not value:
         return ""
@@ -291,15 +517,10 @@ def _normalize_chat_id(raw_number: str) -> str:
     if "@" in raw_number:
         return raw_number
 
-    digits = "".join(filter(str.isdigit, raw_number))
+    digits = normalizar_telefono(raw_number)
     if not digits:
         raise ValueError("El número de WhatsApp debe contener al menos un dígito")
 
-    if digits.startswith("6") and len(digits) == 9:
-        digits = "34" + digits
-    elif digits.startswith("600") and len(digits) == 12:
-        digits = "34" + digits[1:]
-
     return f"{digits}@c.us"
 
 
@@ -387,29 +608,131 @@ def _append_whatsapp_message(
     )
     conversation.updated_at = datetime.now(timezone.utc)
     db.session.add(message)
+    db.session.flush()
+    _avanzar_resumen_conversaciones([message])
     return message
 
 
-def _register_incoming_whatsapp_message(
-    chat_id: str,
-    message_text: str,
-    contact_name: str | None = None,
-    sent_at: datetime | None = None,
-    external_id: str | None = None,
-    media_type: str | None = None,
-    media_url: str | None = None,
-):
-    conversation = _ensure_whatsapp_conversation(chat_id, contact_name, sent_at)
-    _append_whatsapp_message(
-        conversation,
-        sender_type="customer",
-        message_text=message_text,
-        sent_at=sent_at,
-        external_id=external_id,
-        is_read=False,
-        media_type=media_type,
-        media_url=media_url,
+def _avanzar_resumen_conversaciones(mensajes: list[WhatsAppMessage]):
+    """
+    Suma mensajes recién insertados (ya con id) al resumen de su conversación:
+    último mensaje, no leídos y último agente (sin commit). Cada UPDATE es
+    relativo a los valores guardados, así dos procesos que escriben en la misma
+    conversación no se pisan el contador ni retroceden el último mensaje.
+    """
+    if not mensajes:
+        return
+    tabla = WhatsAppConversation.__table__
+    momento = bindparam('b_at', type_=db.DateTime)
+    es_ultimo = or_(tabla.c.last_message_at.is_(None), tabla.c.last_message_at <= momento)
+    db.session.execute(
+        update(tabla).where(tabla.c.id == bindparam('b_id')).values(
+            last_message_id=case((es_ultimo, bindparam('b_mensaje')), else_=tabla.c.last_message_id),
+            last_message_at=case((es_ultimo, momento), else_=tabla.c.last_message_at),
+            unread_count=tabla.c.unread_count + bindparam('b_no_leidos'),
+            last_agent_usuario_id=case(
+                (and_(es_ultimo, bindparam('b_agente', type_=db.Boolean)), bindparam('b_usuario')),
+                else_=tabla.c.last_agent_usuario_id,
+            ),
+        ),
+        [
+            {
+                'b_id': mensaje.conversation_id,
+                'b_mensaje': mensaje.id,
+                'b_at': mensaje.sent_at,
+                'b_no_leidos': 1 if mensaje.sender_type == 'customer' and not mensaje.is_read else 0,
+                'b_agente': mensaje.sender_type == 'agent',
+                'b_usuario': mensaje.usuario_id,
+            }
+            for mensaje in mensajes
+        ],
+    )
+    _expirar_resumen_conversaciones({mensaje.conversation_id for mensaje in mensajes})
+
+
+def _recalcular_resumen_conversaciones(conversation_ids=None) -> int:
+    """
+    Recalcula desde whatsapp_message el resumen de las conversaciones dadas, o
+    de todas sin argumento (sin commit). Lo usan las escrituras masivas que no
+    conocen los ids insertados y la reparación `python -m app resumen-conversaciones`.
+    Retorna cuántas conversaciones se actualizaron.
+    """
+    def _ultimo(columna, *condiciones):
+        return (
+            select(columna)
+            .where(WhatsAppMessage.conversation_id == WhatsAppConversation.id, *condiciones)
+            .order_by(WhatsAppMessage.sent_at.desc(), WhatsAppMessage.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    valores = {
+        'last_message_id': _ultimo(WhatsAppMessage.id),
+        'last_message_at': _ultimo(WhatsAppMessage.sent_at),
+        'unread_count': (
+            select(func.count(WhatsAppMessage.id))
+            .where(
+                WhatsAppMessage.conversation_id == WhatsAppConversation.id,
+                WhatsAppMessage.sender_type == 'customer',
+                WhatsAppMessage.is_read.is_(False),
+            )
+            .scalar_subquery()
+        ),
+        'last_agent_usuario_id': _ultimo(WhatsAppMessage.usuario_id, WhatsAppMessage.sender_type == 'agent'),
+    }
+    if conversation_ids is None:
+        actualizadas = WhatsAppConversation.query.update(valores, synchronize_session=False)
+        db.session.expire_all()
+        return actualizadas
+
+    conversation_ids = list(conversation_ids)
+    actualizadas = 0
+    for inicio in range(0, len(conversation_ids), 500):
+        actualizadas += WhatsAppConversation.query.filter(
+            WhatsAppConversation.id.in_(conversation_ids[inicio:inicio + 500])
+        ).update(valores, synchronize_session=False)
+    _expirar_resumen_conversaciones(conversation_ids)
+    return actualizadas
+
+
+def _marcar_leidos(conversation_id: int, message_ids=None) -> int:
+    """
+    Marca como leídos los mensajes del cliente de una conversación (todos o los
+    de `message_ids`) y descuenta los que realmente cambiaron de su contador de
+    no leídos, en la misma transacción (sin commit). Retorna cuántos se marcaron.
+    """
+    consulta = WhatsAppMessage.query.filter(
+        WhatsAppMessage.conversation_id == conversation_id,
+        WhatsAppMessage.sender_type == 'customer',
+        WhatsAppMessage.is_read.is_(False),
     )
+    if message_ids is not None:
+        consulta = consulta.filter(WhatsAppMessage.id.in_(list(message_ids)))
+    marcados = consulta.update({'is_read': True}, synchronize_session='fetch')
+    if message_ids is None:
+        # Con todo leído el contador es 0 sin más: así se corrige también si estaba desfasado
+        if WhatsAppConversation.query.filter(
+            WhatsAppConversation.id == conversation_id,
+            WhatsAppConversation.unread_count != 0,
+        ).update({'unread_count': 0}, synchronize_session=False):
+            _expirar_resumen_conversaciones([conversation_id])
+    elif marcados:
+        WhatsAppConversation.query.filter_by(id=conversation_id).update({
+            'unread_count': case(
+                (WhatsAppConversation.unread_count > marcados, WhatsAppConversation.unread_count - marcados),
+                else_=0,
+            ),
+        }, synchronize_session=False)
+        _expirar_resumen_conversaciones([conversation_id])
+    return marcados
+
+
+def _expirar_resumen_conversaciones(conversation_ids):
+    """Descarta de la sesión el resumen ya cargado de esas conversaciones tras un UPDATE directo."""
+    for conversation_id in conversation_ids:
+        conversation = db.session.identity_map.get(identity_key(WhatsAppConversation, conversation_id))
+        if conversation is not None:
+            db.session.expire(conversation, ['last_message_id', 'last_message_at', 'unread_count', 'last_agent_usuario_id'])
 
 
 def _register_outgoing_whatsapp_message(
@@ -443,17 +766,131 @@ def _register_outgoing_whatsapp_message(
     )
 
 
+class _EscritorResultados:
+    """
+    Acumula los resultados de envíos masivos y los persiste por bloques con
+    inserciones masivas, resolviendo todas las conversaciones del bloque con
+    una sola consulta en lugar de una búsqueda + flush por destinatario.
+    """
+
+    def __init__(self, tamano_bloque: int = 500):
+        self.tamano_bloque = tamano_bloque
+        self._mensajes_enviados: list[dict] = []
+        self._salientes: list[tuple[str, dict]] = []
+
+    def agregar_envio(self, **campos):
+        """Acumula un MensajeEnviado (columnas como argumentos)."""
+        self._mensajes_enviados.append(campos)
+        if len(self._mensajes_enviados) >= self.tamano_bloque:
+            self._volcar_mensajes_enviados()
+
+    def agregar_whatsapp_saliente(
+        self,
+        chat_id: str,
+        message_text: str,
+        sent_at: datetime | None = None,
+        external_id: str | None = None,
+        usuario_id: int | None = None,
+    ):
+        """Acumula un mensaje de agente para la conversación de `chat_id`."""
+        try:
+            chat_id = _normalize_chat_id(chat_id)
+        except ValueError as exc:
+            print(f"⚠️ No se pudo registrar la conversación avanzada: {exc}")
+            return
+        self._salientes.append((chat_id, {
+            'sender_type': 'agent',
+            'message_text': message_text,
+            'sent_at': sent_at or datetime.now(timezone.utc),
+            'external_id': external_id,
+            'is_read': True,
+            'usuario_id': usuario_id,
+        }))
+        if len(self._salientes) >= self.tamano_bloque:
+            self._volcar_salientes()
+
+    def flush(self):
+        """Persiste todo lo acumulado (sin commit)."""
+        self._volcar_mensajes_enviados()
+        self._volcar_salientes()
+
+    def _volcar_mensajes_enviados(self):
+        if self._mensajes_enviados:
+            db.session.bulk_insert_mappings(MensajeEnviado, self._mensajes_enviados)
+            self._mensajes_enviados = []
+
+    def _volcar_salientes(self):
+        if not self._salientes:
+            return
+        salientes, self._salientes = self._salientes, []
+        conversaciones = _resolver_conversaciones({chat_id for chat_id, _ in salientes})
+
+        ahora = datetime.now(timezone.utc)
+        db.session.bulk_insert_mappings(WhatsAppMessage, [
+            {'conversation_id': conversaciones[chat_id], **datos}
+            for chat_id, datos in salientes
+        ])
+        WhatsAppConversation.query.filter(
+            WhatsAppConversation.id.in_(set(conversaciones.values()))
+        ).update({'updated_at': ahora}, synchronize_session=False)
+        # La inserción masiva no devuelve ids: el resumen se recalcula por índice
+        _recalcular_resumen_conversaciones(set(conversaciones.values()))
+
+
+def _resolver_conversaciones(chat_ids: set[str]) -> dict[str, int]:
+    """
+    Devuelve {chat_id: conversation_id} creando en bloque las conversaciones que falten.
+    """
+    def _consultar(pendientes):
+        encontrados = {}
+        pendientes = list(pendientes)
+        for inicio in range(0, len(pendientes), 500):
+            filas = db.session.query(
+                WhatsAppConversation.contact_number,
+                func.min(WhatsAppConversation.id)
+            ).filter(
+                WhatsAppConversation.contact_number.in_(pendientes[inicio:inicio + 500])
+            ).group_by(WhatsAppConversation.contact_number).all()
+            encontrados.update(filas)
+        return encontrados
+
+    conversaciones = _consultar(chat_ids)
+    faltantes = chat_ids - conversaciones.keys()
+    if faltantes:
+        ahora = datetime.now(timezone.utc)
+        db.session.bulk_insert_mappings(WhatsAppConversation, [
+            {'contact_number': chat_id, 'created_at': ahora, 'updated_at': ahora}
+            for chat_id in faltantes
+        ])
+        conversaciones.update(_consultar(faltantes))
+    return conversaciones
+
+
+def _consulta_listado_conversaciones():
+    """
+    Conversaciones por último mensaje, con el mensaje y el último agente cargados
+    en la misma consulta (por clave primaria). Las conversaciones sin mensajes
+    quedan al final.
+    """
+    return (
+        WhatsAppConversation.query
+        .options(
+            joinedload(WhatsAppConversation.ultimo_mensaje).joinedload(WhatsAppMessage.usuario),
+            joinedload(WhatsAppConversation.ultimo_agente),
+        )
+        .order_by(WhatsAppConversation.last_message_at.desc(), WhatsAppConversation.id.desc())
+    )
+
+
 def _conversation_to_dict(conversation: WhatsAppConversation) -> dict:
-    last = conversation.last_message()
-    # Buscar el último mensaje de un agente (siempre mostrar el último agente que escribió)
-    last_agent = conversation.last_agent_message()
-    last_usuario = None
+    last = conversation.ultimo_mensaje
     # Siempre incluir el último usuario agente que escribió, incluso si el último mensaje es del cliente
-    if last_agent and last_agent.usuario:
+    last_usuario = None
+    if conversation.ultimo_agente:
         last_usuario = {
-            "id": last_agent.usuario.id,
-            "username": last_agent.usuario.username,
-            "color": last_agent.usuario.color or "#007bff",  # Fallback solo si es None
+            "id": conversation.ultimo_agente.id,
+            "username": conversation.ultimo_agente.username,
+            "color": conversation.ultimo_agente.color or "#007bff",  # Fallback solo si es None
         }
     return {
         "id": conversation.id,
@@ -465,7 +902,7 @@ def _conversation_to_dict(conversation: WhatsAppConversation) -> dict:
         "last_usuario": last_usuario,
         "updated_at": conversation.updated_at.isoformat() if conversation.updated_at else None,
         "updated_at_human": _to_local_time(conversation.updated_at).strftime("%d/%m/%Y %H:%M") if conversation.updated_at else "",
-        "unread_count": conversation.unread_count(),
+        "unread_count": conversation.unread_count,
         "url": url_for("whatsapp_conversation_detail", conversation_id=conversation.id),
     }
 
@@ -494,6 +931,7 @@ def _message_to_dict(message: WhatsAppMessage) -> dict:
         "media_type": message.media_type,
         "media_url": message.media_url,
         "external_id": message.external_id,  # Incluir external_id para debugging
+        "estado_entrega": message.estado_entrega,
         "media_route": media_route,
         "usuario": usuario_data,
     }
@@ -516,99 +954,669 @@ def local_time_filter(utc_dt: datetime | None) -> datetime | None:
     return _to_local_time(utc_dt)
 
 
-def _ejecutor_programaciones():
-    """Hilo en background que ejecuta envíos masivos programados por zona y hora."""
+_PROGRAMACION_BLOQUE = max(1, int(os.environ.get('PROGRAMACION_BLOQUE', 500)))
+# Horas durante las que no se repite la misma plantilla a un cliente (0 = sin supresión)
+_SUPRESION_VENTANA_HORAS = float(os.environ.get('SUPRESION_VENTANA_HORAS', 24))
+
+
+def _clientes_suprimidos(cliente_ids: list[int], plantilla_id: int, excluir_campana_id: int | None = None) -> set[int]:
+    """
+    Clientes que recibieron `plantilla_id` dentro de la ventana de supresión o que
+    ya la tienen en cola. Consultas por conjuntos (bloques de 500 ids) apoyadas en
+    el índice MensajeEnviado(cliente_id, plantilla_id, fecha_envio).
+    Los envíos y la cola de `excluir_campana_id` no cuentan: al reanudar una
+    ejecución, sus propios destinatarios no deben suprimirse a sí mismos.
+    """
+    if not cliente_ids or _SUPRESION_VENTANA_HORAS <= 0:
+        return set()
+
+    desde = datetime.utcnow() - timedelta(hours=_SUPRESION_VENTANA_HORAS)
+    suprimidos = set()
+    for inicio in range(0, len(cliente_ids), 500):
+        bloque = cliente_ids[inicio:inicio + 500]
+        consulta_enviados = db.session.query(MensajeEnviado.cliente_id).filter(
+            MensajeEnviado.cliente_id.in_(bloque),
+            MensajeEnviado.plantilla_id == plantilla_id,
+            MensajeEnviado.fecha_envio >= desde,
+            MensajeEnviado.enviado == True,
+        )
+        consulta_cola = db.session.query(OutboxMensaje.cliente_id).filter(
+            OutboxMensaje.cliente_id.in_(bloque),
+            OutboxMensaje.plantilla_id == plantilla_id,
+            OutboxMensaje.estado.in_(('pendiente', 'procesando')),
+        )
+        if excluir_campana_id is not None:
+            consulta_enviados = consulta_enviados.filter(or_(
+                MensajeEnviado.campana_id.is_(None), MensajeEnviado.campana_id != excluir_campana_id))
+            consulta_cola = consulta_cola.filter(or_(
+                OutboxMensaje.campana_id.is_(None), OutboxMensaje.campana_id != excluir_campana_id))
+        suprimidos.update(cliente_id for (cliente_id,) in consulta_enviados.distinct())
+        suprimidos.update(cliente_id for (cliente_id,) in consulta_cola.distinct())
+    return suprimidos
+
+
+def _seleccionar_destinatarios(clientes: list, plantilla_id: int, excluir_campana_id: int | None = None) -> tuple[list, int, int]:
+    """
+    Etapa de supresión previa al envío: deja un único destinatario por teléfono
+    normalizado (el de menor id) y descarta los teléfonos que ya recibieron la
+    plantilla dentro de la ventana. `clientes` debe venir ordenado por id.
+    Retorna (destinatarios, duplicados, suprimidos).
+    """
+    suprimidos_ids = _clientes_suprimidos([cliente.id for cliente in clientes], plantilla_id, excluir_campana_id)
+    telefonos_suprimidos = {normalizar_telefono(cliente.telefono) for cliente in clientes if cliente.id in suprimidos_ids}
+
+    destinatarios = []
+    vistos = set()
+    duplicados = suprimidos = 0
+    for cliente in clientes:
+        telefono = normalizar_telefono(cliente.telefono)
+        if telefono and telefono in telefonos_suprimidos:
+            suprimidos += 1
+            continue
+        if telefono and telefono in vistos:
+            duplicados += 1
+            continue
+        vistos.add(telefono)
+        destinatarios.append(cliente)
+    return destinatarios, duplicados, suprimidos
+
+
+def _iniciar_ejecucion_programacion(prog: ProgramacionMasiva, fecha: date) -> CampanaEnvio:
+    """Obtiene o crea (con commit) el registro de la ejecución de `prog` para `fecha`."""
+    ejecucion = CampanaEnvio.query.filter_by(programacion_id=prog.id, fecha_programada=fecha).first()
+    if ejecucion:
+        return ejecucion
+
+    ejecucion = CampanaEnvio(
+        zona_id=prog.zona_id,
+        plantilla_id=prog.plantilla_id,
+        programacion_id=prog.id,
+        fecha_programada=fecha,
+        estado='preparando',
+        total=Cliente.query.filter(Cliente.zona_id == prog.zona_id, Cliente.activo == True).count(),
+        ultimo_cliente_id=0,
+        iniciado_at=datetime.utcnow(),
+    )
+    db.session.add(ejecucion)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otro proceso creó la ejecución a la vez
+        db.session.rollback()
+        ejecucion = CampanaEnvio.query.filter_by(programacion_id=prog.id, fecha_programada=fecha).one()
+    return ejecucion
+
+
+def _turnos_ventana(cliente_ids: list, inicio: datetime, ventana_minutos: int) -> dict:
+    """
+    Reparte los destinatarios uniformemente en `ventana_minutos` desde `inicio`.
+    Retorna {cliente_id: disponible_en}; vacío si no hay ventana.
+    """
+    if ventana_minutos <= 0 or not cliente_ids:
+        return {}
+    intervalo = ventana_minutos * 60 / len(cliente_ids)
+    return {
+        cliente_id: inicio + timedelta(seconds=posicion * intervalo)
+        for posicion, cliente_id in enumerate(cliente_ids)
+    }
+
+
+def _completar_ejecucion_programacion(prog: ProgramacionMasiva, ejecucion: CampanaEnvio) -> int:
+    """
+    Encola por bloques los destinatarios que faltan de una ejecución, guardando
+    el punto de control tras cada bloque. Tras un reinicio continúa desde
+    `ultimo_cliente_id`; las claves de idempotencia evitan duplicar el bloque
+    que estuviera a medias. Retorna cuántos mensajes se encolaron.
+    """
+    fecha = ejecucion.fecha_programada
+    if ejecucion.estado != 'preparando':
+        prog.ultima_ejecucion = fecha
+        db.session.commit()
+        return 0
+
+    zona = ejecucion.zona
+    plan = obtener_plan(ejecucion.plantilla)
+
+    # La supresión se decide sobre toda la zona para deduplicar teléfonos entre bloques.
+    # Los candidatos se congelan en `iniciado_at` (los clientes dados de alta después
+    # esperan a la próxima ejecución) y la cola/envíos de esta misma ejecución no
+    # suprimen: así una reanudación obtiene la misma lista y los mismos turnos.
+    iniciado_at = ejecucion.iniciado_at or datetime.utcnow()
+    candidatos = db.session.query(Cliente.id, Cliente.telefono).filter(
+        Cliente.zona_id == ejecucion.zona_id,
+        Cliente.activo == True,
+        or_(Cliente.created_at.is_(None), Cliente.created_at <= iniciado_at),
+    ).order_by(Cliente.id.asc()).all()
+    seleccionados, duplicados, suprimidos = _seleccionar_destinatarios(
+        candidatos, ejecucion.plantilla_id, excluir_campana_id=ejecucion.id)
+    permitidos = {cliente.id for cliente in seleccionados}
+    # Con ventana, cada destinatario tiene su turno fijo (por orden de id) desde el inicio
+    turnos = _turnos_ventana(
+        [cliente.id for cliente in seleccionados],
+        iniciado_at,
+        prog.ventana_minutos or 0,
+    )
+    if duplicados or suprimidos:
+        print(f"🧹 Programación {prog.id}: {duplicados} teléfono(s) duplicado(s) y {suprimidos} cliente(s) suprimido(s)")
+
+    encolados = 0
+    while True:
+        bloque = Cliente.query.filter(
+            Cliente.zona_id == ejecucion.zona_id,
+            Cliente.activo == True,
+            Cliente.id > (ejecucion.ultimo_cliente_id or 0),
+        ).order_by(Cliente.id.asc()).limit(_PROGRAMACION_BLOQUE).all()
+        if not bloque:
+            break
+        clientes = [cliente for cliente in bloque if cliente.id in permitidos]
+
+        filas = []
+        for cliente, mensaje_personalizado in zip(clientes, plan.render_many(clientes, zona)):
+            filas.append({
+                'clave_idempotencia': f"programacion:{prog.id}:{fecha.isoformat()}:{cliente.id}",
+                'origen': 'programacion',
+                'telefono': cliente.telefono,
+                'mensaje': mensaje_personalizado,
+                'cliente_id': cliente.id,
+                'plantilla_id': ejecucion.plantilla_id,
+                'programacion_id': prog.id,
+                'campana_id': ejecucion.id,
+                'disponible_en': turnos.get(cliente.id),
+            })
+        encolados += _encolar_mensajes(filas)
+        ultimo_cliente_id = bloque[-1].id
+        ejecucion.ultimo_cliente_id = ultimo_cliente_id
+        db.session.commit()
+        # Los clientes del bloque ya no se usan: que no se acumulen en la sesión
+        for cliente in bloque:
+            db.session.expunge(cliente)
+        if not _sigo_siendo_lider():
+            raise LiderazgoPerdido(f"Programación {prog.id}: otro proceso tomó el liderazgo; continuará desde el cliente {ultimo_cliente_id}")
+
+    # Todos los destinatarios están en la cola: fijar el total real y pasar a en curso
+    CampanaEnvio.query.filter_by(id=ejecucion.id).update({
+        'estado': 'en_curso',
+        'total': OutboxMensaje.query.filter_by(campana_id=ejecucion.id).count(),
+    }, synchronize_session=False)
+    CampanaEnvio.query.filter(
+        CampanaEnvio.id == ejecucion.id,
+        CampanaEnvio.enviados + CampanaEnvio.fallidos >= CampanaEnvio.total,
+    ).update({'estado': 'completada', 'finalizado_at': datetime.utcnow()}, synchronize_session=False)
+    prog.ultima_ejecucion = fecha
+    db.session.commit()
+    return encolados
+
+
+def _reanudar_ejecuciones_programadas():
+    """Retoma las ejecuciones que quedaron a medias (p. ej. por un reinicio o un deploy)."""
+    pendientes = CampanaEnvio.query.filter(
+        CampanaEnvio.programacion_id.isnot(None),
+        CampanaEnvio.estado == 'preparando',
+    ).order_by(CampanaEnvio.id.asc()).all()
+    for ejecucion in pendientes:
+        prog = ProgramacionMasiva.query.get(ejecucion.programacion_id)
+        if not prog or not prog.activo:
+            ejecucion.estado = 'error'
+            ejecucion.error = 'La programación se eliminó o desactivó antes de terminar de encolar'
+            ejecucion.total = OutboxMensaje.query.filter_by(campana_id=ejecucion.id).count()
+            ejecucion.finalizado_at = datetime.utcnow()
+            db.session.commit()
+            continue
+        print(
+            f"↻ Reanudando programación {prog.id} del {ejecucion.fecha_programada} "
+            f"desde el cliente {ejecucion.ultimo_cliente_id or 0}"
+        )
+        encolados = _completar_ejecucion_programacion(prog, ejecucion)
+        print(f"📮 Programación {prog.id}: {encolados} mensaje(s) encolado(s) al reanudar")
+
+
+# El scheduler duerme hasta el próximo disparo. Las rutas que cambian programaciones
+# lo despiertan con un Event (mismo proceso) y tocando un fichero sello (otros procesos,
+# que solo miran su fecha de modificación: sin consultas a la BD mientras espera).
+_SCHEDULER_SELLO = os.path.join(
+    os.environ.get('SCHEDULER_STATE_DIR', tempfile.gettempdir()),
+    'recambios_programaciones.stamp',
+)
+_SCHEDULER_REVISION_SEG = float(os.environ.get('SCHEDULER_REVISION_SEG', 5))
+_SCHEDULER_REINTENTO_SEG = float(os.environ.get('SCHEDULER_REINTENTO_SEG', 300))
+
+# Recuperación de disparos perdidos (app caída o en deploy a la hora programada):
+# 'ejecutar' siempre, 'omitir' nunca, o 'ventana' si el retraso no supera N minutos.
+# Las recuperaciones se escalonan para no lanzar todas las zonas a la vez.
+_SCHEDULER_RECUPERACION = os.environ.get('SCHEDULER_RECUPERACION', 'ventana').strip().lower()
+_SCHEDULER_RECUPERACION_VENTANA_MIN = float(os.environ.get('SCHEDULER_RECUPERACION_VENTANA_MIN', 120))
+_SCHEDULER_RECUPERACION_ESCALONADO_SEG = float(os.environ.get('SCHEDULER_RECUPERACION_ESCALONADO_SEG', 60))
+if _SCHEDULER_RECUPERACION not in ('ejecutar', 'omitir', 'ventana'):
+    print(f"⚠️ SCHEDULER_RECUPERACION desconocida ({_SCHEDULER_RECUPERACION!r}); se usa 'ventana'")
+    _SCHEDULER_RECUPERACION = 'ventana'
+_programaciones_cambiadas = threading.Event()
+
+# Liderazgo: solo el proceso con el lease 'scheduler_programaciones' dispara programaciones.
+# El resto de workers/nodos esperan y lo toman si el líder deja de renovarlo.
+_SCHEDULER_LEASE = 'scheduler_programaciones'
+_SCHEDULER_LEASE_SEG = float(os.environ.get('SCHEDULER_LEASE_SEG', 15))
+_scheduler_titular = None
+_scheduler_ultimo_latido = 0.0
+_liderazgo_vigente = threading.Event()
+
+# Programaciones vencidas a la vez: cada zona en un hilo del pool (las de una misma
+# zona en serie, para que la supresión de duplicados vea los envíos de la anterior)
+_SCHEDULER_MAX_PARALELO = max(1, int(os.environ.get('SCHEDULER_MAX_PARALELO', 4)))
+_pool_programaciones = ThreadPoolExecutor(max_workers=_SCHEDULER_MAX_PARALELO, thread_name_prefix='programacion')
+
+
+class LiderazgoPerdido(RuntimeError):
+    """El proceso dejó de ser líder del scheduler en mitad de una ejecución."""
+
+
+def _adquirir_lease(nombre: str, titular: str, duracion_seg: float) -> bool:
+    """Toma o renueva el lease `nombre` para `titular` (con commit). Retorna si lo tiene."""
+    ahora = datetime.utcnow()
+    valores = {'titular': titular, 'expira_at': ahora + timedelta(seconds=duracion_seg), 'renovado_at': ahora}
+    try:
+        actualizadas = LeaseProceso.query.filter(
+            LeaseProceso.nombre == nombre,
+            or_(LeaseProceso.titular == titular, LeaseProceso.expira_at < ahora),
+        ).update(valores, synchronize_session=False)
+        if not actualizadas:
+            if db.session.query(LeaseProceso.nombre).filter_by(nombre=nombre).first():
+                db.session.rollback()
+                return False
+            db.session.add(LeaseProceso(nombre=nombre, **valores))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # Otro proceso creó la fila a la vez
+        db.session.rollback()
+        return False
+
+
+def _liberar_lease(nombre: str, titular: str):
+    """Cede el lease para que otro proceso lo tome sin esperar a que expire."""
+    LeaseProceso.query.filter_by(nombre=nombre, titular=titular).update(
+        {'expira_at': datetime.utcnow()}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+def _latido_scheduler(forzar: bool = False) -> bool:
+    """
+    Renueva el lease del scheduler si toca (cada tercio de su duración).
+    Retorna si este proceso sigue siendo el líder.
+    """
+    global _scheduler_ultimo_latido
+    if not forzar and _time.monotonic() - _scheduler_ultimo_latido < _SCHEDULER_LEASE_SEG / 3:
+        return True
+    lider = _adquirir_lease(_SCHEDULER_LEASE, _scheduler_titular, _SCHEDULER_LEASE_SEG)
+    _scheduler_ultimo_latido = _time.monotonic() if lider else 0.0
+    if lider:
+        _liderazgo_vigente.set()
+    else:
+        _liderazgo_vigente.clear()
+    return lider
+
+
+def _sigo_siendo_lider() -> bool:
+    """
+    Comprobación entre bloques de una ejecución: el hilo del scheduler renueva el
+    lease, los hilos del pool consultan el último latido. Fuera del scheduler
+    (p. ej. el benchmark) no aplica.
+    """
+    hilo = threading.current_thread().name
+    if not _scheduler_titular:
+        return True
+    if hilo == 'ejecutor_programaciones':
+        return _latido_scheduler()
+    if hilo.startswith('programacion'):
+        return _liderazgo_vigente.is_set()
+    return True
+
+
+def _ceder_liderazgo_scheduler():
+    try:
+        with app.app_context():
+            _liberar_lease(_SCHEDULER_LEASE, _scheduler_titular)
+    except Exception as e:
+        print(f"⚠️ No se pudo liberar el liderazgo del scheduler: {e}")
+
+
+def _invalidar_programaciones():
+    """Avisa a los schedulers de que hay que recalcular la cola de disparos."""
+    _programaciones_cambiadas.set()
+    try:
+        with open(_SCHEDULER_SELLO, 'a'):
+            os.utime(_SCHEDULER_SELLO, None)
+    except OSError as e:
+        print(f"⚠️ No se pudo actualizar el sello de programaciones: {e}")
+
+
+def _sello_programaciones() -> float:
+    try:
+        return os.path.getmtime(_SCHEDULER_SELLO)
+    except OSError:
+        return 0.0
+
+
+def _siguiente_disparo(prog: ProgramacionMasiva, desde: datetime) -> datetime | None:
+    """
+    Próximo disparo de `prog` (en la zona horaria del scheduler) a partir de `desde`.
+    Un disparo dentro del minuto en curso todavía cuenta; se salta el día ya ejecutado.
+    """
+    dias = {int(d) for d in (prog.dias_semana or '').split(',') if d.strip()}
+    try:
+        hora, minuto = (int(parte) for parte in prog.hora.split(':'))
+    except (AttributeError, ValueError):
+        print(f"⚠️ Programación {prog.id} con hora inválida: {prog.hora!r}")
+        return None
+    if not dias:
+        return None
+
+    inicio_minuto = desde.replace(second=0, microsecond=0)
+    for desplazamiento in range(8):
+        dia = desde.date() + timedelta(days=desplazamiento)
+        if dia.weekday() not in dias or dia == prog.ultima_ejecucion:
+            continue
+        disparo = datetime(dia.year, dia.month, dia.day, hora, minuto, tzinfo=_scheduler_tz)
+        if disparo >= inicio_minuto:
+            return disparo
+    return None
+
+
+def _ultimo_disparo_perdido(prog: ProgramacionMasiva, ahora: datetime) -> datetime | None:
+    """
+    Último disparo de `prog` anterior al minuto en curso (como mucho una semana atrás)
+    si no llegó a ejecutarse: ni consta en `ultima_ejecucion` ni tiene ejecución
+    registrada. Los anteriores a ese quedan superados por él y no se recuperan.
+    """
+    dias = {int(d) for d in (prog.dias_semana or '').split(',') if d.strip()}
+    try:
+        hora, minuto = (int(parte) for parte in prog.hora.split(':'))
+    except (AttributeError, ValueError):
+        return None
+
+    inicio_minuto = ahora.replace(second=0, microsecond=0)
+    for desplazamiento in range(8):
+        dia = ahora.date() - timedelta(days=desplazamiento)
+        if dia.weekday() not in dias:
+            continue
+        disparo = datetime(dia.year, dia.month, dia.day, hora, minuto, tzinfo=_scheduler_tz)
+        if disparo >= inicio_minuto:
+            continue
+        creada = prog.created_at.replace(tzinfo=timezone.utc) if prog.created_at else None
+        if dia == prog.ultima_ejecucion or (creada and disparo <= creada):
+            return None
+        ejecutada = db.session.query(CampanaEnvio.id).filter_by(programacion_id=prog.id, fecha_programada=dia).first()
+        return None if ejecutada else disparo
+    return None
+
+
+def _planificar_recuperaciones(programaciones: list, ahora: datetime) -> list:
+    """
+    Aplica la política de recuperación a los disparos perdidos y retorna las entradas
+    (momento, programacion_id, disparo) para la cola, escalonadas desde `ahora`.
+    """
+    perdidos = []
+    for prog in programaciones:
+        disparo = _ultimo_disparo_perdido(prog, ahora)
+        if not disparo:
+            continue
+        retraso_min = (ahora - disparo).total_seconds() / 60
+        if _SCHEDULER_RECUPERACION == 'omitir' or (
+            _SCHEDULER_RECUPERACION == 'ventana' and retraso_min > _SCHEDULER_RECUPERACION_VENTANA_MIN
+        ):
+            print(
+                f"⏭️ Programación {prog.id}: se omite el disparo perdido del "
+                f"{disparo.strftime('%Y-%m-%d %H:%M')} ({retraso_min:.0f} min de retraso)"
+            )
+            continue
+        perdidos.append((disparo, prog.id))
+
+    recuperaciones = []
+    for i, (disparo, prog_id) in enumerate(sorted(perdidos)):
+        momento = ahora + timedelta(seconds=i * _SCHEDULER_RECUPERACION_ESCALONADO_SEG)
+        recuperaciones.append((momento, prog_id, disparo))
+        print(
+            f"⏪ Programación {prog_id}: recuperando el disparo del {disparo.strftime('%Y-%m-%d %H:%M')} "
+            f"a las {momento.strftime('%H:%M:%S')}"
+        )
+    return recuperaciones
+
+
+def _cargar_cola_programaciones(recuperar: bool = False) -> list:
+    """
+    Reanuda ejecuciones a medias y construye el heap de (momento, programacion_id, disparo).
+    Con `recuperar` (al tomar el liderazgo) incluye los disparos perdidos mientras no
+    había scheduler; al recargar por cambios no, para que editar una hora no dispare nada.
+    """
+    _reanudar_ejecuciones_programadas()
+
+    ahora = _now()
+    programaciones = ProgramacionMasiva.query.filter_by(activo=True).all()
+    cola = _planificar_recuperaciones(programaciones, ahora) if recuperar else []
+    recuperadas = {prog_id for _, prog_id, _ in cola}
+    for prog in programaciones:
+        if prog.id in recuperadas:
+            # Su siguiente disparo se calcula cuando se ejecute la recuperación
+            continue
+        disparo = _siguiente_disparo(prog, ahora)
+        if disparo:
+            cola.append((disparo, prog.id, disparo))
+    heapq.heapify(cola)
+
+    if cola:
+        print(
+            f"⏰ {len(cola)} programación(es) activa(s); próxima: {cola[0][1]} "
+            f"el {cola[0][0].strftime('%Y-%m-%d %H:%M')} ({_scheduler_tz_name})"
+        )
+    else:
+        print("⏰ No hay programaciones activas pendientes")
+    return cola
+
+
+def _disparar_programacion(prog_id: int, disparo: datetime) -> datetime | None:
+    """Ejecuta la programación para el día del disparo y retorna su siguiente disparo."""
+    prog = ProgramacionMasiva.query.get(prog_id)
+    if not prog or not prog.activo:
+        return None
+
+    fecha = disparo.date()
+    if prog.ultima_ejecucion != fecha:
+        zona = Zona.query.get(prog.zona_id)
+        plantilla = MensajePlantilla.query.get(prog.plantilla_id)
+        if zona and plantilla:
+            # Encolar los envíos con punto de control; el worker de outbox los realiza y registra
+            ejecucion = _iniciar_ejecucion_programacion(prog, fecha)
+            encolados = _completar_ejecucion_programacion(prog, ejecucion)
+            print(f"📮 Programación {prog.id}: {encolados} mensaje(s) encolado(s)")
+
+    return _siguiente_disparo(prog, disparo + timedelta(minutes=1))
+
+
+def _disparar_zona(entradas: list) -> list:
+    """
+    Ejecuta en un hilo del pool, con su propia sesión, las programaciones vencidas
+    de una zona. Un fallo solo afecta a esa programación, que se reintenta pasados
+    SCHEDULER_REINTENTO_SEG. Retorna las entradas a devolver a la cola.
+    """
+    siguientes = []
     with app.app_context():
-        while True:
-            ahora = _now()
-            dia_semana = ahora.weekday()  # 0=Lunes ... 6=Domingo
-            hora_actual = ahora.strftime('%H:%M')
-            hoy = ahora.date()
-            # Debug: muestra el pulso del scheduler
-            print(f"⏱️ {_scheduler_tz_name} -> {ahora.strftime('%Y-%m-%d %H:%M:%S')} (weekday={dia_semana})")
+        try:
+            for _, prog_id, disparo in entradas:
+                try:
+                    siguiente = _disparar_programacion(prog_id, disparo)
+                    if siguiente:
+                        siguientes.append((siguiente, prog_id, siguiente))
+                except LiderazgoPerdido:
+                    raise
+                except Exception as e:
+                    print(f"❌ Error ejecutando la programación {prog_id}: {e}")
+                    db.session.rollback()
+                    siguientes.append((_now() + timedelta(seconds=_SCHEDULER_REINTENTO_SEG), prog_id, disparo))
+        finally:
+            db.session.remove()
+    return siguientes
+
+
+def _ejecutar_vencidas(vencidas: list) -> list:
+    """
+    Reparte las entradas vencidas de la cola por zona en el pool y espera a que
+    terminen, renovando el lease mientras tanto. Retorna las entradas siguientes.
+    """
+    zonas = dict(
+        db.session.query(ProgramacionMasiva.id, ProgramacionMasiva.zona_id)
+        .filter(ProgramacionMasiva.id.in_([prog_id for _, prog_id, _ in vencidas]))
+        .all()
+    )
+    db.session.commit()
+    por_zona = {}
+    for entrada in vencidas:
+        por_zona.setdefault(zonas.get(entrada[1]), []).append(entrada)
+
+    futuros = [_pool_programaciones.submit(_disparar_zona, entradas) for entradas in por_zona.values()]
+    pendientes = set(futuros)
+    while pendientes:
+        _, pendientes = wait(pendientes, timeout=_SCHEDULER_LEASE_SEG / 3)
+        _latido_scheduler()
+
+    siguientes, perdido = [], None
+    for futuro in futuros:
+        try:
+            siguientes.extend(futuro.result())
+        except LiderazgoPerdido as e:
+            perdido = e
+    if perdido:
+        raise perdido
+    return siguientes
 
-            try:
-                programaciones = ProgramacionMasiva.query.filter_by(activo=True).all()
-                for prog in programaciones:
-                    # Verificar día
-                    dias = {int(d) for d in prog.dias_semana.split(',') if d.strip()}
-                    if dia_semana not in dias:
-                        if prog.ultima_ejecucion != hoy:
-                            print(
-                                f"↷ Programación {prog.id} omitida: hoy es {dia_semana}, "
-                                f"válida para {sorted(dias)}"
-                            )
-                        continue
-
-                    # Verificar hora exacta (minuto)
-                    if prog.hora != hora_actual:
-                        if prog.ultima_ejecucion != hoy:
-                            print(
-                                f"⌛ Programación {prog.id} aún no es su hora: "
-                                f"objetivo {prog.hora}, ahora {hora_actual}"
-                            )
-                        continue
-
-                    # Evitar ejecutar más de una vez por día
-                    if prog.ultima_ejecucion == hoy:
-                        continue
-
-                    # Ejecutar envío para la zona
-                    zona = Zona.query.get(prog.zona_id)
-                    plantilla = MensajePlantilla.query.get(prog.plantilla_id)
-                    if not zona or not plantilla:
-                        continue
-
-                    clientes = Cliente.query.filter(
-                        Cliente.zona_id == prog.zona_id,
-                        Cliente.activo == True
-                    ).all()
-
-                    for cliente in clientes:
-                        contexto_mensaje = _FormatoSeguro({
-                            "nombre_cliente": cliente.nombre,
-                            "cliente_nombre": cliente.nombre,
-                            "zona": zona.nombre,
-                            "zona_nombre": zona.nombre,
-                            "enlace_web": "",
-                            "link_ofertas": "",
-                            "telefono_cliente": cliente.telefono,
-                            "cliente_telefono": cliente.telefono,
-                        })
-                        mensaje_personalizado = plantilla.contenido.format_map(contexto_mensaje)
-
-                        success, error_msg = twilio_sender.send_message(cliente.telefono, mensaje_personalizado)
-
-                        if success:
-                            try:
-                                _register_outgoing_whatsapp_message(
-                                    cliente.telefono,
-                                    mensaje_personalizado,
-                                    sent_at=_now().astimezone(timezone.utc)
-                                )
-                            except Exception as exc:  # noqa: BLE001
-                                print(f"⚠️ No se pudo registrar la conversación avanzada: {exc}")
-
-                        registro = MensajeEnviado(
-                            cliente_id=cliente.id,
-                            plantilla_id=plantilla.id,
-                            mensaje_final=mensaje_personalizado,
-                            enviado=success,
-                            fecha_envio=_now().astimezone(timezone.utc) if success else None,
-                            error=error_msg if not success else None
-                        )
-                        db.session.add(registro)
 
-                    # Marcar ejecución del día y confirmar
-                    prog.ultima_ejecucion = hoy
-                    db.session.commit()
+# Métricas del hilo del scheduler, para comprobar que la memoria se mantiene estable
+_SCHEDULER_METRICAS_SEG = float(os.environ.get('SCHEDULER_METRICAS_SEG', 3600))
+_SCHEDULER_AVISO_OBJETOS = int(os.environ.get('SCHEDULER_AVISO_OBJETOS', 5000))
+
+
+def _rss_mb() -> float | None:
+    """Memoria residente actual del proceso en MB (en sistemas sin /proc, el pico)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return pico / (1024 * 1024) if sys.platform == 'darwin' else pico / 1024
+    except (ImportError, OSError):
+        return None
 
+
+class _MetricasScheduler:
+    """Acumula por ciclo el tamaño del identity map y emite un resumen periódico con el RSS."""
+
+    def __init__(self):
+        self.rss_inicial = _rss_mb()
+        self.ultimo_informe = _time.monotonic()
+        self.ciclos = 0
+        self.max_objetos = 0
+
+    def registrar_ciclo(self, objetos: int):
+        self.ciclos += 1
+        self.max_objetos = max(self.max_objetos, objetos)
+        if objetos > _SCHEDULER_AVISO_OBJETOS:
+            print(f"⚠️ Scheduler: {objetos} objetos en la sesión al terminar el ciclo")
+
+    def informar_si_toca(self):
+        if _time.monotonic() - self.ultimo_informe < _SCHEDULER_METRICAS_SEG:
+            return
+        rss = _rss_mb()
+        memoria = 'RSS desconocido'
+        if rss is not None:
+            memoria = f"RSS {rss:.1f} MB"
+            if self.rss_inicial is not None:
+                memoria += f" ({rss - self.rss_inicial:+.1f} MB desde el arranque)"
+        resumen = f"📊 Scheduler: {self.ciclos} ciclos, {memoria}, máx. {self.max_objetos} objetos en sesión"
+        if hasattr(db.engine.pool, 'checkedout'):
+            resumen += f", {db.engine.pool.checkedout()} conexión(es) en uso"
+        print(resumen)
+        self.ultimo_informe = _time.monotonic()
+        self.ciclos = self.max_objetos = 0
+
+
+def _ejecutor_programaciones():
+    """
+    Hilo en background que ejecuta envíos masivos programados por zona y hora.
+    Corre en todos los procesos web, pero solo dispara el que tiene el lease.
+    """
+    global _scheduler_titular
+    _scheduler_titular = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    cola = []
+    recargar = True
+    recuperar = False
+    lider = ceder_registrado = False
+    sello = _sello_programaciones()
+    metricas = _MetricasScheduler()
+    while True:
+        # Contexto y sesión nuevos en cada ciclo: nada del ciclo anterior queda en el
+        # identity map ni retiene una conexión mientras el hilo duerme
+        error = False
+        with app.app_context():
+            try:
+                era_lider, lider = lider, _latido_scheduler(forzar=not lider)
+                if era_lider and not lider:
+                    print(f"👥 Scheduler: liderazgo perdido ({_scheduler_titular})")
+                    cola = []
+                elif lider and not era_lider:
+                    print(f"👑 Scheduler: este proceso es el líder ({_scheduler_titular})")
+                    recargar = recuperar = True
+                    if not ceder_registrado:
+                        atexit.register(_ceder_liderazgo_scheduler)
+                        ceder_registrado = True
+
+                if lider and recargar:
+                    recargar = False
+                    sello = _sello_programaciones()
+                    cola = _cargar_cola_programaciones(recuperar=recuperar)
+                    recuperar = False
+
+                # Disparar lo que ya ha vencido
+                vencidas = []
+                while lider and cola and cola[0][0] <= _now():
+                    vencidas.append(heapq.heappop(cola))
+                if vencidas:
+                    for entrada in _ejecutar_vencidas(vencidas):
+                        heapq.heappush(cola, entrada)
+            except LiderazgoPerdido as e:
+                # El nuevo líder reanudará la ejecución desde su punto de control
+                print(f"👥 Scheduler: {e}")
+                db.session.rollback()
+                lider, cola = False, []
             except Exception as e:
-                # Evitar que el hilo muera por excepciones
+                # Evitar que el hilo muera por excepciones; las ejecuciones a medias se reanudan al recargar
                 print(f"❌ Error en ejecutor de programaciones: {e}")
-
-            # Dormir hasta el siguiente minuto
-            _time.sleep(300)
+                db.session.rollback()
+                recargar = error = True
+            finally:
+                metricas.registrar_ciclo(len(db.session.identity_map))
+                db.session.expunge_all()
+                db.session.remove()
+                metricas.informar_si_toca()
+
+        if error:
+            _programaciones_cambiadas.wait(timeout=_SCHEDULER_REINTENTO_SEG)
+            continue
+
+        # Dormir hasta el próximo disparo, atentos a cambios en las programaciones;
+        # los seguidores solo despiertan para intentar tomar el lease
+        espera = min(_SCHEDULER_REVISION_SEG, _SCHEDULER_LEASE_SEG / 3)
+        if not lider:
+            _time.sleep(espera)
+            continue
+        if cola:
+            espera = max(0.0, min(espera, (cola[0][0] - _now()).total_seconds()))
+        if _programaciones_cambiadas.wait(timeout=espera):
+            _programaciones_cambiadas.clear()
+            recargar = True
+        elif _sello_programaciones() != sello:
+            recargar = True
 
 
 def _iniciar_hilo_programaciones():
@@ -627,6 +1635,420 @@ def _asegurar_scheduler():
         except Exception as e:
             print(f"❌ No se pudo iniciar el scheduler: {e}")
 
+
+# Cola de salida (outbox): las rutas web y el scheduler solo encolan filas en
+# OutboxMensaje; el worker (`python -m app worker`) las reclama en lotes, las
+# envía con un pool acotado de hilos y registra el resultado.
+_OUTBOX_MAX_WORKERS = max(1, int(os.environ.get('OUTBOX_MAX_WORKERS', os.environ.get('CAMPANA_MAX_WORKERS', 8))))
+_OUTBOX_LOTE = max(1, int(os.environ.get('OUTBOX_LOTE', 50)))
+_OUTBOX_LEASE_SEG = int(os.environ.get('OUTBOX_LEASE_SEG', 300))
+_OUTBOX_ESPERA_SEG = float(os.environ.get('OUTBOX_ESPERA_SEG', 1.0))
+_OUTBOX_MAX_INTENTOS = max(1, int(os.environ.get('OUTBOX_MAX_INTENTOS', 5)))
+_OUTBOX_BACKOFF_BASE_SEG = float(os.environ.get('OUTBOX_BACKOFF_BASE_SEG', 30))
+_OUTBOX_BACKOFF_MAX_SEG = float(os.environ.get('OUTBOX_BACKOFF_MAX_SEG', 1800))
+# 'async' envía cada lote con el cliente HTTP asíncrono (si httpx está instalado); 'hilos' usa el pool de hilos
+_OUTBOX_TRANSPORTE = os.environ.get('OUTBOX_TRANSPORTE', 'async').lower()
+_OUTBOX_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+_pool_envios = ThreadPoolExecutor(max_workers=_OUTBOX_MAX_WORKERS, thread_name_prefix='envio_outbox')
+_outbox_embebido_iniciado = False
+# 'true' arranca siempre el worker en el proceso web, 'false' nunca; por defecto
+# ('auto') se arranca si ningún worker ha dado señales de vida (lease 'worker_outbox')
+_OUTBOX_WORKER_EMBEDDED = os.environ.get('OUTBOX_WORKER_EMBEDDED', 'auto').lower()
+_OUTBOX_LATIDO = 'worker_outbox'
+_OUTBOX_LATIDO_SEG = float(os.environ.get('OUTBOX_LATIDO_SEG', 15))
+_outbox_ultimo_latido = 0.0
+_outbox_ultima_comprobacion = 0.0
+_outbox_inicio_proceso = _time.monotonic()
+
+
+def _encolar_mensajes(filas: list[dict]) -> int:
+    """
+    Encola mensajes salientes en la sesión actual (sin commit).
+    Cada fila necesita 'clave_idempotencia', 'origen', 'telefono' y 'mensaje';
+    las claves ya encoladas se ignoran. Retorna cuántas filas se añadieron.
+    """
+    if not filas:
+        return 0
+
+    claves = [fila['clave_idempotencia'] for fila in filas]
+    existentes = set()
+    for inicio in range(0, len(claves), 500):
+        existentes.update(
+            clave for (clave,) in db.session.query(OutboxMensaje.clave_idempotencia)
+            .filter(OutboxMensaje.clave_idempotencia.in_(claves[inicio:inicio + 500]))
+        )
+
+    ahora = datetime.utcnow()
+    nuevas = []
+    for fila in filas:
+        if fila['clave_idempotencia'] in existentes:
+            continue
+        existentes.add(fila['clave_idempotencia'])
+        nuevas.append({'estado': 'pendiente', 'intentos': 0, 'created_at': ahora, **fila})
+
+    if nuevas:
+        db.session.bulk_insert_mappings(OutboxMensaje, nuevas)
+    return len(nuevas)
+
+
+def _encolar_mensaje_conversacion(message: WhatsAppMessage, telefono: str, texto: str, media_url: str | None = None):
+    """Encola el envío de un mensaje de agente ya añadido a una conversación."""
+    db.session.flush()
+    _encolar_mensajes([{
+        'clave_idempotencia': f"whatsapp_message:{message.id}",
+        'origen': 'conversacion',
+        'telefono': telefono,
+        'mensaje': texto or "",
+        'media_url': media_url,
+        'whatsapp_message_id': message.id,
+        'usuario_id': message.usuario_id,
+    }])
+
+
+def _reclamar_lote_outbox(limite: int) -> list[OutboxMensaje]:
+    """Reclama hasta `limite` filas pendientes (o con lease vencido) para este worker."""
+    ahora = datetime.utcnow()
+    token = f"{_OUTBOX_WORKER_ID}:{uuid.uuid4().hex[:8]}"
+    disponible = or_(
+        and_(
+            OutboxMensaje.estado == 'pendiente',
+            or_(OutboxMensaje.disponible_en.is_(None), OutboxMensaje.disponible_en <= ahora),
+        ),
+        and_(OutboxMensaje.estado == 'procesando', OutboxMensaje.bloqueado_hasta < ahora),
+    )
+    candidatos = select(OutboxMensaje.id).where(disponible).order_by(OutboxMensaje.id.asc()).limit(limite)
+
+    reclamadas = OutboxMensaje.query.filter(OutboxMensaje.id.in_(candidatos), disponible).update({
+        'estado': 'procesando',
+        'bloqueado_por': token,
+        'bloqueado_hasta': ahora + timedelta(seconds=_OUTBOX_LEASE_SEG),
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if not reclamadas:
+        return []
+    return OutboxMensaje.query.filter_by(bloqueado_por=token, estado='procesando').order_by(OutboxMensaje.id.asc()).all()
+
+
+def _enviar_fila_outbox(telefono: str, mensaje: str, media_url: str | None) -> ResultadoEnvio:
+    return twilio_sender.enviar(telefono, mensaje or "", media_url=media_url)
+
+
+def _usar_transporte_async() -> bool:
+    return _OUTBOX_TRANSPORTE == 'async' and twilio_async_sender.disponible
+
+
+def _enviar_filas_outbox(filas: list[OutboxMensaje]):
+    """Envía las filas de un lote y genera pares (fila, ResultadoEnvio) según van terminando."""
+    if _usar_transporte_async():
+        resultados = twilio_async_sender.enviar_lote_sync(
+            (fila.telefono, fila.mensaje or "", fila.media_url) for fila in filas
+        )
+        yield from zip(filas, resultados)
+        return
+
+    futuros = {
+        _pool_envios.submit(_enviar_fila_outbox, fila.telefono, fila.mensaje, fila.media_url): fila
+        for fila in filas
+    }
+    for futuro in as_completed(futuros):
+        try:
+            resultado = futuro.result()
+        except Exception as exc:  # noqa: BLE001
+            resultado = ResultadoEnvio(False, error=f"Error inesperado: {exc}")
+        yield futuros[futuro], resultado
+
+
+def _espera_reintento(intentos: int) -> float:
+    """Backoff exponencial con jitter: base·2^(n-1), acotado, entre la mitad y el total."""
+    espera = min(_OUTBOX_BACKOFF_MAX_SEG, _OUTBOX_BACKOFF_BASE_SEG * (2 ** max(0, intentos - 1)))
+    return random.uniform(espera / 2, espera)
+
+
+def _registrar_resultado_outbox(fila: OutboxMensaje, resultado: ResultadoEnvio, contadores: dict, escritor: _EscritorResultados):
+    """Registra el resultado de un envío según el origen de la fila (sin commit)."""
+    fila.intentos = (fila.intentos or 0) + 1
+    fila.codigo_error = resultado.codigo
+    fila.bloqueado_por = None
+    fila.bloqueado_hasta = None
+
+    # Fallos transitorios: volver a la cola más tarde sin registrar nada todavía
+    if not resultado.success and resultado.transitorio and fila.intentos < _OUTBOX_MAX_INTENTOS:
+        espera = _espera_reintento(fila.intentos)
+        fila.estado = 'pendiente'
+        fila.error = resultado.error
+        fila.disponible_en = datetime.utcnow() + timedelta(seconds=espera)
+        print(f"🔁 Outbox {fila.id}: intento {fila.intentos} fallido ({resultado.error}); reintento en {espera:.0f}s")
+        return
+
+    success = resultado.success
+    ahora = datetime.now(timezone.utc)
+    external_id = resultado.sid if success and resultado.sid else None
+    error_msg = resultado.error if not success else None
+
+    if fila.origen in ('campana', 'programacion'):
+        escritor.agregar_envio(
+            cliente_id=fila.cliente_id,
+            plantilla_id=fila.plantilla_id,
+            campana_id=fila.campana_id,
+            mensaje_final=fila.mensaje,
+            enviado=success,
+            fecha_envio=ahora if success else None,
+            error=error_msg,
+            created_at=datetime.utcnow(),
+            sid=external_id,
+        )
+        if success:
+            escritor.agregar_whatsapp_saliente(
+                fila.telefono,
+                fila.mensaje,
+                sent_at=ahora,
+                external_id=external_id,
+                usuario_id=fila.usuario_id,
+            )
+        if fila.campana_id:
+            contador = contadores.setdefault(fila.campana_id, {'enviados': 0, 'fallidos': 0})
+            contador['enviados' if success else 'fallidos'] += 1
+
+    elif fila.origen == 'respuesta':
+        # whatsapp_message_id es el mensaje entrante respondido; respuesta_id solo
+        # llega en filas encoladas antes del almacén único
+        respondido = WhatsAppMessage.query.get(fila.whatsapp_message_id) if fila.whatsapp_message_id else None
+        if respondido and success:
+            respondido.respondido = True
+        respuesta = RespuestaMensaje.query.get(fila.respuesta_id) if fila.respuesta_id else None
+        if respuesta:
+            respuesta.enviado = success
+            respuesta.fecha_envio = ahora if success else None
+            respuesta.error = error_msg
+            if success:
+                respuesta.mensaje_recibido.respondido = True
+        if success:
+            escritor.agregar_whatsapp_saliente(
+                fila.telefono,
+                fila.mensaje,
+                sent_at=ahora,
+                external_id=external_id,
+                usuario_id=fila.usuario_id,
+            )
+
+    elif fila.origen == 'conversacion':
+        # El mensaje ya se mostró en la conversación al encolarlo; solo falta el SID,
+        # o marcarlo como fallido para que el agente sepa que no llegó a enviarse
+        mensaje_whatsapp = WhatsAppMessage.query.get(fila.whatsapp_message_id) if fila.whatsapp_message_id else None
+        if mensaje_whatsapp and external_id:
+            mensaje_whatsapp.external_id = external_id
+        elif mensaje_whatsapp and not success:
+            mensaje_whatsapp.estado_entrega = 'failed'
+            mensaje_whatsapp.estado_entrega_at = datetime.utcnow()
+
+    fila.estado = 'enviado' if success else 'fallido'
+    fila.external_id = external_id
+    fila.error = error_msg
+    fila.disponible_en = None
+    fila.procesado_at = datetime.utcnow()
+
+    if not success:
+        # A la cola de mensajes muertos para poder reencolarlo más adelante
+        db.session.add(OutboxFallido(
+            outbox_id=fila.id,
+            origen=fila.origen,
+            telefono=fila.telefono,
+            campana_id=fila.campana_id,
+            intentos=fila.intentos,
+            codigo_error=resultado.codigo,
+            transitorio=resultado.transitorio,
+            error=error_msg,
+        ))
+
+
+def _reencolar_fallidos(solo_transitorios: bool = False, codigo_error: int | None = None, campana_id: int | None = None) -> int:
+    """
+    Devuelve a la cola los mensajes de la cola de mensajes muertos (sin commit).
+    Deshace lo registrado al darlos por fallidos (contador de la campaña y fila
+    fallida del historial) para que el nuevo intento cuente una sola vez.
+    Retorna cuántos mensajes se reencolaron.
+    """
+    consulta = db.session.query(OutboxFallido.id, OutboxFallido.outbox_id)
+    if solo_transitorios:
+        consulta = consulta.filter(OutboxFallido.transitorio == True)
+    if codigo_error is not None:
+        consulta = consulta.filter(OutboxFallido.codigo_error == codigo_error)
+    if campana_id is not None:
+        consulta = consulta.filter(OutboxFallido.campana_id == campana_id)
+    pares = consulta.all()
+    if not pares:
+        return 0
+
+    for inicio in range(0, len(pares), 500):
+        bloque = pares[inicio:inicio + 500]
+        outbox_ids = [outbox_id for _, outbox_id in bloque]
+
+        por_campana = defaultdict(list)
+        for campana, cliente in db.session.query(OutboxMensaje.campana_id, OutboxMensaje.cliente_id).filter(
+            OutboxMensaje.id.in_(outbox_ids),
+            OutboxMensaje.origen.in_(('campana', 'programacion')),
+            OutboxMensaje.campana_id.isnot(None),
+        ):
+            por_campana[campana].append(cliente)
+
+        for campana, clientes in por_campana.items():
+            MensajeEnviado.query.filter(
+                MensajeEnviado.campana_id == campana,
+                MensajeEnviado.cliente_id.in_(clientes),
+                MensajeEnviado.enviado == False,
+            ).delete(synchronize_session=False)
+            CampanaEnvio.query.filter_by(id=campana).update({
+                'fallidos': case((CampanaEnvio.fallidos > len(clientes), CampanaEnvio.fallidos - len(clientes)), else_=0),
+                'estado': 'en_curso',
+                'finalizado_at': None,
+            }, synchronize_session=False)
+
+        # Los mensajes de conversación marcados como fallidos vuelven a quedar pendientes
+        mensajes_conversacion = select(OutboxMensaje.whatsapp_message_id).where(
+            OutboxMensaje.id.in_(outbox_ids),
+            OutboxMensaje.origen == 'conversacion',
+            OutboxMensaje.whatsapp_message_id.isnot(None),
+        )
+        WhatsAppMessage.query.filter(
+            WhatsAppMessage.id.in_(mensajes_conversacion),
+            WhatsAppMessage.estado_entrega == 'failed',
+        ).update({'estado_entrega': None, 'estado_entrega_at': None}, synchronize_session=False)
+
+        OutboxMensaje.query.filter(OutboxMensaje.id.in_(outbox_ids)).update({
+            'estado': 'pendiente',
+            'intentos': 0,
+            'disponible_en': None,
+            'codigo_error': None,
+            'error': None,
+            'procesado_at': None,
+        }, synchronize_session=False)
+        OutboxFallido.query.filter(OutboxFallido.id.in_([id_ for id_, _ in bloque])).delete(synchronize_session=False)
+
+    return len(pares)
+
+
+def _actualizar_contadores_campanas(contadores: dict):
+    """Suma los resultados del lote a cada campaña y cierra las que han terminado."""
+    for campana_id, contador in contadores.items():
+        CampanaEnvio.query.filter_by(id=campana_id).update({
+            'enviados': CampanaEnvio.enviados + contador['enviados'],
+            'fallidos': CampanaEnvio.fallidos + contador['fallidos'],
+        }, synchronize_session=False)
+    if contadores:
+        CampanaEnvio.query.filter(
+            CampanaEnvio.id.in_(list(contadores)),
+            CampanaEnvio.estado == 'en_curso',
+            CampanaEnvio.enviados + CampanaEnvio.fallidos >= CampanaEnvio.total,
+        ).update({'estado': 'completada', 'finalizado_at': datetime.utcnow()}, synchronize_session=False)
+
+
+def _procesar_lote_outbox(limite: int = _OUTBOX_LOTE) -> int:
+    """Reclama un lote, lo envía en paralelo y registra los resultados. Retorna el tamaño del lote."""
+    filas = _reclamar_lote_outbox(limite)
+    if not filas:
+        return 0
+
+    contadores = {}
+    escritor = _EscritorResultados()
+    sids = []
+    try:
+        for fila, resultado in _enviar_filas_outbox(filas):
+            _registrar_resultado_outbox(fila, resultado, contadores, escritor)
+            if resultado.success and resultado.sid:
+                sids.append(resultado.sid)
+
+        escritor.flush()
+        # Estados de entrega que llegaron antes de que guardásemos el SID
+        _aplicar_estados_entrega(sids)
+        _actualizar_contadores_campanas(contadores)
+        db.session.commit()
+    except Exception:
+        # Las filas quedan reclamadas hasta que venza el lease y se reintentarán
+        db.session.rollback()
+        raise
+    return len(filas)
+
+
+def _ejecutor_outbox():
+    """Bucle del worker de la cola de salida."""
+    if _usar_transporte_async():
+        transporte = f"HTTP asíncrono, {twilio_async_sender.concurrencia} conexiones"
+    else:
+        if _OUTBOX_TRANSPORTE == 'async':
+            print("⚠️ httpx no está instalado: el worker de outbox envía con el pool de hilos")
+        transporte = f"{_OUTBOX_MAX_WORKERS} hilos"
+    print(f"📮 Worker de outbox iniciado ({_OUTBOX_WORKER_ID}, {transporte}, lotes de {_OUTBOX_LOTE})")
+    while True:
+        procesados = 0
+        try:
+            with app.app_context():
+                _latido_outbox()
+                procesados = _procesar_lote_outbox()
+                if procesados:
+                    print(f"📤 Outbox: lote de {procesados} mensaje(s) procesado")
+        except Exception as e:
+            # Evitar que el worker muera por excepciones
+            print(f"❌ Error en worker de outbox: {e}")
+
+        if not procesados:
+            _time.sleep(_OUTBOX_ESPERA_SEG)
+
+
+def _iniciar_outbox_embebido():
+    """Arranca el worker de outbox dentro del proceso web (solo si se habilita explícitamente)."""
+    global _outbox_embebido_iniciado
+    if _outbox_embebido_iniciado:
+        return
+    hilo = threading.Thread(target=_ejecutor_outbox, name='worker_outbox', daemon=True)
+    hilo.start()
+    _outbox_embebido_iniciado = True
+
+
+def _latido_outbox():
+    """
+    Señal de vida del worker (cada OUTBOX_LATIDO_SEG). Con varios workers solo
+    uno tiene el lease, pero basta con que esté vigente: hay alguien enviando.
+    """
+    global _outbox_ultimo_latido
+    if _time.monotonic() - _outbox_ultimo_latido < _OUTBOX_LATIDO_SEG:
+        return
+    _adquirir_lease(_OUTBOX_LATIDO, _OUTBOX_WORKER_ID, _OUTBOX_LATIDO_SEG * 3)
+    _outbox_ultimo_latido = _time.monotonic()
+
+
+def _worker_outbox_activo() -> bool:
+    """Si algún worker de outbox (separado o embebido) ha renovado su latido hace poco."""
+    return db.session.query(LeaseProceso.nombre).filter(
+        LeaseProceso.nombre == _OUTBOX_LATIDO,
+        LeaseProceso.expira_at >= datetime.utcnow(),
+    ).first() is not None
+
+
+@app.before_request
+def _asegurar_outbox_embebido():
+    global _outbox_ultima_comprobacion
+    if _outbox_embebido_iniciado or _OUTBOX_WORKER_EMBEDDED == 'false':
+        return
+    if _OUTBOX_WORKER_EMBEDDED == 'true':
+        _iniciar_outbox_embebido()
+        return
+
+    # Modo auto: se deja margen tras arrancar para que el worker separado dé su
+    # primer latido, y después se comprueba como mucho una vez por latido
+    ahora = _time.monotonic()
+    if ahora - _outbox_inicio_proceso < 2 * _OUTBOX_LATIDO_SEG or ahora - _outbox_ultima_comprobacion < _OUTBOX_LATIDO_SEG:
+        return
+    _outbox_ultima_comprobacion = ahora
+    try:
+        # Tomar el lease del latido decide quién arranca el worker: si varios procesos
+        # web lo echan en falta a la vez, solo uno lo consigue y los demás ven su latido
+        if _adquirir_lease(_OUTBOX_LATIDO, _OUTBOX_WORKER_ID, _OUTBOX_LATIDO_SEG * 3):
+            print("⚠️ No hay ningún worker de outbox activo (`python -m app worker`): se arranca dentro del proceso web")
+            _iniciar_outbox_embebido()
+    except Exception as e:
+        print(f"⚠️ No se pudo comprobar el worker de outbox: {e}")
+
 # Esta aplicación usa SQLite (recambios.db) para desarrollo local
 
 def inicializar_sistema():
@@ -919,6 +2341,7 @@ def nuevo_cliente():
         try:
             db.session.add(cliente)
             db.session.commit()
+            _olvidar_clientes_por_telefono()
             flash('Cliente creado correctamente.', 'success')
             return redirect(url_for('clientes'))
         except Exception as e:
@@ -1089,6 +2512,7 @@ def importar_clientes():
             db.session.add(cliente)
 
         db.session.commit()
+        _olvidar_clientes_por_telefono()
         if filas_invalidas:
             detalles = '; '.join(
                 f"fila {item['fila_excel']} (Código: {item['codigo']}, Nombre: {item['nombre']}, Teléfono original: {item['telefono']})"
@@ -1126,6 +2550,7 @@ def editar_cliente(cliente_id):
         
         try:
             db.session.commit()
+            _olvidar_clientes_por_telefono()
             flash('Cliente actualizado exitosamente', 'success')
             return redirect(url_for('clientes'))
         except Exception as e:
@@ -1351,6 +2776,13 @@ def nueva_plantilla():
             flash('El nombre y el contenido de la plantilla son obligatorios.', 'error')
             return redirect(url_for('nueva_plantilla'))
 
+        # Rechazar aquí las plantillas con marcadores que no se sabrían rellenar
+        try:
+            validar_plantilla(contenido)
+        except PlantillaInvalida as e:
+            flash(f'Plantilla no válida. {str(e)}', 'error')
+            return redirect(url_for('nueva_plantilla'))
+
         plantilla = MensajePlantilla(nombre=nombre, contenido=contenido, activo=True)
 
         try:
@@ -1383,73 +2815,152 @@ def enviar_masivo():
         
         zona = Zona.query.get(zona_id)
         plantilla = MensajePlantilla.query.get(plantilla_id)
+        if not zona or not plantilla:
+            flash('La zona o la plantilla seleccionada no existe', 'error')
+            return redirect(url_for('enviar_masivo'))
+
         # Obtener solo los clientes seleccionados
         cliente_ids = [int(id) for id in destinatarios_seleccionados.split(',') if id.strip()]
+
         clientes = Cliente.query.filter(
             Cliente.id.in_(cliente_ids),
-            Cliente.zona_id == zona_id,
+            Cliente.zona_id == zona.id,
             Cliente.activo == True
-        ).all()
-        
-        resultados = []
-        exitosos = 0
-        fallidos = 0
-        
-        for cliente in clientes:
-            contexto_mensaje = _FormatoSeguro({
-                "nombre_cliente": cliente.nombre,
-                "cliente_nombre": cliente.nombre,
-                "zona": zona.nombre,
-                "zona_nombre": zona.nombre,
-                "enlace_web": "",
-                "link_ofertas": "",
-                "telefono_cliente": cliente.telefono,
-                "cliente_telefono": cliente.telefono,
-            })
+        ).order_by(Cliente.id.asc()).all()
+        clientes, duplicados, suprimidos = _seleccionar_destinatarios(clientes, plantilla.id)
 
-            # Personalizar mensaje con datos del cliente
-            mensaje_personalizado = plantilla.contenido.format_map(contexto_mensaje)
-            
-            # Enviar mensaje usando Twilio
-            success, error_msg = twilio_sender.send_message(cliente.telefono, mensaje_personalizado)
-            
-            # Registrar envío
-            mensaje_enviado = MensajeEnviado(
-                cliente_id=cliente.id,
+        # La petición solo registra la campaña y encola los envíos; el worker de outbox los realiza
+        try:
+            campana = CampanaEnvio(
+                zona_id=zona.id,
                 plantilla_id=plantilla.id,
-                mensaje_final=mensaje_personalizado,
-                enviado=success,
-                fecha_envio=datetime.now(timezone.utc) if success else None,
-                error=error_msg if not success else None
+                usuario_id=current_user.id if current_user.is_authenticated else None,
+                estado='en_curso',
+                total=len(clientes),
+                iniciado_at=datetime.utcnow(),
             )
-            db.session.add(mensaje_enviado)
-            
-            if success:
-                exitosos += 1
-            else:
-                fallidos += 1
-            
-            resultados.append({
-                'cliente': cliente.nombre,
-                'telefono': cliente.telefono,
-                'exito': success,
-                'error': error_msg if not success else None
-            })
-        
-        db.session.commit()
-        
-        flash(f'Enviados: {exitosos}, Fallidos: {fallidos}', 'success')
-        return render_template('resultado_envio.html', 
-                             resultados=resultados, 
-                             zona=zona, 
-                             plantilla=plantilla,
-                             exitosos=exitosos,
-                             fallidos=fallidos)
+            db.session.add(campana)
+            db.session.flush()
+
+            mensajes_renderizados = obtener_plan(plantilla).render_many(clientes, zona)
+            filas = []
+            for cliente, mensaje_personalizado in zip(clientes, mensajes_renderizados):
+                filas.append({
+                    'clave_idempotencia': f"campana:{campana.id}:{cliente.id}",
+                    'origen': 'campana',
+                    'telefono': cliente.telefono,
+                    'mensaje': mensaje_personalizado,
+                    'cliente_id': cliente.id,
+                    'plantilla_id': plantilla.id,
+                    'campana_id': campana.id,
+                    'usuario_id': campana.usuario_id,
+                })
+            _encolar_mensajes(filas)
+
+            if not clientes:
+                campana.estado = 'completada'
+                campana.finalizado_at = datetime.utcnow()
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error creando la campaña de envío: {str(e)}', 'error')
+            return redirect(url_for('enviar_masivo'))
+
+        flash(f'Envío masivo en curso para {len(clientes)} destinatario(s)', 'info')
+        if duplicados or suprimidos:
+            flash(
+                f'Se omitieron {duplicados} teléfono(s) duplicado(s) y {suprimidos} cliente(s) que ya recibieron '
+                f'esta plantilla en las últimas {_SUPRESION_VENTANA_HORAS:g} horas',
+                'warning',
+            )
+        return redirect(url_for('resultado_campana', campana_id=campana.id))
     
     zonas = Zona.query.all()
     plantillas = MensajePlantilla.query.filter_by(activo=True).all()
     return render_template('enviar_masivo.html', zonas=zonas, plantillas=plantillas)
 
+@app.route('/enviar_masivo/campanas/<int:campana_id>')
+@login_required
+def resultado_campana(campana_id):
+    """Resultado de una campaña leído desde la base de datos"""
+    campana = CampanaEnvio.query.get_or_404(campana_id)
+    registros = db.session.query(MensajeEnviado, Cliente)\
+        .join(Cliente, MensajeEnviado.cliente_id == Cliente.id)\
+        .filter(MensajeEnviado.campana_id == campana.id)\
+        .order_by(MensajeEnviado.id.asc())\
+        .all()
+    resultados = [{
+        'cliente': cliente.nombre,
+        'telefono': cliente.telefono,
+        'exito': mensaje.enviado,
+        'error': mensaje.error if not mensaje.enviado else None,
+        'estado_entrega': mensaje.estado_entrega,
+    } for mensaje, cliente in registros]
+
+    return render_template('resultado_envio.html',
+                         campana=campana,
+                         worker_activo=campana.finalizada or _worker_outbox_activo(),
+                         entrega=_estadisticas_entrega([campana.id])[campana.id],
+                         resultados=resultados,
+                         zona=campana.zona,
+                         plantilla=campana.plantilla,
+                         exitosos=campana.enviados,
+                         fallidos=campana.fallidos)
+
+@app.get('/enviar_masivo/campanas/<int:campana_id>/progreso')
+@login_required
+def progreso_campana(campana_id):
+    """Progreso de una campaña en curso (consultado por la página de resultados)"""
+    campana = CampanaEnvio.query.get_or_404(campana_id)
+    return jsonify({
+        'id': campana.id,
+        'estado': campana.estado,
+        'total': campana.total,
+        'enviados': campana.enviados,
+        'fallidos': campana.fallidos,
+        'procesados': campana.procesados,
+        'pendientes': max(campana.total - campana.procesados, 0),
+        'finalizada': campana.finalizada,
+        'error': campana.error,
+        'worker_activo': campana.finalizada or _worker_outbox_activo(),
+        'entrega': _estadisticas_entrega([campana.id])[campana.id],
+    })
+
+@app.route('/enviar_masivo/fallidos')
+@login_required
+def mensajes_fallidos():
+    """Cola de mensajes muertos: envíos que fallaron definitivamente"""
+    total = OutboxFallido.query.count()
+    por_codigo = db.session.query(
+        OutboxFallido.codigo_error,
+        OutboxFallido.transitorio,
+        func.count(OutboxFallido.id),
+    ).group_by(OutboxFallido.codigo_error, OutboxFallido.transitorio)\
+        .order_by(func.count(OutboxFallido.id).desc()).all()
+    fallidos = OutboxFallido.query.options(joinedload(OutboxFallido.outbox))\
+        .order_by(OutboxFallido.created_at.desc()).limit(200).all()
+    return render_template('mensajes_fallidos.html', total=total, por_codigo=por_codigo, fallidos=fallidos)
+
+@app.post('/enviar_masivo/fallidos/reencolar')
+@login_required
+def reencolar_mensajes_fallidos():
+    """Reencola en bloque la cola de mensajes muertos (opcionalmente filtrada)"""
+    codigo_error = request.form.get('codigo_error', type=int)
+    campana_id = request.form.get('campana_id', type=int)
+    solo_transitorios = request.form.get('solo_transitorios') == '1'
+    try:
+        reencolados = _reencolar_fallidos(
+            solo_transitorios=solo_transitorios,
+            codigo_error=codigo_error,
+            campana_id=campana_id,
+        )
+        db.session.commit()
+        flash(f'{reencolados} mensaje(s) reencolado(s) para envío', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error reencolando mensajes: {str(e)}', 'error')
+    return redirect(url_for('mensajes_fallidos'))
+
 @app.route('/historial')
 @login_required
 def historial():
@@ -1466,6 +2977,18 @@ def api_clientes_zona(zona_id):
     } for c in clientes])
 
 # Rutas para gestión de programaciones
+_VENTANA_MAX_MINUTOS = 12 * 60
+
+
+def _leer_ventana_minutos(valor: str | None) -> int | None:
+    """Ventana de envío del formulario; vacío es 0. Retorna None si no es válida."""
+    try:
+        minutos = int(valor or 0)
+    except ValueError:
+        return None
+    return minutos if 0 <= minutos <= _VENTANA_MAX_MINUTOS else None
+
+
 @app.route('/programaciones')
 @login_required
 def programaciones():
@@ -1484,10 +3007,14 @@ def nueva_programacion():
     plantilla_id = request.form.get('plantilla_id')
     dias_semana = request.form.getlist('dias_semana')
     hora = request.form.get('hora')
+    ventana_minutos = _leer_ventana_minutos(request.form.get('ventana_minutos'))
     
     if not zona_id or not plantilla_id or not dias_semana or not hora:
         flash('Todos los campos son obligatorios', 'error')
         return redirect(url_for('programaciones'))
+    if ventana_minutos is None:
+        flash(f'La ventana de envío debe ser un número de minutos entre 0 y {_VENTANA_MAX_MINUTOS}', 'error')
+        return redirect(url_for('programaciones'))
     
     try:
         dias_normalizados = sorted({str(int(d)) for d in dias_semana if d.strip()})
@@ -1496,11 +3023,13 @@ def nueva_programacion():
             plantilla_id=int(plantilla_id),
             dias_semana=','.join(dias_normalizados),
             hora=hora,
+            ventana_minutos=ventana_minutos,
             activo=True,
             ultima_ejecucion=None
         )
         db.session.add(programacion)
         db.session.commit()
+        _invalidar_programaciones()
         flash('Programación creada correctamente', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1518,21 +3047,35 @@ def editar_programacion(id):
         plantilla_id = request.form.get('plantilla_id')
         dias_semana = request.form.getlist('dias_semana')
         hora = request.form.get('hora')
+        ventana_minutos = _leer_ventana_minutos(request.form.get('ventana_minutos'))
         
         if not zona_id or not plantilla_id or not dias_semana or not hora:
             flash('Todos los campos son obligatorios', 'error')
             return redirect(url_for('editar_programacion', id=id))
+        if ventana_minutos is None:
+            flash(f'La ventana de envío debe ser un número de minutos entre 0 y {_VENTANA_MAX_MINUTOS}', 'error')
+            return redirect(url_for('editar_programacion', id=id))
         
         try:
             dias_normalizados = sorted({str(int(d)) for d in dias_semana if d.strip()})
             programacion.zona_id = int(zona_id)
             programacion.plantilla_id = int(plantilla_id)
             programacion.dias_semana = ','.join(dias_normalizados)
-            if programacion.hora != hora:
-                programacion.ultima_ejecucion = None
+            # Una programación se ejecuta como mucho una vez al día (la ejecución se
+            # identifica por programación y fecha): si hoy ya se ejecutó, la nueva hora
+            # se aplica a partir del próximo día programado
+            hoy = _now().date()
+            ya_ejecutada_hoy = programacion.hora != hora and (
+                programacion.ultima_ejecucion == hoy
+                or CampanaEnvio.query.filter_by(programacion_id=programacion.id, fecha_programada=hoy).first() is not None
+            )
             programacion.hora = hora
+            programacion.ventana_minutos = ventana_minutos
             db.session.commit()
+            _invalidar_programaciones()
             flash('Programación actualizada correctamente', 'success')
+            if ya_ejecutada_hoy:
+                flash('Esta programación ya se ejecutó hoy: la nueva hora se aplicará desde el próximo día programado', 'info')
             return redirect(url_for('programaciones'))
         except Exception as e:
             db.session.rollback()
@@ -1555,6 +3098,7 @@ def eliminar_programacion(id):
     try:
         db.session.delete(programacion)
         db.session.commit()
+        _invalidar_programaciones()
         flash('Programación eliminada correctamente', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1569,6 +3113,7 @@ def toggle_programacion(id):
     programacion.activo = not programacion.activo
     try:
         db.session.commit()
+        _invalidar_programaciones()
         estado = 'activada' if programacion.activo else 'desactivada'
         flash(f'Programación {estado} correctamente', 'success')
     except Exception as e:
@@ -1806,6 +3351,7 @@ def panel_envios_masivos():
     total_plantillas = MensajePlantilla.query.count()
     total_historial = MensajeEnviado.query.count()
     total_programaciones = ProgramacionMasiva.query.count()
+    total_fallidos = OutboxFallido.query.count()
     return render_template(
         'panel_envios.html',
         total_clientes=total_clientes,
@@ -1813,6 +3359,7 @@ def panel_envios_masivos():
         total_plantillas=total_plantillas,
         total_historial=total_historial,
         total_programaciones=total_programaciones,
+        total_fallidos=total_fallidos,
     )
 
 @app.route('/publico/ofertas')
@@ -1897,6 +3444,8 @@ def configurar_twilio_route():
 
         if conectado:
             flash(f'Twilio configurado exitosamente: {mensaje}', 'success')
+            if not _outbox_embebido_iniciado:
+                flash('Los envíos los hace el worker separado, que no recibe estas credenciales: define TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN y TWILIO_WHATSAPP_NUMBER en su entorno', 'warning')
         else:
             flash(f'Error configurando Twilio: {mensaje}', 'error')
         
@@ -2269,193 +3818,952 @@ def eliminar_plantillas_temporales():
     flash(f'Plantillas eliminadas: {", ".join(eliminadas)}', 'success')
     return redirect(url_for('mensajes'))
 
-# Rutas para mensajes recibidos
-@app.route('/webhook/whatsapp', methods=['POST'])
-def webhook_whatsapp():
-    """Webhook para recibir mensajes de Twilio"""
-    # Rate limiting: Protección contra spam
-    client_ip = _get_client_ip()
-    if not _check_rate_limit(client_ip):
-        print(f"⚠️ Rate limit excedido para IP: {client_ip}")
-        return jsonify({
-            'status': 'error',
-            'message': 'Rate limit exceeded. Too many requests.'
-        }), 429  # HTTP 429: Too Many Requests
+# Rutas para mensajes recibidos
+_TWIML_VACIO = '<?xml version="1.0" encoding="UTF-8"?><Response></Response>'
+
+
+@app.route('/webhook/whatsapp', methods=['POST'])
+def webhook_whatsapp():
+    """
+    Webhook para recibir mensajes de Twilio. Solo guarda el payload en la bandeja
+    de entrada y responde al momento; el consumidor de webhooks hace el resto.
+    """
+    # Rate limiting: Protección contra spam
+    client_ip = _get_client_ip()
+    if not _check_rate_limit(client_ip):
+        print(f"⚠️ Rate limit excedido para IP: {client_ip}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Rate limit exceeded. Too many requests.'
+        }), 429  # HTTP 429: Too Many Requests
+    
+    try:
+        # Detectar User-Agent para identificar el origen
+        user_agent = request.headers.get('User-Agent', '')
+        
+        # Twilio envía datos como form-urlencoded o JSON
+        if request.is_json:
+            data = request.get_json(silent=True) or {}
+        else:
+            # Twilio normalmente envía como form-urlencoded
+            data = request.form.to_dict()
+        
+        if not data:
+            return jsonify({'status': 'error', 'message': 'No data received'}), 400
+        
+        # Detectar si es Green-API (legacy) y rechazarlo explícitamente
+        is_green_api = 'GREEN-API' in user_agent or 'typeWebhook' in data or 'instanceData' in data
+        
+        if is_green_api:
+            print(f"⚠️ Webhook Green-API rechazado - keys: {list(data.keys())}")
+            print(f"⚠️ Este webhook solo acepta mensajes de Twilio. Por favor, desactiva el webhook de Green-API.")
+            return jsonify({
+                'status': 'error',
+                'message': 'Green-API webhooks are no longer supported. This endpoint only accepts Twilio webhooks. Please disable Green-API webhook and configure Twilio instead.'
+            }), 400
+        
+        if not _telefono_remitente_webhook(data):
+            print(f"⚠️ Webhook recibido sin número de remitente - keys: {list(data.keys())}")
+            return jsonify({'status': 'error', 'message': 'No sender number (From field missing). This endpoint only accepts Twilio webhooks.'}), 400
+        
+        _guardar_webhook_entrante(json.dumps(data))
+        
+        # Twilio espera una respuesta en formato TwiML o 200 OK
+        return Response(_TWIML_VACIO, mimetype='text/xml', status=200)
+        
+    except Exception as e:
+        print(f"❌ Error guardando webhook: {e}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+@app.route('/webhook/whatsapp/estado', methods=['POST'])
+def webhook_estado_whatsapp():
+    """
+    StatusCallback de Twilio: estado de entrega de un mensaje saliente (queued,
+    sent, delivered, read, failed...). Como el webhook de mensajes, solo lo guarda
+    en la bandeja de entrada; el consumidor aplica los estados por lotes.
+    """
+    client_ip = _get_client_ip()
+    if not _check_rate_limit(client_ip):
+        print(f"⚠️ Rate limit excedido para IP: {client_ip}")
+        return jsonify({'status': 'error', 'message': 'Rate limit exceeded. Too many requests.'}), 429
+
+    try:
+        data = request.form.to_dict() if not request.is_json else (request.get_json(silent=True) or {})
+        if not data.get('MessageSid') or not data.get('MessageStatus'):
+            return jsonify({'status': 'error', 'message': 'MessageSid and MessageStatus are required'}), 400
+
+        _guardar_webhook_entrante(json.dumps(data), tipo='estado')
+        return Response(_TWIML_VACIO, mimetype='text/xml', status=200)
+    except Exception as e:
+        print(f"❌ Error guardando estado de entrega: {e}")
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+
+# Orden de los estados de Twilio: los callbacks pueden llegar desordenados y un
+# estado solo se sustituye por otro más avanzado. Los fallos son finales
+# Un fallo supera a los estados de tránsito, pero no a una entrega confirmada: si
+# tras 'delivered'/'read' llega un 'failed' tardío, el mensaje sigue contando como
+# entregado y del fallo solo se guarda el código de error en EstadoEntrega
+_RANGO_ESTADO_ENTREGA = {
+    'accepted': 0, 'scheduled': 0, 'queued': 1, 'sending': 2, 'sent': 3,
+    'undelivered': 4, 'failed': 4, 'canceled': 4, 'delivered': 5, 'read': 6,
+}
+_ESTADOS_ENTREGADOS = ('delivered', 'read')
+_ESTADOS_NO_ENTREGADOS = ('undelivered', 'failed', 'canceled')
+
+
+def _leer_estado_entrega(data: dict, recibido_at: datetime) -> dict | None:
+    """Extrae SID, estado y código de error de un StatusCallback (None si no aplica)."""
+    sid = (data.get('MessageSid') or '').strip()
+    estado = (data.get('MessageStatus') or '').strip().lower()
+    if not sid or estado not in _RANGO_ESTADO_ENTREGA:
+        return None
+    try:
+        codigo_error = int(data['ErrorCode']) if data.get('ErrorCode') else None
+    except ValueError:
+        codigo_error = None
+    return {'sid': sid, 'estado': estado, 'codigo_error': codigo_error, 'recibido_at': recibido_at}
+
+
+def _registrar_estados_entrega(estados: list[dict]):
+    """
+    Upsert (sin commit) de un lote de estados en EstadoEntrega, quedándose con el
+    más avanzado de cada SID, y copia los que cambian a MensajeEnviado y
+    WhatsAppMessage por su SID indexado.
+    """
+    if not estados:
+        return
+    ultimos = {}
+    for estado in estados:
+        actual = ultimos.get(estado['sid'])
+        if actual is None or _RANGO_ESTADO_ENTREGA[estado['estado']] >= _RANGO_ESTADO_ENTREGA[actual['estado']]:
+            if actual is not None and not estado['codigo_error']:
+                estado = {**estado, 'codigo_error': actual['codigo_error']}
+            ultimos[estado['sid']] = estado
+        elif estado['codigo_error'] and not actual['codigo_error']:
+            # Fallo posterior a la entrega en el mismo lote: se conserva solo su código
+            ultimos[estado['sid']] = {**actual, 'codigo_error': estado['codigo_error']}
+
+    existentes = {fila.sid: fila for fila in EstadoEntrega.query.filter(EstadoEntrega.sid.in_(list(ultimos)))}
+    cambiados = []
+    with db.session.no_autoflush:
+        for sid, estado in ultimos.items():
+            fila = existentes.get(sid)
+            if fila is None:
+                db.session.add(EstadoEntrega(
+                    sid=sid,
+                    estado=estado['estado'],
+                    codigo_error=estado['codigo_error'],
+                    actualizado_at=estado['recibido_at'],
+                ))
+            elif _RANGO_ESTADO_ENTREGA[estado['estado']] > _RANGO_ESTADO_ENTREGA.get(fila.estado, 0):
+                fila.estado = estado['estado']
+                fila.codigo_error = estado['codigo_error'] or fila.codigo_error
+                fila.actualizado_at = estado['recibido_at']
+            else:
+                if estado['estado'] in _ESTADOS_NO_ENTREGADOS and fila.estado in _ESTADOS_ENTREGADOS:
+                    print(f"⚠️ {sid}: '{estado['estado']}' recibido tras '{fila.estado}' (error {estado['codigo_error']}); se mantiene como entregado")
+                    fila.codigo_error = estado['codigo_error'] or fila.codigo_error
+                continue
+            cambiados.append(sid)
+    _aplicar_estados_entrega(cambiados)
+
+
+def _aplicar_estados_entrega(sids: list[str]):
+    """
+    Copia (sin commit) el estado guardado en EstadoEntrega a los MensajeEnviado y
+    WhatsAppMessage con esos SIDs, con una sentencia por tabla y bloque.
+    """
+    if not sids:
+        return
+    db.session.flush()
+    for inicio in range(0, len(sids), 500):
+        valores = [
+            {'b_sid': sid, 'b_estado': estado, 'b_at': actualizado_at}
+            for sid, estado, actualizado_at in db.session.query(
+                EstadoEntrega.sid, EstadoEntrega.estado, EstadoEntrega.actualizado_at
+            ).filter(EstadoEntrega.sid.in_(sids[inicio:inicio + 500]))
+        ]
+        if not valores:
+            continue
+        for tabla, columna_sid in ((MensajeEnviado.__table__, 'sid'), (WhatsAppMessage.__table__, 'external_id')):
+            db.session.execute(
+                update(tabla)
+                .where(tabla.c[columna_sid] == bindparam('b_sid'))
+                .values(estado_entrega=bindparam('b_estado'), estado_entrega_at=bindparam('b_at')),
+                valores,
+            )
+
+
+def _estadisticas_entrega(campana_ids: list[int]) -> dict[int, dict]:
+    """
+    Agregados de entrega por campaña a partir de los StatusCallback: aceptados por
+    Twilio, entregados, leídos, no entregados y sin confirmar, con sus tasas.
+    """
+    estadisticas = {
+        campana_id: {'aceptados': 0, 'entregados': 0, 'leidos': 0, 'no_entregados': 0, 'sin_confirmar': 0}
+        for campana_id in campana_ids
+    }
+    if not campana_ids:
+        return estadisticas
+    for campana_id, estado, cantidad in db.session.query(
+        MensajeEnviado.campana_id, MensajeEnviado.estado_entrega, func.count(MensajeEnviado.id)
+    ).filter(
+        MensajeEnviado.campana_id.in_(campana_ids),
+        MensajeEnviado.enviado == True,
+    ).group_by(MensajeEnviado.campana_id, MensajeEnviado.estado_entrega):
+        datos = estadisticas[campana_id]
+        datos['aceptados'] += cantidad
+        if estado in _ESTADOS_ENTREGADOS:
+            datos['entregados'] += cantidad
+            if estado == 'read':
+                datos['leidos'] += cantidad
+        elif estado in _ESTADOS_NO_ENTREGADOS:
+            datos['no_entregados'] += cantidad
+        else:
+            datos['sin_confirmar'] += cantidad
+
+    for datos in estadisticas.values():
+        aceptados = datos['aceptados']
+        datos['tasa_entrega'] = round(datos['entregados'] * 100 / aceptados, 1) if aceptados else None
+        datos['tasa_lectura'] = round(datos['leidos'] * 100 / aceptados, 1) if aceptados else None
+    return estadisticas
+
+
+# Group commit del webhook: en vez de una transacción por petición, un hilo escritor
+# por proceso junta los payloads que se acumulan mientras confirma el grupo anterior
+# y los inserta con un solo commit; cada petición espera el resultado de su fila.
+# En plena ráfaga (último grupo de más de uno) espera además hasta WEBHOOK_GRUPO_MS
+# para llenar el grupo; con tráfico suelto no añade latencia
+_WEBHOOK_GRUPO_MS = float(os.environ.get('WEBHOOK_GRUPO_MS', 5))
+_WEBHOOK_GRUPO_MAX = max(1, int(os.environ.get('WEBHOOK_GRUPO_MAX', 200)))
+_WEBHOOK_GRUPO_TIMEOUT_SEG = float(os.environ.get('WEBHOOK_GRUPO_TIMEOUT_SEG', 10))
+_cola_webhooks_entrantes: queue.Queue = queue.Queue()
+_escritor_webhooks_lock = threading.Lock()
+_escritor_webhooks_iniciado = False
+
+
+def _guardar_webhook_entrante(payload: str, tipo: str = 'mensaje'):
+    """
+    Guarda el payload en la bandeja de entrada a través del escritor agrupado.
+    Bloquea hasta que su grupo se ha confirmado; lanza la excepción si su fila falló.
+    """
+    global _escritor_webhooks_iniciado
+    if not _escritor_webhooks_iniciado:
+        with _escritor_webhooks_lock:
+            if not _escritor_webhooks_iniciado:
+                threading.Thread(target=_escritor_webhooks, name='escritor_webhooks', daemon=True).start()
+                _escritor_webhooks_iniciado = True
+
+    resultado = Future()
+    _cola_webhooks_entrantes.put(({'tipo': tipo, 'payload': payload, 'recibido_at': datetime.utcnow()}, resultado))
+    resultado.result(timeout=_WEBHOOK_GRUPO_TIMEOUT_SEG)
+
+
+def _escribir_grupo_webhooks(grupo: list[tuple[dict, Future]]):
+    """
+    Inserta el grupo en una sola transacción. Si falla se reintenta fila a fila
+    para que cada petición reciba su propio resultado.
+    """
+    try:
+        db.session.bulk_insert_mappings(WebhookEntrante, [fila for fila, _ in grupo])
+        db.session.commit()
+        for _, resultado in grupo:
+            resultado.set_result(True)
+        return
+    except Exception as e:
+        db.session.rollback()
+        print(f"⚠️ Grupo de {len(grupo)} webhook(s) no guardado ({e}); se guardan uno a uno")
+
+    for fila, resultado in grupo:
+        try:
+            db.session.bulk_insert_mappings(WebhookEntrante, [fila])
+            db.session.commit()
+            resultado.set_result(True)
+        except Exception as e:
+            db.session.rollback()
+            resultado.set_exception(e)
+
+
+def _escritor_webhooks():
+    """Bucle del escritor agrupado de la bandeja de entrada de webhooks."""
+    en_rafaga = False
+    while True:
+        grupo = [_cola_webhooks_entrantes.get()]
+        limite = _time.monotonic() + (_WEBHOOK_GRUPO_MS / 1000 if en_rafaga else 0)
+        while len(grupo) < _WEBHOOK_GRUPO_MAX:
+            try:
+                restante = limite - _time.monotonic()
+                if restante > 0:
+                    grupo.append(_cola_webhooks_entrantes.get(timeout=restante))
+                else:
+                    grupo.append(_cola_webhooks_entrantes.get_nowait())
+            except queue.Empty:
+                break
+        en_rafaga = len(grupo) > 1
+
+        try:
+            with app.app_context():
+                _escribir_grupo_webhooks(grupo)
+        except Exception as e:
+            # Evitar que el escritor muera por excepciones; las peticiones reciben el error
+            print(f"❌ Error en escritor de webhooks: {e}")
+            for _, resultado in grupo:
+                if not resultado.done():
+                    resultado.set_exception(e)
+        _webhooks_pendientes.set()
+
+
+def _telefono_remitente_webhook(data: dict) -> str:
+    """Número del remitente sin el prefijo whatsapp: ni el +."""
+    from_number = data.get('From', '')
+    if from_number.startswith('whatsapp:'):
+        from_number = from_number.replace('whatsapp:', '')
+    return from_number.replace('+', '')
+
+
+def _leer_webhook_entrante(data: dict, recibido_at: datetime) -> dict | None:
+    """
+    Extrae del payload de Twilio los datos del mensaje entrante (sin tocar la BD).
+    Retorna None si el webhook no trae mensaje.
+
+    Twilio envía mensajes con estos campos:
+    - From: whatsapp:+34612345678
+    - To: whatsapp:+34612345678 (nuestro número)
+    - Body: texto del mensaje
+    - MessageSid: ID único del mensaje
+    - NumMedia: número de archivos adjuntos (0 si no hay)
+    - MediaUrl0, MediaUrl1, etc.: URLs de los medios
+    """
+    telefono_remitente = _telefono_remitente_webhook(data)
+    num_media = int(data.get('NumMedia', 0) or 0)
     
-    try:
-        # Detectar User-Agent para identificar el origen
-        user_agent = request.headers.get('User-Agent', '')
-        
-        # Twilio envía datos como form-urlencoded o JSON
-        if request.is_json:
-            data = request.get_json(silent=True) or {}
-        else:
-            # Twilio normalmente envía como form-urlencoded
-            data = request.form.to_dict()
-        
-        if not data:
-            return jsonify({'status': 'error', 'message': 'No data received'}), 400
-        
-        # Detectar si es Green-API (legacy) y rechazarlo explícitamente
-        is_green_api = 'GREEN-API' in user_agent or 'typeWebhook' in data or 'instanceData' in data
-        
-        if is_green_api:
-            print(f"⚠️ Webhook Green-API rechazado - keys: {list(data.keys())}")
-            print(f"⚠️ Este webhook solo acepta mensajes de Twilio. Por favor, desactiva el webhook de Green-API.")
-            return jsonify({
-                'status': 'error',
-                'message': 'Green-API webhooks are no longer supported. This endpoint only accepts Twilio webhooks. Please disable Green-API webhook and configure Twilio instead.'
-            }), 400
-        
-        # Log del payload completo para debugging
-        print(f"🔍 Webhook Twilio recibido - keys: {list(data.keys())}")
-        
-        # Twilio envía mensajes con estos campos:
-        # - From: whatsapp:+34612345678
-        # - To: whatsapp:+34612345678 (nuestro número)
-        # - Body: texto del mensaje
-        # - MessageSid: ID único del mensaje
-        # - NumMedia: número de archivos adjuntos (0 si no hay)
-        # - MediaUrl0, MediaUrl1, etc.: URLs de los medios
-        
-        from_number = data.get('From', '')
-        to_number = data.get('To', '')
-        message_body = data.get('Body', '')
-        message_sid = data.get('MessageSid', '')
-        num_media = int(data.get('NumMedia', 0) or 0)
-        
-        # Extraer número de teléfono (quitar prefijo whatsapp:)
-        if from_number.startswith('whatsapp:'):
-            telefono_remitente = from_number.replace('whatsapp:', '').replace('+', '')
-        else:
-            telefono_remitente = from_number.replace('+', '')
-        
-        if not telefono_remitente:
-            print(f"⚠️ Webhook recibido sin número de remitente - keys: {list(data.keys())}")
-            return jsonify({'status': 'error', 'message': 'No sender number (From field missing). This endpoint only accepts Twilio webhooks.'}), 400
-        
-        # Determinar tipo de mensaje y media
-        mensaje_texto = message_body or ''
-        tipo_mensaje = 'texto'
-        archivo_url = None
+    # Determinar tipo de mensaje y media
+    mensaje_texto = data.get('Body', '') or ''
+    tipo_mensaje = 'texto'
+    archivo_url = None
+    
+    if num_media > 0:
+        # Hay archivos adjuntos
+        media_url = data.get('MediaUrl0', '')
+        media_content_type = data.get('MediaContentType0', '')
         
-        if num_media > 0:
-            # Hay archivos adjuntos
-            media_url = data.get('MediaUrl0', '')
-            media_content_type = data.get('MediaContentType0', '')
-            
-            if media_url:
-                archivo_url = media_url
-                
-                # Determinar tipo según content-type
-                if 'image' in media_content_type.lower():
-                    tipo_mensaje = 'imagen'
-                    if not mensaje_texto:
-                        mensaje_texto = '[Imagen]'
-                elif 'video' in media_content_type.lower():
-                    tipo_mensaje = 'video'
-                    if not mensaje_texto:
-                        mensaje_texto = '[Video]'
-                elif 'audio' in media_content_type.lower():
-                    tipo_mensaje = 'audio'
-                    if not mensaje_texto:
-                        mensaje_texto = '[Audio]'
-                else:
-                    tipo_mensaje = 'documento'
-                    if not mensaje_texto:
-                        mensaje_texto = '[Archivo]'
-                
-        if mensaje_texto or num_media > 0:
-            print(f"📥 Mensaje entrante de Twilio detectado")
-            
-            # Buscar si el remitente es un cliente existente
-            cliente_existente = Cliente.query.filter_by(telefono=telefono_remitente).first()
+        if media_url:
+            archivo_url = media_url
             
-            # Normalizar chat_id para conversaciones
+            # Determinar tipo según content-type
+            if 'image' in media_content_type.lower():
+                tipo_mensaje = 'imagen'
+                if not mensaje_texto:
+                    mensaje_texto = '[Imagen]'
+            elif 'video' in media_content_type.lower():
+                tipo_mensaje = 'video'
+                if not mensaje_texto:
+                    mensaje_texto = '[Video]'
+            elif 'audio' in media_content_type.lower():
+                tipo_mensaje = 'audio'
+                if not mensaje_texto:
+                    mensaje_texto = '[Audio]'
+            else:
+                tipo_mensaje = 'documento'
+                if not mensaje_texto:
+                    mensaje_texto = '[Archivo]'
+    
+    if not (mensaje_texto or num_media > 0):
+        return None
+    
+    # Normalizar chat_id para conversaciones
+    try:
+        chat_id_full = _normalize_chat_id(telefono_remitente)
+    except ValueError:
+        chat_id_full = telefono_remitente
+
+    return {
+        'telefono': telefono_remitente,
+        'chat_id': chat_id_full,
+        # Twilio puede enviar ProfileName en algunos casos
+        'nombre': data.get('ProfileName', '') or telefono_remitente,
+        'texto': mensaje_texto,
+        'tipo': tipo_mensaje,
+        'archivo_url': archivo_url,
+        # Todos los adjuntos (MediaUrl0..N) para descargarlos al almacén local
+        'medios': [
+            (indice, data[f'MediaUrl{indice}'], data.get(f'MediaContentType{indice}') or None)
+            for indice in range(num_media)
+            if data.get(f'MediaUrl{indice}')
+        ],
+        'sid': data.get('MessageSid', ''),
+        'recibido_at': recibido_at,
+    }
+
+
+# Caché LRU teléfono normalizado -> id de cliente para los remitentes habituales.
+# Solo guarda aciertos; caduca a los CLIENTES_CACHE_TTL_SEG para que los cambios
+# hechos desde otro proceso acaben viéndose, y se vacía al crear, editar o importar
+_CLIENTES_CACHE_MAX = int(os.environ.get('CLIENTES_CACHE_MAX', 2048))
+_CLIENTES_CACHE_TTL_SEG = float(os.environ.get('CLIENTES_CACHE_TTL_SEG', 300))
+_cache_clientes_telefono = OrderedDict()
+_cache_clientes_lock = threading.Lock()
+
+
+def _olvidar_clientes_por_telefono():
+    with _cache_clientes_lock:
+        _cache_clientes_telefono.clear()
+
+
+def _clientes_por_telefono(telefonos) -> dict:
+    """
+    Retorna {teléfono normalizado: id del cliente} para los teléfonos dados (en
+    cualquier formato). Con varios clientes en el mismo teléfono gana el más antiguo.
+    Los que no están en caché se buscan en una sola consulta por el índice de
+    `telefono_normalizado`.
+    """
+    normalizados = {normalizar_telefono(telefono) for telefono in telefonos} - {''}
+    ahora = _time.monotonic()
+    encontrados = {}
+    with _cache_clientes_lock:
+        for telefono in normalizados:
+            entrada = _cache_clientes_telefono.get(telefono)
+            if entrada is None:
+                continue
+            if entrada[1] < ahora:
+                del _cache_clientes_telefono[telefono]
+                continue
+            _cache_clientes_telefono.move_to_end(telefono)
+            encontrados[telefono] = entrada[0]
+
+    faltan = normalizados - encontrados.keys()
+    if not faltan:
+        return encontrados
+
+    nuevos = {}
+    for telefono, cliente_id in (
+        db.session.query(Cliente.telefono_normalizado, Cliente.id)
+        .filter(Cliente.telefono_normalizado.in_(faltan))
+        .order_by(Cliente.id.asc())
+    ):
+        nuevos.setdefault(telefono, cliente_id)
+
+    if _CLIENTES_CACHE_MAX > 0:
+        caduca = ahora + _CLIENTES_CACHE_TTL_SEG
+        with _cache_clientes_lock:
+            for telefono, cliente_id in nuevos.items():
+                _cache_clientes_telefono[telefono] = (cliente_id, caduca)
+                _cache_clientes_telefono.move_to_end(telefono)
+            while len(_cache_clientes_telefono) > _CLIENTES_CACHE_MAX:
+                _cache_clientes_telefono.popitem(last=False)
+
+    encontrados.update(nuevos)
+    return encontrados
+
+
+def _registrar_mensajes_entrantes(mensajes: list[dict]):
+    """
+    Registra un lote de mensajes entrantes (sin commit) en su conversación como
+    WhatsAppMessage, el único almacén de entrantes (/mensajes-recibidos se sirve
+    desde ahí). Primero se hacen todas las lecturas (clientes,
+    conversaciones y SIDs ya registrados en una consulta cada una) y después solo
+    escrituras, para que el bloqueo de escritura de SQLite dure lo mínimo y no
+    frene al webhook. Los SIDs ya registrados (reintentos de Twilio) se ignoran;
+    los índices únicos garantizan que tampoco se dupliquen en una carrera.
+    """
+    if not mensajes:
+        return
+    sids = {mensaje['sid'] for mensaje in mensajes if mensaje['sid']}
+    sids_registrados = {
+        sid for (sid,) in
+        db.session.query(WhatsAppMessage.external_id).filter(WhatsAppMessage.external_id.in_(sids))
+    }
+
+    clientes = _clientes_por_telefono({mensaje['telefono'] for mensaje in mensajes})
+
+    chat_ids = {mensaje['chat_id'] for mensaje in mensajes if mensaje['chat_id']}
+    conversaciones = {}
+    for conversation in (
+        WhatsAppConversation.query
+        .filter(WhatsAppConversation.contact_number.in_(chat_ids))
+        .order_by(WhatsAppConversation.id.asc())
+    ):
+        conversaciones.setdefault(conversation.contact_number, conversation)
+
+    nuevos = []
+    with db.session.no_autoflush:
+        for mensaje in mensajes:
+            # Twilio no envía timestamp en el webhook: se usa la hora de recepción,
+            # que conserva el orden aunque el consumidor procese con retraso
+            sent_at = mensaje['recibido_at'].replace(tzinfo=timezone.utc)
+            sid = mensaje['sid'] or None
+            if not mensaje['chat_id']:
+                print(f"⚠️ Mensaje entrante sin remitente ignorado: {sid}")
+                continue
+            if sid and sid in sids_registrados:
+                print(f"↩️ Reintento de webhook ignorado: {sid}")
+                continue
+            if sid:
+                sids_registrados.add(sid)
+
+            conversation = conversaciones.get(mensaje['chat_id'])
+            if conversation is None:
+                conversation = WhatsAppConversation(
+                    contact_number=mensaje['chat_id'],
+                    contact_name=mensaje['nombre'],
+                    created_at=mensaje['recibido_at'],
+                )
+                db.session.add(conversation)
+                conversaciones[mensaje['chat_id']] = conversation
+            elif mensaje['nombre'].strip() and mensaje['nombre'].strip() != conversation.contact_name:
+                conversation.contact_name = mensaje['nombre'].strip()
+            conversation.updated_at = datetime.now(timezone.utc)
+
+            whatsapp_message = WhatsAppMessage(
+                conversation=conversation,
+                sender_type='customer',
+                message_text=mensaje['texto'],
+                sent_at=sent_at,
+                external_id=sid,
+                is_read=False,
+                media_type=mensaje['tipo'] if mensaje['tipo'] != 'texto' else None,
+                media_url=mensaje['archivo_url'],
+                cliente_id=clientes.get(normalizar_telefono(mensaje['telefono'])),
+            )
+            db.session.add(whatsapp_message)
+            nuevos.append(whatsapp_message)
+            for indice, url, content_type in mensaje.get('medios', []):
+                db.session.add(WhatsAppMedia(
+                    message=whatsapp_message,
+                    indice=indice,
+                    url_origen=url,
+                    content_type=content_type,
+                ))
+
+            tipo_info = f" ({mensaje['tipo']})" if mensaje['tipo'] != 'texto' else ""
+            print(f"✅ Mensaje recibido de {mensaje['telefono']}{tipo_info}: {mensaje['texto'][:50]}")
+
+    if nuevos:
+        db.session.flush()
+        _avanzar_resumen_conversaciones(nuevos)
+
+
+def _migrar_mensajes_recibidos(lote: int = 1000) -> dict:
+    """
+    Pasa las filas antiguas de MensajeRecibido al almacén único (WhatsAppMessage),
+    por lotes y con un commit por lote. Las que ya estaban en la conversación
+    (mismo SID o, sin SID, mismo texto en el mismo chat con menos de un minuto de
+    diferencia) solo aportan cliente, leído y respondido; el resto se insertan.
+    Se puede repetir sin duplicar. Las respuestas (RespuestaMensaje) no se tocan:
+    ya se registraban también como mensajes de agente en la conversación.
+    Retorna {'actualizados': n, 'insertados': n}.
+    """
+    resumen = {'actualizados': 0, 'insertados': 0}
+    ultimo_id = 0
+    while True:
+        filas = (
+            MensajeRecibido.query
+            .filter(MensajeRecibido.id > ultimo_id)
+            .order_by(MensajeRecibido.id.asc())
+            .limit(lote)
+            .all()
+        )
+        if not filas:
+            return resumen
+        ultimo_id = filas[-1].id
+
+        chats = {}
+        for fila in filas:
             try:
-                chat_id_full = _normalize_chat_id(telefono_remitente)
+                chats[fila.id] = _normalize_chat_id(fila.telefono_remitente)
             except ValueError:
-                chat_id_full = telefono_remitente
-            
-            # Obtener nombre del contacto (si está disponible en Twilio)
-            # Twilio puede enviar ProfileName en algunos casos
-            contact_name = data.get('ProfileName', '') or telefono_remitente
-
-            # Crear registro del mensaje recibido
-            mensaje_recibido = MensajeRecibido(
-                telefono_remitente=telefono_remitente,
-                nombre_remitente=contact_name,
-                mensaje=mensaje_texto,
-                tipo_mensaje=tipo_mensaje,
-                archivo_url=archivo_url,
-                cliente_id=cliente_existente.id if cliente_existente else None,
-                id_mensaje_whatsapp=message_sid
+                chats[fila.id] = fila.telefono_remitente
+        conversaciones = {}
+        for conversation in (
+            WhatsAppConversation.query
+            .filter(WhatsAppConversation.contact_number.in_(set(chats.values())))
+            .order_by(WhatsAppConversation.id.asc())
+        ):
+            conversaciones.setdefault(conversation.contact_number, conversation)
+        for fila in filas:
+            chat_id = chats[fila.id]
+            if chat_id not in conversaciones:
+                conversaciones[chat_id] = WhatsAppConversation(
+                    contact_number=chat_id,
+                    contact_name=fila.nombre_remitente,
+                    created_at=fila.fecha_recepcion,
+                    updated_at=fila.fecha_recepcion,
+                )
+                db.session.add(conversaciones[chat_id])
+        db.session.flush()
+
+        por_sid = {
+            message.external_id: message for message in
+            WhatsAppMessage.query.filter(
+                WhatsAppMessage.external_id.in_({fila.id_mensaje_whatsapp for fila in filas if fila.id_mensaje_whatsapp})
             )
-            
-            db.session.add(mensaje_recibido)
+        }
+        sin_sid = defaultdict(list)
+        for message in WhatsAppMessage.query.filter(
+            WhatsAppMessage.conversation_id.in_({conversaciones[chats[fila.id]].id for fila in filas if not fila.id_mensaje_whatsapp}),
+            WhatsAppMessage.sender_type == 'customer',
+            WhatsAppMessage.external_id.is_(None),
+        ):
+            sin_sid[(message.conversation_id, message.message_text)].append(message)
+
+        actualizar, insertar = [], []
+        for fila in filas:
+            conversation = conversaciones[chats[fila.id]]
+            if fila.id_mensaje_whatsapp:
+                existente = por_sid.get(fila.id_mensaje_whatsapp)
+            else:
+                existente = next((
+                    message for message in sin_sid.get((conversation.id, fila.mensaje), [])
+                    if fila.fecha_recepcion and abs((message.sent_at - fila.fecha_recepcion).total_seconds()) < 60
+                ), None)
+            if existente is not None:
+                actualizar.append({
+                    'id': existente.id,
+                    'cliente_id': existente.cliente_id or fila.cliente_id,
+                    'is_read': bool(existente.is_read or fila.leido),
+                    'respondido': bool(existente.respondido or fila.respondido),
+                })
+                continue
+            insertar.append({
+                'conversation_id': conversation.id,
+                'sender_type': 'customer',
+                'message_text': fila.mensaje,
+                'sent_at': fila.fecha_recepcion or datetime.utcnow(),
+                'external_id': fila.id_mensaje_whatsapp,
+                'is_read': bool(fila.leido),
+                'media_type': fila.tipo_mensaje if fila.tipo_mensaje and fila.tipo_mensaje != 'texto' else None,
+                'media_url': fila.archivo_url,
+                'cliente_id': fila.cliente_id,
+                'respondido': bool(fila.respondido),
+            })
 
-            # Registrar en conversaciones avanzadas
-            if chat_id_full:
-                # Twilio no envía timestamp en el webhook, usar hora actual
-                sent_at = datetime.now(timezone.utc)
-                
-                try:
-                    _register_incoming_whatsapp_message(
-                        chat_id_full,
-                        mensaje_texto,
-                        contact_name=contact_name,
-                        sent_at=sent_at,
-                        external_id=message_sid if message_sid else None,
-                        media_type=tipo_mensaje if tipo_mensaje != 'texto' else None,
-                        media_url=archivo_url if archivo_url else None,
-                    )
-                    if tipo_mensaje != 'texto':
-                        print(f"📎 Media registrado - tipo: {tipo_mensaje}, SID: {message_sid or 'N/A'}, media_url: {archivo_url[:50] if archivo_url else 'N/A'}...")
-                    else:
-                        print(f"✅ Mensaje de texto registrado correctamente")
-                except Exception as exc:  # noqa: BLE001
-                    print(f"⚠️ No se pudo registrar la conversación avanzada: {exc}")
-                    import traceback
-                    print(f"⚠️ Traceback: {traceback.format_exc()}")
+        if actualizar:
+            db.session.bulk_update_mappings(WhatsAppMessage, actualizar)
+        if insertar:
+            db.session.bulk_insert_mappings(WhatsAppMessage, insertar)
+        _recalcular_resumen_conversaciones({conversation.id for conversation in conversaciones.values()})
+        db.session.commit()
+        db.session.expunge_all()
+        resumen['actualizados'] += len(actualizar)
+        resumen['insertados'] += len(insertar)
+        print(f"📥 Migrados {resumen['actualizados'] + resumen['insertados']} mensaje(s) recibido(s) hasta el id {ultimo_id}")
+
+
+# Consumidor de la bandeja de entrada: un hilo por proceso web, despertado por el
+# propio webhook; reclama lotes con lease como el worker de outbox
+_WEBHOOK_LOTE = max(1, int(os.environ.get('WEBHOOK_LOTE', 100)))
+_WEBHOOK_ESPERA_SEG = float(os.environ.get('WEBHOOK_ESPERA_SEG', 1.0))
+# Tras un aviso del webhook se espera un poco para agrupar la ráfaga en un solo lote
+_WEBHOOK_AGRUPAR_SEG = float(os.environ.get('WEBHOOK_AGRUPAR_SEG', 0.2))
+_WEBHOOK_LEASE_SEG = int(os.environ.get('WEBHOOK_LEASE_SEG', 60))
+_WEBHOOK_MAX_INTENTOS = max(1, int(os.environ.get('WEBHOOK_MAX_INTENTOS', 3)))
+_webhooks_pendientes = threading.Event()
+_consumidor_webhooks_iniciado = False
+
+
+def _reclamar_lote_webhooks(limite: int) -> list[WebhookEntrante]:
+    """Reclama hasta `limite` webhooks pendientes (o con lease vencido), en orden de llegada."""
+    ahora = datetime.utcnow()
+    token = f"{_OUTBOX_WORKER_ID}:{uuid.uuid4().hex[:8]}"
+    disponible = or_(
+        WebhookEntrante.estado == 'pendiente',
+        and_(WebhookEntrante.estado == 'procesando', WebhookEntrante.bloqueado_hasta < ahora),
+    )
+    candidatos = select(WebhookEntrante.id).where(disponible).order_by(WebhookEntrante.id.asc()).limit(limite)
 
-            db.session.commit()
-            
-            # Log mejorado con información del tipo de mensaje
-            tipo_info = f" ({tipo_mensaje})" if tipo_mensaje != 'texto' else ""
-            archivo_info = f" - URL: {archivo_url[:50]}..." if archivo_url else ""
-            print(f"✅ Mensaje recibido de {telefono_remitente}{tipo_info}: {mensaje_texto[:50]}...{archivo_info}")
-            
-            # Twilio espera una respuesta en formato TwiML o 200 OK
-            # Responder con 200 OK es suficiente
-            return Response('<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                          mimetype='text/xml', status=200)
-        
-        return Response('<?xml version="1.0" encoding="UTF-8"?><Response></Response>', 
-                      mimetype='text/xml', status=200)
-        
+    reclamados = WebhookEntrante.query.filter(WebhookEntrante.id.in_(candidatos), disponible).update({
+        'estado': 'procesando',
+        'bloqueado_por': token,
+        'bloqueado_hasta': ahora + timedelta(seconds=_WEBHOOK_LEASE_SEG),
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if not reclamados:
+        return []
+    return WebhookEntrante.query.filter_by(bloqueado_por=token, estado='procesando').order_by(WebhookEntrante.id.asc()).all()
+
+
+def _registrar_webhooks(filas: list[WebhookEntrante]) -> bool:
+    """
+    Registra (sin commit) los mensajes y estados de entrega de las filas de la
+    bandeja. Retorna True si algún mensaje trae adjuntos que descargar.
+    """
+    mensajes, estados = [], []
+    for fila in filas:
+        data = json.loads(fila.payload)
+        if fila.tipo == 'estado':
+            estado = _leer_estado_entrega(data, fila.recibido_at)
+            if estado:
+                estados.append(estado)
+        else:
+            mensaje = _leer_webhook_entrante(data, fila.recibido_at)
+            if mensaje:
+                mensajes.append(mensaje)
+    _registrar_mensajes_entrantes(mensajes)
+    _registrar_estados_entrega(estados)
+    return any(mensaje['medios'] for mensaje in mensajes)
+
+
+def _procesar_lote_webhooks(limite: int = _WEBHOOK_LOTE) -> int:
+    """
+    Procesa un lote de la bandeja de entrada en una sola transacción. Si algo falla
+    se reintenta fila a fila, para que un payload problemático no bloquee al resto.
+    Retorna el tamaño del lote.
+    """
+    filas = _reclamar_lote_webhooks(limite)
+    if not filas:
+        return 0
+    ids = [fila.id for fila in filas]
+
+    try:
+        hay_medios = _registrar_webhooks(filas)
+        for fila in filas:
+            db.session.delete(fila)
+        db.session.commit()
+        if hay_medios:
+            _medios_pendientes.set()
+        return len(ids)
     except Exception as e:
-        print(f"❌ Error procesando webhook: {e}")
         db.session.rollback()
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        print(f"⚠️ Lote de webhooks con errores ({e}); se procesan uno a uno")
+
+    for webhook_id in ids:
+        # La fila puede haber desaparecido entre el reclamo y el reintento (p. ej. la
+        # procesó otro consumidor tras expirar el bloqueo): no hay nada que hacer
+        fila = db.session.get(WebhookEntrante, webhook_id)
+        if fila is None:
+            continue
+        try:
+            hay_medios = _registrar_webhooks([fila])
+            db.session.delete(fila)
+            db.session.commit()
+            if hay_medios:
+                _medios_pendientes.set()
+        except Exception as e:
+            db.session.rollback()
+            fila = db.session.get(WebhookEntrante, webhook_id)
+            if fila is None:
+                print(f"⚠️ Webhook {webhook_id} ya no está en la bandeja: {e}")
+                continue
+            fila.intentos += 1
+            fila.error = str(e)
+            fila.estado = 'error' if fila.intentos >= _WEBHOOK_MAX_INTENTOS else 'pendiente'
+            fila.bloqueado_por = fila.bloqueado_hasta = None
+            db.session.commit()
+            print(f"❌ Webhook {webhook_id} no procesado (intento {fila.intentos}): {e}")
+    return len(ids)
+
+
+def _consumidor_webhooks():
+    """Bucle del consumidor de la bandeja de entrada de webhooks."""
+    print(f"📥 Consumidor de webhooks iniciado (lotes de {_WEBHOOK_LOTE})")
+    while True:
+        _webhooks_pendientes.clear()
+        procesados = 0
+        try:
+            with app.app_context():
+                procesados = _procesar_lote_webhooks()
+        except Exception as e:
+            # Evitar que el consumidor muera por excepciones
+            print(f"❌ Error en consumidor de webhooks: {e}")
+
+        if procesados < _WEBHOOK_LOTE and _webhooks_pendientes.wait(timeout=_WEBHOOK_ESPERA_SEG):
+            _time.sleep(_WEBHOOK_AGRUPAR_SEG)
+
+
+@app.before_request
+def _asegurar_consumidor_webhooks():
+    global _consumidor_webhooks_iniciado
+    if not _consumidor_webhooks_iniciado:
+        _consumidor_webhooks_iniciado = True
+        hilo = threading.Thread(target=_consumidor_webhooks, name='consumidor_webhooks', daemon=True)
+        hilo.start()
+        hilo = threading.Thread(target=_descargador_medios, name='descargador_medios', daemon=True)
+        hilo.start()
+
+
+# Descargador de adjuntos entrantes: baja cada MediaUrlN en paralelo al almacén
+# local (WHATSAPP_MEDIA_FOLDER), con el nombre de fichero igual al SHA-256 del
+# contenido, para que /whatsapp/media no vuelva a llamar a Twilio
+_MEDIA_DESCARGAS_PARALELAS = max(1, int(os.environ.get('MEDIA_DESCARGAS_PARALELAS', 4)))
+_MEDIA_TIMEOUT_SEG = float(os.environ.get('MEDIA_TIMEOUT_SEG', 30))
+_MEDIA_LEASE_SEG = int(os.environ.get('MEDIA_LEASE_SEG', 300))
+_MEDIA_MAX_INTENTOS = max(1, int(os.environ.get('MEDIA_MAX_INTENTOS', 3)))
+_MEDIA_ESPERA_SEG = float(os.environ.get('MEDIA_ESPERA_SEG', 30))
+# Tamaño máximo de un adjunto entrante; por encima se aborta la descarga (16 MB, como las subidas)
+_MEDIA_MAX_BYTES = int(os.environ.get('MEDIA_MAX_BYTES', 16 * 1024 * 1024))
+_medios_pendientes = threading.Event()
+_pool_medios = ThreadPoolExecutor(max_workers=_MEDIA_DESCARGAS_PARALELAS, thread_name_prefix='medios')
+
+
+def _reclamar_lote_medios(limite: int) -> list[tuple]:
+    """
+    Reclama hasta `limite` adjuntos pendientes (o con lease vencido).
+    Retorna tuplas (id, url, content_type) para descargar sin tocar la BD.
+    """
+    ahora = datetime.utcnow()
+    token = f"{_OUTBOX_WORKER_ID}:{uuid.uuid4().hex[:8]}"
+    # Las pendientes con bloqueado_hasta son reintentos que esperan su turno
+    disponible = or_(
+        and_(WhatsAppMedia.estado == 'pendiente', or_(WhatsAppMedia.bloqueado_hasta.is_(None), WhatsAppMedia.bloqueado_hasta < ahora)),
+        and_(WhatsAppMedia.estado == 'descargando', WhatsAppMedia.bloqueado_hasta < ahora),
+    )
+    candidatos = select(WhatsAppMedia.id).where(disponible).order_by(WhatsAppMedia.id.asc()).limit(limite)
+
+    reclamados = WhatsAppMedia.query.filter(WhatsAppMedia.id.in_(candidatos), disponible).update({
+        'estado': 'descargando',
+        'bloqueado_por': token,
+        'bloqueado_hasta': ahora + timedelta(seconds=_MEDIA_LEASE_SEG),
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if not reclamados:
+        return []
+    return db.session.query(WhatsAppMedia.id, WhatsAppMedia.url_origen, WhatsAppMedia.content_type).filter_by(
+        bloqueado_por=token, estado='descargando'
+    ).order_by(WhatsAppMedia.id.asc()).all()
+
+
+class MedioDemasiadoGrande(ValueError):
+    """El adjunto supera MEDIA_MAX_BYTES; no tiene sentido reintentar la descarga."""
+
+
+def _descargar_medio(url: str, carpeta: str) -> tuple[str, str, int, str | None]:
+    """
+    Descarga `url` al almacén por contenido. Si ya existe un fichero con el mismo
+    hash se reutiliza. Retorna (sha256, ruta relativa, tamaño, content-type).
+    Lanza MedioDemasiadoGrande si el adjunto supera MEDIA_MAX_BYTES.
+    """
+    auth = None
+    if 'twilio.com' in url and twilio_sender.account_sid and twilio_sender.auth_token:
+        auth = (twilio_sender.account_sid, twilio_sender.auth_token)
+
+    resumen = hashlib.sha256()
+    tamano = 0
+    temporal = tempfile.NamedTemporaryFile(dir=carpeta, prefix='.descarga_', delete=False)
+    try:
+        with temporal, requests.get(url, auth=auth, timeout=_MEDIA_TIMEOUT_SEG, stream=True) as respuesta:
+            respuesta.raise_for_status()
+            # Content-Length puede faltar o mentir: se comprueba también lo descargado
+            declarado = respuesta.headers.get('Content-Length')
+            if declarado and declarado.isdigit() and int(declarado) > _MEDIA_MAX_BYTES:
+                raise MedioDemasiadoGrande(f"Adjunto de {int(declarado)} bytes (máximo {_MEDIA_MAX_BYTES})")
+            for bloque in respuesta.iter_content(chunk_size=64 * 1024):
+                tamano += len(bloque)
+                if tamano > _MEDIA_MAX_BYTES:
+                    raise MedioDemasiadoGrande(f"Adjunto de más de {_MEDIA_MAX_BYTES} bytes")
+                resumen.update(bloque)
+                temporal.write(bloque)
+            content_type = respuesta.headers.get('Content-Type')
+
+        sha256 = resumen.hexdigest()
+        ruta = os.path.join(sha256[:2], sha256)
+        destino = os.path.join(carpeta, ruta)
+        if os.path.exists(destino):
+            os.remove(temporal.name)
+        else:
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            os.replace(temporal.name, destino)
+        return sha256, ruta, tamano, content_type
+    except BaseException:
+        if os.path.exists(temporal.name):
+            os.remove(temporal.name)
+        raise
+
+
+def _procesar_lote_medios() -> int:
+    """
+    Reclama un lote de adjuntos, los descarga en paralelo (sin transacción abierta)
+    y guarda los resultados en una sola escritura. Retorna el tamaño del lote.
+    """
+    lote = _reclamar_lote_medios(_MEDIA_DESCARGAS_PARALELAS * 4)
+    if not lote:
+        return 0
+
+    carpeta = app.config['WHATSAPP_MEDIA_FOLDER']
+    futuros = {_pool_medios.submit(_descargar_medio, url, carpeta): medio_id for medio_id, url, _ in lote}
+    resultados = {futuros[futuro]: futuro for futuro in as_completed(futuros)}
+
+    for medio in WhatsAppMedia.query.filter(WhatsAppMedia.id.in_(resultados)).all():
+        medio.bloqueado_por = medio.bloqueado_hasta = None
+        try:
+            medio.sha256, medio.ruta, medio.tamano, content_type = resultados[medio.id].result()
+        except Exception as e:
+            medio.intentos += 1
+            medio.error = str(e)
+            agotado = isinstance(e, MedioDemasiadoGrande) or medio.intentos >= _MEDIA_MAX_INTENTOS
+            medio.estado = 'error' if agotado else 'pendiente'
+            medio.bloqueado_hasta = datetime.utcnow() + timedelta(seconds=_MEDIA_ESPERA_SEG * medio.intentos)
+            print(f"⚠️ No se pudo descargar el adjunto {medio.id} (intento {medio.intentos}): {e}")
+            continue
+        medio.content_type = medio.content_type or content_type
+        medio.estado = 'descargado'
+        medio.error = None
+        medio.descargado_at = datetime.utcnow()
+    db.session.commit()
+    return len(lote)
+
+
+def _descargador_medios():
+    """Bucle del descargador de adjuntos; lo despierta el consumidor de webhooks."""
+    while True:
+        _medios_pendientes.clear()
+        procesados = 0
+        try:
+            with app.app_context():
+                procesados = _procesar_lote_medios()
+        except Exception as e:
+            print(f"❌ Error en descargador de adjuntos: {e}")
+
+        if not procesados:
+            # Sin aviso se revisa de vez en cuando por si quedan reintentos o leases vencidos
+            _medios_pendientes.wait(timeout=_MEDIA_ESPERA_SEG)
+
+def _consulta_mensajes_recibidos():
+    """
+    Capa de compatibilidad de /mensajes-recibidos: los mensajes entrantes
+    (WhatsAppMessage de tipo customer) con su conversación y cliente cargados.
+    WhatsAppMessage expone los nombres de campo de MensajeRecibido, así que las
+    plantillas antiguas no cambian.
+    """
+    return (
+        WhatsAppMessage.query
+        .filter(WhatsAppMessage.sender_type == 'customer')
+        .options(joinedload(WhatsAppMessage.conversation), joinedload(WhatsAppMessage.cliente))
+    )
+
+
+def _mensaje_recibido_or_404(mensaje_id: int) -> WhatsAppMessage:
+    mensaje = _consulta_mensajes_recibidos().filter(WhatsAppMessage.id == mensaje_id).first()
+    if mensaje is None:
+        abort(404)
+    return mensaje
+
 
 @app.route('/mensajes-recibidos')
 @login_required
 def mensajes_recibidos():
     """Página para ver mensajes recibidos"""
     # Obtener mensajes no leídos primero, luego los leídos
-    mensajes_no_leidos = MensajeRecibido.query.filter_by(leido=False).order_by(MensajeRecibido.fecha_recepcion.desc()).all()
-    mensajes_leidos = MensajeRecibido.query.filter_by(leido=True).order_by(MensajeRecibido.fecha_recepcion.desc()).limit(50).all()
+    orden = (WhatsAppMessage.sent_at.desc(), WhatsAppMessage.id.desc())
+    mensajes_no_leidos = _consulta_mensajes_recibidos().filter(WhatsAppMessage.is_read.is_(False)).order_by(*orden).all()
+    mensajes_leidos = _consulta_mensajes_recibidos().filter(WhatsAppMessage.is_read.is_(True)).order_by(*orden).limit(50).all()
     
     return render_template('mensajes_recibidos.html', 
                          mensajes_no_leidos=mensajes_no_leidos,
-                         mensajes_leidos=mensajes_leidos)
+                         mensajes_leidos=mensajes_leidos,
+                         envio_id=uuid.uuid4().hex)
 
 @app.route('/mensajes-recibidos/<int:mensaje_id>/marcar-leido', methods=['POST'])
 @login_required
 def marcar_mensaje_leido(mensaje_id):
     """Marcar un mensaje como leído"""
-    mensaje = MensajeRecibido.query.get_or_404(mensaje_id)
-    mensaje.leido = True
+    mensaje = _mensaje_recibido_or_404(mensaje_id)
+    _marcar_leidos(mensaje.conversation_id, [mensaje.id])
     db.session.commit()
     
     return jsonify({'status': 'success'})
@@ -2464,46 +4772,36 @@ def marcar_mensaje_leido(mensaje_id):
 @login_required
 def responder_mensaje(mensaje_id):
     """Responder a un mensaje recibido"""
-    mensaje = MensajeRecibido.query.get_or_404(mensaje_id)
+    mensaje = _mensaje_recibido_or_404(mensaje_id)
     respuesta_texto = request.form.get('respuesta')
     
     if not respuesta_texto:
         flash('Debe escribir una respuesta', 'error')
         return redirect(url_for('mensajes_recibidos'))
     
+    # Clave estable para que un doble envío del formulario se encole una sola vez:
+    # el identificador que trae el formulario (uno por página) o, si falta, el texto
+    envio_id = request.form.get('envio_id', '')
+    if not (envio_id.isalnum() and len(envio_id) <= 32):
+        envio_id = hashlib.sha256(respuesta_texto.encode('utf-8')).hexdigest()[:32]
+
     try:
-        # Enviar respuesta usando Twilio
-        success, error_msg = twilio_sender.send_message(mensaje.telefono_remitente, respuesta_texto)
-        
-        # Crear registro de la respuesta
-        respuesta = RespuestaMensaje(
-            mensaje_recibido_id=mensaje.id,
-            respuesta=respuesta_texto,
-            enviado=success,
-            fecha_envio=datetime.now(timezone.utc) if success else None,
-            error=error_msg if not success else None
-        )
-        
-        db.session.add(respuesta)
-        
-        # Marcar mensaje original como respondido si se envió correctamente
-        if success:
-            mensaje.respondido = True
-            try:
-                _register_outgoing_whatsapp_message(
-                    mensaje.telefono_remitente,
-                    respuesta_texto,
-                    sent_at=datetime.utcnow(),
-                )
-            except Exception as exc:  # noqa: BLE001
-                print(f"⚠️ No se pudo registrar la respuesta en conversaciones avanzadas: {exc}")
-        
+        # El worker de outbox la envía, marca el mensaje como respondido y añade
+        # la respuesta a la conversación
+        encolados = _encolar_mensajes([{
+            'clave_idempotencia': f"respuesta:{mensaje.id}:{envio_id}",
+            'origen': 'respuesta',
+            'telefono': mensaje.conversation.contact_number,
+            'mensaje': respuesta_texto,
+            'cliente_id': mensaje.cliente_id,
+            'whatsapp_message_id': mensaje.id,
+            'usuario_id': current_user.id if current_user.is_authenticated else None,
+        }])
         db.session.commit()
-        
-        if success:
-            flash('Respuesta enviada exitosamente', 'success')
+        if encolados:
+            flash('Respuesta encolada para envío', 'success')
         else:
-            flash(f'Error enviando respuesta: {error_msg}', 'error')
+            flash('Esta respuesta ya estaba encolada', 'info')
             
     except Exception as e:
         db.session.rollback()
@@ -2515,44 +4813,25 @@ def responder_mensaje(mensaje_id):
 @login_required
 def ver_conversacion(mensaje_id):
     """Ver la conversación completa con un cliente"""
-    mensaje = MensajeRecibido.query.get_or_404(mensaje_id)
-    
-    # Obtener todos los mensajes recibidos de este número
-    mensajes_recibidos = MensajeRecibido.query.filter_by(telefono_remitente=mensaje.telefono_remitente).order_by(MensajeRecibido.fecha_recepcion.asc()).all()
-    
-    # Obtener todas las respuestas enviadas a este número
-    respuestas_enviadas = []
-    for msg in mensajes_recibidos:
-        respuestas = RespuestaMensaje.query.filter_by(mensaje_recibido_id=msg.id).all()
-        respuestas_enviadas.extend(respuestas)
-    
-    # Combinar y ordenar cronológicamente
-    conversacion = []
-    
-    # Agregar mensajes recibidos
-    for msg in mensajes_recibidos:
-        conversacion.append({
-            'tipo': 'recibido',
-            'fecha': msg.fecha_recepcion,
-            'mensaje': msg.mensaje,
-            'tipo_mensaje': msg.tipo_mensaje,
-            'archivo_url': msg.archivo_url
-        })
-    
-    # Agregar respuestas enviadas
-    for resp in respuestas_enviadas:
-        conversacion.append({
-            'tipo': 'enviado',
-            'fecha': resp.fecha_envio,
-            'mensaje': resp.respuesta,
-            'tipo_mensaje': 'texto'
-        })
+    mensaje = _mensaje_recibido_or_404(mensaje_id)
     
-    # Ordenar por fecha
-    conversacion.sort(key=lambda x: x['fecha'])
+    # Mensajes recibidos y respuestas están en la misma conversación, ya en orden
+    conversacion = [
+        {
+            'id': msg.id,
+            'tipo': 'recibido' if msg.sender_type == 'customer' else 'enviado',
+            'fecha': msg.sent_at,
+            'mensaje': msg.message_text,
+            'tipo_mensaje': msg.tipo_mensaje,
+            'archivo_url': msg.media_url,
+        }
+        for msg in mensaje.conversation.messages.order_by(WhatsAppMessage.sent_at.asc(), WhatsAppMessage.id.asc())
+    ]
     
     return render_template('conversacion.html', 
                          conversacion=conversacion,
+                         mensaje_id=mensaje.id,
+                         envio_id=uuid.uuid4().hex,
                          telefono=mensaje.telefono_remitente,
                          nombre=mensaje.nombre_remitente)
 
@@ -2560,92 +4839,9 @@ def ver_conversacion(mensaje_id):
 @app.route('/whatsapp')
 @login_required
 def whatsapp_dashboard():
-    # Optimización: Pre-cargar todos los datos necesarios en una sola pasada para evitar N+1 queries
-    # Ordenar por el último mensaje (sent_at) en lugar de updated_at
-    last_message_subquery = db.session.query(
-        WhatsAppMessage.conversation_id,
-        func.max(WhatsAppMessage.sent_at).label('last_sent_at')
-    ).group_by(WhatsAppMessage.conversation_id).subquery()
-    
-    conversaciones = db.session.query(WhatsAppConversation)\
-        .outerjoin(
-            last_message_subquery,
-            WhatsAppConversation.id == last_message_subquery.c.conversation_id
-        )\
-        .order_by(
-            func.coalesce(last_message_subquery.c.last_sent_at, WhatsAppConversation.updated_at).desc(),
-            WhatsAppConversation.id.desc()
-        )\
-        .all()
-    
-    # Pre-cargar datos para evitar N+1 queries en el template
-    conversation_ids = [c.id for c in conversaciones]
-    last_messages_dict = {}
-    unread_counts_dict = {}
-    last_agent_messages_dict = {}
-    
-    if conversation_ids:
-        # Últimos mensajes
-        last_msg_subquery = db.session.query(
-            WhatsAppMessage.conversation_id,
-            func.max(WhatsAppMessage.sent_at).label('max_sent_at'),
-            func.max(WhatsAppMessage.id).label('max_id')
-        ).filter(
-            WhatsAppMessage.conversation_id.in_(conversation_ids)
-        ).group_by(WhatsAppMessage.conversation_id).subquery()
-        
-        last_msgs = db.session.query(WhatsAppMessage)\
-            .join(
-                last_msg_subquery,
-                and_(
-                    WhatsAppMessage.conversation_id == last_msg_subquery.c.conversation_id,
-                    WhatsAppMessage.sent_at == last_msg_subquery.c.max_sent_at,
-                    WhatsAppMessage.id == last_msg_subquery.c.max_id
-                )
-            )\
-            .all()
-        last_messages_dict = {msg.conversation_id: msg for msg in last_msgs}
-        
-        # Unread counts
-        unread_results = db.session.query(
-            WhatsAppMessage.conversation_id,
-            func.count(WhatsAppMessage.id).label('unread')
-        ).filter(
-            WhatsAppMessage.conversation_id.in_(conversation_ids),
-            WhatsAppMessage.sender_type == 'customer',
-            WhatsAppMessage.is_read == False
-        ).group_by(WhatsAppMessage.conversation_id).all()
-        unread_counts_dict = {conv_id: count for conv_id, count in unread_results}
-        
-        # Últimos mensajes de agentes
-        last_agent_subquery = db.session.query(
-            WhatsAppMessage.conversation_id,
-            func.max(WhatsAppMessage.sent_at).label('max_sent_at'),
-            func.max(WhatsAppMessage.id).label('max_id')
-        ).filter(
-            WhatsAppMessage.conversation_id.in_(conversation_ids),
-            WhatsAppMessage.sender_type == 'agent'
-        ).group_by(WhatsAppMessage.conversation_id).subquery()
-        
-        last_agents = db.session.query(WhatsAppMessage)\
-            .options(joinedload(WhatsAppMessage.usuario))\
-            .join(
-                last_agent_subquery,
-                and_(
-                    WhatsAppMessage.conversation_id == last_agent_subquery.c.conversation_id,
-                    WhatsAppMessage.sent_at == last_agent_subquery.c.max_sent_at,
-                    WhatsAppMessage.id == last_agent_subquery.c.max_id
-                )
-            )\
-            .all()
-        last_agent_messages_dict = {msg.conversation_id: msg for msg in last_agents}
-    
-    # Añadir datos pre-cargados a cada conversación como atributos temporales
-    for conv in conversaciones:
-        conv._last_message = last_messages_dict.get(conv.id)
-        conv._unread_count = unread_counts_dict.get(conv.id, 0)
-        conv._last_agent_message = last_agent_messages_dict.get(conv.id)
-    
+    # Un solo recorrido por el índice de last_message_at: el resumen (último
+    # mensaje, no leídos y último agente) está desnormalizado en la conversación
+    conversaciones = _consulta_listado_conversaciones().all()
     return render_template('whatsapp/index.html', conversaciones=conversaciones)
 
 
@@ -2688,21 +4884,20 @@ def whatsapp_new_conversation():
 
         if initial_message:
             try:
-                external_id = _send_twilio_message(chat_id, initial_message)
+                message = _append_whatsapp_message(
+                    conversation,
+                    sender_type='agent',
+                    message_text=initial_message,
+                    sent_at=datetime.utcnow(),
+                    is_read=True,
+                    usuario_id=current_user.id if current_user.is_authenticated else None,
+                )
+                _encolar_mensaje_conversacion(message, chat_id, initial_message)
             except Exception as exc:  # noqa: BLE001
                 db.session.rollback()
                 flash(f'No fue posible enviar el mensaje inicial: {exc}', 'error')
                 return render_template('whatsapp/new_conversation.html', clientes=clientes)
 
-            _append_whatsapp_message(
-                conversation,
-                sender_type='agent',
-                message_text=initial_message,
-                sent_at=datetime.utcnow(),
-                external_id=external_id,
-                is_read=True,
-            )
-
         db.session.commit()
         flash('Conversación creada correctamente.', 'success')
         return redirect(url_for('whatsapp_conversation_detail', conversation_id=conversation.id))
@@ -2725,7 +4920,6 @@ def whatsapp_conversation_detail(conversation_id):
             return redirect(url_for('whatsapp_conversation_detail', conversation_id=conversation.id))
 
         try:
-            external_id = None
             media_url = None
             media_type = None
 
@@ -2769,46 +4963,20 @@ def whatsapp_conversation_detail(conversation_id):
                         pass
                     return redirect(url_for('whatsapp_conversation_detail', conversation_id=conversation.id))
 
-                print(f"📤 Enviando imagen a Twilio:")
-                print(f"   URL: {media_url}")
-                print(f"   Número destino: {conversation.contact_number}")
-                print(f"   Caption: {message_text if message_text else '(sin texto)'}")
-
-                # Enviar imagen usando Twilio
-                success, result = twilio_sender.send_image(
-                    conversation.contact_number,
-                    media_url,
-                    caption=message_text if message_text else ""
-                )
-
-                if not success:
-                    print(f"❌ Error enviando imagen: {result}")
-                    # Eliminar archivo si falla el envío
-                    try:
-                        os.remove(filepath)
-                    except:
-                        pass
-                    flash(f'Error enviando imagen: {result}', 'error')
-                    return redirect(url_for('whatsapp_conversation_detail', conversation_id=conversation.id))
-
-                print(f"✅ Imagen enviada correctamente. SID: {result}")
-
-                external_id = result  # El SID del mensaje de Twilio
-            else:
-                # Enviar solo texto
-                external_id = _send_twilio_message(conversation.contact_number, message_text)
+                print(f"📤 Imagen encolada para Twilio: {media_url} -> {conversation.contact_number}")
 
-            _append_whatsapp_message(
+            # El mensaje se muestra al instante; el worker de outbox lo envía y guarda el SID
+            message = _append_whatsapp_message(
                 conversation,
                 sender_type='agent',
                 message_text=message_text if message_text else '[Imagen]',
                 sent_at=datetime.utcnow(),
-                external_id=external_id,
                 is_read=True,
                 media_type=media_type,
                 media_url=media_url,
                 usuario_id=current_user.id if current_user.is_authenticated else None,
             )
+            _encolar_mensaje_conversacion(message, conversation.contact_number, message_text, media_url=media_url)
             db.session.commit()
             flash('Mensaje enviado correctamente', 'success')
             return redirect(url_for('whatsapp_conversation_detail', conversation_id=conversation.id))
@@ -2817,12 +4985,9 @@ def whatsapp_conversation_detail(conversation_id):
             flash(f'Error enviando mensaje: {exc}', 'error')
             return redirect(url_for('whatsapp_conversation_detail', conversation_id=conversation.id))
 
-    unread_messages = conversation.messages.filter_by(sender_type='customer', is_read=False).all()
-    if unread_messages:
-        for msg in unread_messages:
-            msg.is_read = True
-        db.session.commit()
-        conversation = WhatsAppConversation.query.get_or_404(conversation_id)
+    # Sin fiarse del contador: _marcar_leidos comprueba los mensajes y lo deja en 0
+    _marcar_leidos(conversation.id)
+    db.session.commit()
 
     # Optimización: Pre-cargar usuarios para evitar N+1 queries
     messages = db.session.query(WhatsAppMessage)\
@@ -2835,129 +5000,18 @@ def whatsapp_conversation_detail(conversation_id):
 
 @app.get('/whatsapp/api/conversaciones')
 def whatsapp_api_conversations():
-    # Optimización: Usar subconsulta para obtener el último mensaje de cada conversación
-    # y ordenar por el sent_at del último mensaje (no por updated_at)
-    
     # Filtrar por tipo si se especifica en los parámetros
     tipo_filter = request.args.get('tipo', default=None, type=str)
     
-    # Subconsulta para obtener el último sent_at de cada conversación
-    last_message_subquery = db.session.query(
-        WhatsAppMessage.conversation_id,
-        func.max(WhatsAppMessage.sent_at).label('last_sent_at')
-    ).group_by(WhatsAppMessage.conversation_id).subquery()
-    
-    # Obtener conversaciones ordenadas por el último mensaje (sent_at)
-    query = db.session.query(WhatsAppConversation)\
-        .outerjoin(
-            last_message_subquery,
-            WhatsAppConversation.id == last_message_subquery.c.conversation_id
-        )
-    
-    # Aplicar filtro por tipo si se especifica
+    query = _consulta_listado_conversaciones()
     if tipo_filter:
         query = query.filter(WhatsAppConversation.tipo == tipo_filter)
+    conversations = query.all()
     
-    conversations = query.order_by(
-        func.coalesce(last_message_subquery.c.last_sent_at, WhatsAppConversation.updated_at).desc(),
-        WhatsAppConversation.id.desc()
-    ).all()
-    
-    # Pre-cargar unread counts con una sola query para todas las conversaciones
-    conversation_ids = [c.id for c in conversations]
-    unread_counts = {}
-    if conversation_ids:
-        unread_results = db.session.query(
-            WhatsAppMessage.conversation_id,
-            func.count(WhatsAppMessage.id).label('unread')
-        ).filter(
-            WhatsAppMessage.conversation_id.in_(conversation_ids),
-            WhatsAppMessage.sender_type == 'customer',
-            WhatsAppMessage.is_read == False
-        ).group_by(WhatsAppMessage.conversation_id).all()
-        
-        unread_counts = {conv_id: count for conv_id, count in unread_results}
-    
-    # Pre-cargar últimos mensajes con una sola query
-    last_messages = {}
-    if conversation_ids:
-        # Obtener el último mensaje de cada conversación
-        last_msg_subquery = db.session.query(
-            WhatsAppMessage.conversation_id,
-            func.max(WhatsAppMessage.sent_at).label('max_sent_at'),
-            func.max(WhatsAppMessage.id).label('max_id')
-        ).filter(
-            WhatsAppMessage.conversation_id.in_(conversation_ids)
-        ).group_by(WhatsAppMessage.conversation_id).subquery()
-        
-        last_msgs = db.session.query(WhatsAppMessage)\
-            .join(
-                last_msg_subquery,
-                and_(
-                    WhatsAppMessage.conversation_id == last_msg_subquery.c.conversation_id,
-                    WhatsAppMessage.sent_at == last_msg_subquery.c.max_sent_at,
-                    WhatsAppMessage.id == last_msg_subquery.c.max_id
-                )
-            )\
-            .all()
-        
-        last_messages = {msg.conversation_id: msg for msg in last_msgs}
-    
-    # Pre-cargar últimos mensajes de agentes
-    last_agent_messages = {}
-    if conversation_ids:
-        last_agent_subquery = db.session.query(
-            WhatsAppMessage.conversation_id,
-            func.max(WhatsAppMessage.sent_at).label('max_sent_at'),
-            func.max(WhatsAppMessage.id).label('max_id')
-        ).filter(
-            WhatsAppMessage.conversation_id.in_(conversation_ids),
-            WhatsAppMessage.sender_type == 'agent'
-        ).group_by(WhatsAppMessage.conversation_id).subquery()
-        
-        last_agents = db.session.query(WhatsAppMessage)\
-            .options(joinedload(WhatsAppMessage.usuario))\
-            .join(
-                last_agent_subquery,
-                and_(
-                    WhatsAppMessage.conversation_id == last_agent_subquery.c.conversation_id,
-                    WhatsAppMessage.sent_at == last_agent_subquery.c.max_sent_at,
-                    WhatsAppMessage.id == last_agent_subquery.c.max_id
-                )
-            )\
-            .all()
-        
-        last_agent_messages = {msg.conversation_id: msg for msg in last_agents}
-    
-    # Construir respuesta optimizada sin N+1 queries
-    data = []
-    for conv in conversations:
-        last_msg = last_messages.get(conv.id)
-        last_agent = last_agent_messages.get(conv.id)
-        
-        last_usuario = None
-        if last_agent and last_agent.usuario:
-            last_usuario = {
-                "id": last_agent.usuario.id,
-                "username": last_agent.usuario.username,
-                "color": last_agent.usuario.color or "#007bff",
-            }
-        
-        data.append({
-            "id": conv.id,
-            "display_name": conv.contact_name or _chat_display(conv.contact_number),
-            "contact_number": conv.contact_number,
-            "last_message_text": last_msg.message_text if last_msg else "",
-            "last_message_sender": last_msg.sender_type if last_msg else None,
-            "last_media_type": last_msg.media_type if last_msg else None,
-            "last_usuario": last_usuario,
-            "updated_at": conv.updated_at.isoformat() if conv.updated_at else None,
-            "updated_at_human": _to_local_time(conv.updated_at).strftime("%d/%m/%Y %H:%M") if conv.updated_at else "",
-            "unread_count": unread_counts.get(conv.id, 0),
-            "url": url_for("whatsapp_conversation_detail", conversation_id=conv.id),
-            "anotaciones": conv.anotaciones or "",
-            "tipo": conv.tipo or None,
-        })
+    data = [
+        {**_conversation_to_dict(conv), "anotaciones": conv.anotaciones or "", "tipo": conv.tipo or None}
+        for conv in conversations
+    ]
     
     return jsonify({'conversations': data})
 
@@ -3037,9 +5091,9 @@ def whatsapp_api_conversation_messages(conversation_id):
     ).order_by(WhatsAppMessage.id.asc()).options(joinedload(WhatsAppMessage.usuario))
 
     messages = query.all()
-    changed = False
     last_id = after_id
     serialized = []
+    por_leer = []
 
     for message in messages:
         msg_dict = _message_to_dict(message)
@@ -3047,16 +5101,15 @@ def whatsapp_api_conversation_messages(conversation_id):
         serialized.append(msg_dict)
         last_id = max(last_id, message.id)
         if mark_read and message.sender_type == 'customer' and not message.is_read:
-            message.is_read = True
-            changed = True
+            por_leer.append(message.id)
 
-    if changed:
+    if por_leer and _marcar_leidos(conversation.id, por_leer):
         db.session.commit()
 
     return jsonify({
         'messages': serialized,
         'last_id': last_id,
-        'unread_count': conversation.unread_count(),
+        'unread_count': conversation.unread_count,
         'updated_at': conversation.updated_at.isoformat() if conversation.updated_at else None,
         'updated_at_human': conversation.updated_at.strftime("%d/%m/%Y %H:%M") if conversation.updated_at else '',
     })
@@ -3133,6 +5186,24 @@ def whatsapp_debug_mensajes():
 def whatsapp_media(message_id: int):
     message = WhatsAppMessage.query.get_or_404(message_id)
 
+    # Adjuntos descargados al recibir el webhook: se sirven del almacén local
+    if message.medios:
+        indice = request.args.get('n', 0, type=int)
+        medio = next((medio for medio in message.medios if medio.indice == indice), None)
+        if medio is None or medio.estado == 'error':
+            abort(404)
+        if medio.estado != 'descargado':
+            # Aún en cola: el navegador puede reintentar en un momento
+            return Response('Adjunto en descarga', status=503, headers={'Retry-After': '2'})
+        return send_from_directory(
+            app.config['WHATSAPP_MEDIA_FOLDER'],
+            medio.ruta,
+            mimetype=medio.content_type or 'application/octet-stream',
+            max_age=86400,
+        )
+
+    # Mensajes anteriores al almacén local: se piden a Twilio
+
     # Permitir obtener medios si hay media_type, incluso sin URL guardada
     if not message.media_type and not message.media_url and not message.external_id:
         abort(404)
@@ -3369,6 +5440,34 @@ def pedidos_uploaded_file(filename):
 
 
 if __name__ == '__main__':
+    # `python -m app worker` arranca solo el worker de la cola de salida
+    if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+        _ejecutor_outbox()
+        sys.exit(0)
+
+    # `python -m app redrive [--transitorios]` reencola la cola de mensajes muertos
+    if len(sys.argv) > 1 and sys.argv[1] == 'redrive':
+        with app.app_context():
+            reencolados = _reencolar_fallidos(solo_transitorios='--transitorios' in sys.argv[2:])
+            db.session.commit()
+        print(f"🔁 {reencolados} mensaje(s) reencolado(s)")
+        sys.exit(0)
+
+    # `python -m app resumen-conversaciones` reconstruye el resumen de todas las conversaciones
+    if len(sys.argv) > 1 and sys.argv[1] == 'resumen-conversaciones':
+        with app.app_context():
+            actualizadas = _recalcular_resumen_conversaciones()
+            db.session.commit()
+        print(f"✅ Resumen recalculado en {actualizadas} conversación(es)")
+        sys.exit(0)
+
+    # `python -m app migrar-recibidos` pasa los MensajeRecibido antiguos a WhatsAppMessage
+    if len(sys.argv) > 1 and sys.argv[1] == 'migrar-recibidos':
+        with app.app_context():
+            resumen = _migrar_mensajes_recibidos()
+        print(f"✅ Mensajes recibidos migrados: {resumen['insertados']} nuevo(s), {resumen['actualizados']} ya existente(s)")
+        sys.exit(0)
+
     with app.app_context():
         # Inicializar sistema automáticamente
         inicializar_sistema()
@@ -3392,6 +5491,9 @@ if __name__ == '__main__':
         except ImportError:
             print("⚠️ Archivo de configuración no encontrado - usando modo simulación")
     
+    # En desarrollo local el worker de outbox corre dentro del mismo proceso
+    _iniciar_outbox_embebido()
+
     # Usar puerto correcto según el entorno
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=app.config['DEBUG'])
@@ -0,0 +1,161 @@
+"""
+Benchmark del pipeline de envío (encolado + worker de outbox) en modo simulación.
+
+Crea una zona temporal con N clientes, lanza un envío masivo (o una ejecución
+programada) y procesa la cola midiendo el rendimiento. El comportamiento de
+"Twilio" se configura con las variables SIMULACION_* (ver simulacion.py), p. ej.:
+
+    SIMULACION_LATENCIA=lognormal:150:600 SIMULACION_ERRORES=429:0.02,21211:0.01,timeout:0.002 \\
+    SIMULACION_MAX_POR_SEG=80 TWILIO_RATE_PER_SEC=70 OUTBOX_LOTE=200 \\
+    python benchmark_envios.py --clientes 2000
+
+Al terminar borra los datos creados (salvo con --conservar).
+"""
+
+import argparse
+import sys
+import time
+from collections import Counter
+from datetime import date
+
+import app as aplicacion
+from app import app, db
+from models import (
+    Cliente,
+    CampanaEnvio,
+    MensajeEnviado,
+    MensajePlantilla,
+    OutboxFallido,
+    OutboxMensaje,
+    ProgramacionMasiva,
+    Usuario,
+    WhatsAppConversation,
+    WhatsAppMessage,
+    Zona,
+)
+from twilio_sender import twilio_sender
+
+
+def _crear_datos(num_clientes: int):
+    zona = Zona(nombre=f"Benchmark {int(time.time())}", descripcion="Zona temporal de benchmark")
+    db.session.add(zona)
+    db.session.flush()
+    db.session.bulk_insert_mappings(Cliente, [
+        {"nombre": f"Cliente benchmark {i}", "telefono": f"699{i:06d}", "telefono_normalizado": f"34699{i:06d}",
+         "zona_id": zona.id, "activo": True}
+        for i in range(num_clientes)
+    ])
+    db.session.commit()
+    return zona
+
+
+def _lanzar_campana(zona, plantilla) -> int:
+    """Lanza el envío masivo a través de la ruta real `enviar_masivo`."""
+    usuario = Usuario.query.first()
+    cliente_http = app.test_client()
+    with cliente_http.session_transaction() as sesion:
+        sesion["_user_id"] = str(usuario.id)
+        sesion["_fresh"] = True
+    ids = [cliente_id for (cliente_id,) in db.session.query(Cliente.id).filter_by(zona_id=zona.id)]
+    respuesta = cliente_http.post("/enviar_masivo", data={
+        "zona_id": zona.id,
+        "plantilla_id": plantilla.id,
+        "destinatarios_seleccionados": ",".join(map(str, ids)),
+    })
+    if respuesta.status_code != 302 or "/campanas/" not in (respuesta.location or ""):
+        raise RuntimeError(f"enviar_masivo no creó la campaña (HTTP {respuesta.status_code})")
+    return int(respuesta.location.rstrip("/").split("/")[-1])
+
+
+def _lanzar_programacion(zona, plantilla) -> int:
+    """Ejecuta una programación temporal con el mismo código que usa el scheduler."""
+    prog = ProgramacionMasiva(zona_id=zona.id, plantilla_id=plantilla.id, dias_semana="", hora="00:00", activo=False)
+    db.session.add(prog)
+    db.session.commit()
+    ejecucion = aplicacion._iniciar_ejecucion_programacion(prog, date.today())
+    aplicacion._completar_ejecucion_programacion(prog, ejecucion)
+    return ejecucion.id
+
+
+def _procesar_cola(campana_id: int, limite_seg: float):
+    inicio = time.time()
+    while time.time() - inicio < limite_seg:
+        procesados = aplicacion._procesar_lote_outbox()
+        campana = db.session.get(CampanaEnvio, campana_id)
+        db.session.refresh(campana)
+        if campana.finalizada:
+            return campana, time.time() - inicio
+        if not procesados:
+            time.sleep(0.2)
+    return db.session.get(CampanaEnvio, campana_id), time.time() - inicio
+
+
+def _limpiar(zona, campana_id: int):
+    telefonos = [telefono for (telefono,) in db.session.query(Cliente.telefono).filter_by(zona_id=zona.id)]
+    chats = [aplicacion._normalize_chat_id(telefono) for telefono in telefonos]
+    conversaciones = [conv_id for (conv_id,) in db.session.query(WhatsAppConversation.id)
+                      .filter(WhatsAppConversation.contact_number.in_(chats))]
+    outbox_ids = db.session.query(OutboxMensaje.id).filter_by(campana_id=campana_id)
+    OutboxFallido.query.filter(OutboxFallido.outbox_id.in_(outbox_ids)).delete(synchronize_session=False)
+    OutboxMensaje.query.filter_by(campana_id=campana_id).delete(synchronize_session=False)
+    MensajeEnviado.query.filter_by(campana_id=campana_id).delete(synchronize_session=False)
+    WhatsAppMessage.query.filter(WhatsAppMessage.conversation_id.in_(conversaciones)).delete(synchronize_session=False)
+    WhatsAppConversation.query.filter(WhatsAppConversation.id.in_(conversaciones)).delete(synchronize_session=False)
+    programacion_id = db.session.get(CampanaEnvio, campana_id).programacion_id
+    CampanaEnvio.query.filter_by(id=campana_id).delete(synchronize_session=False)
+    if programacion_id:
+        ProgramacionMasiva.query.filter_by(id=programacion_id).delete(synchronize_session=False)
+    Cliente.query.filter_by(zona_id=zona.id).delete(synchronize_session=False)
+    db.session.delete(zona)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clientes", type=int, default=1000, help="Número de destinatarios")
+    parser.add_argument("--programacion", action="store_true", help="Medir una ejecución programada en vez de enviar_masivo")
+    parser.add_argument("--limite", type=float, default=600, help="Segundos máximos procesando la cola")
+    parser.add_argument("--conservar", action="store_true", help="No borrar los datos creados")
+    args = parser.parse_args()
+
+    if not twilio_sender.simulate_mode:
+        print("❌ Twilio está configurado con credenciales reales; el benchmark solo se ejecuta en modo simulación")
+        sys.exit(1)
+
+    with app.app_context():
+        aplicacion.inicializar_sistema()
+        plantilla = MensajePlantilla.query.filter_by(activo=True).first()
+        if not plantilla:
+            print("❌ No hay plantillas activas")
+            sys.exit(1)
+
+        zona = _crear_datos(args.clientes)
+        print(f"👥 {args.clientes} clientes creados en la zona '{zona.nombre}'")
+
+        inicio = time.time()
+        campana_id = _lanzar_programacion(zona, plantilla) if args.programacion else _lanzar_campana(zona, plantilla)
+        print(f"📮 Encolado: {time.time() - inicio:.2f}s")
+
+        try:
+            campana, duracion = _procesar_cola(campana_id, args.limite)
+            codigos = Counter(
+                codigo for (codigo,) in db.session.query(OutboxMensaje.codigo_error)
+                .filter(OutboxMensaje.campana_id == campana_id, OutboxMensaje.codigo_error.isnot(None))
+            )
+            reintentos = db.session.query(db.func.sum(OutboxMensaje.intentos - 1)).filter_by(campana_id=campana_id).scalar() or 0
+
+            print(f"📤 Procesados {campana.procesados}/{campana.total} en {duracion:.2f}s "
+                  f"({campana.procesados / duracion if duracion else 0:.1f} msg/s)")
+            print(f"   Enviados: {campana.enviados} · Fallidos: {campana.fallidos} · Reintentos: {reintentos}")
+            if codigos:
+                print("   Códigos de error finales: " + ", ".join(f"{codigo}×{n}" for codigo, n in codigos.most_common()))
+            if not campana.finalizada:
+                print(f"⚠️ La campaña no terminó en {args.limite:.0f}s (quedan reintentos pendientes)")
+        finally:
+            if not args.conservar:
+                _limpiar(zona, campana_id)
+                print("🧹 Datos de benchmark eliminados")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Configuración común de pytest: la aplicación se importa contra una base SQLite
+en memoria y un directorio temporal para el limitador, sin tocar recambios.db.
+"""
+
+import os
+import tempfile
+
+os.environ.setdefault('SQLITE_DATABASE_URL', 'sqlite://')
+os.environ.setdefault('RATE_LIMIT_DIR', tempfile.mkdtemp(prefix='rm_tests_'))
+
+import pytest
+
+
+@pytest.fixture
+def app_db():
+    """Contexto de la aplicación con las tablas recién creadas (y borradas al terminar)."""
+    import app as modulo_app
+    from models import db
+
+    with modulo_app.app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield modulo_app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def cliente_web(app_db, monkeypatch):
+    """Cliente de pruebas sin login ni hilos de fondo (scheduler, consumidor, outbox)."""
+    monkeypatch.setattr(app_db, '_sistema_inicializado', True)
+    monkeypatch.setattr(app_db, '_scheduler_iniciado', True)
+    monkeypatch.setattr(app_db, '_consumidor_webhooks_iniciado', True)
+    monkeypatch.setattr(app_db, '_OUTBOX_WORKER_EMBEDDED', 'false')
+    monkeypatch.setitem(app_db.app.config, 'LOGIN_DISABLED', True)
+    monkeypatch.setitem(app_db.app.config, 'TESTING', True)
+    return app_db.app.test_client()
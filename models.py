@@ -1,10 +1,25 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.orm import validates
 from datetime import datetime
 
 db = SQLAlchemy()
 
+
+def normalizar_telefono(telefono: str) -> str:
+    """
+    Forma canónica de un teléfono: solo dígitos, con prefijo internacional.
+    Los números españoles de 9 dígitos (móviles 6/7, fijos 8/9) reciben el prefijo 34.
+    """
+    digitos = "".join(filter(str.isdigit, telefono or ""))
+    if digitos.startswith("00"):
+        digitos = digitos[2:]
+    if len(digitos) == 9 and digitos[0] in "6789":
+        digitos = "34" + digitos
+    return digitos
+
+
 class Usuario(db.Model, UserMixin):
     __tablename__ = 'usuario'
     
@@ -43,6 +58,9 @@ class Cliente(db.Model):
     codigo = db.Column(db.String(50))
     nombre = db.Column(db.String(100), nullable=False)
     telefono = db.Column(db.String(20), nullable=False)
+    # normalizar_telefono(telefono), mantenido por el validador de `telefono`;
+    # indexado para emparejar remitentes de WhatsApp con clientes
+    telefono_normalizado = db.Column(db.String(20), index=True)
     email = db.Column(db.String(120))
     direccion = db.Column(db.Text)
     poblacion = db.Column(db.String(100))
@@ -54,6 +72,11 @@ class Cliente(db.Model):
     # Relación con mensajes enviados
     mensajes_enviados = db.relationship('MensajeEnviado', backref='cliente', lazy=True)
     
+    @validates('telefono')
+    def _validar_telefono(self, key, telefono):
+        self.telefono_normalizado = normalizar_telefono(telefono) or None
+        return telefono
+    
     def __repr__(self):
         return f'<Cliente {self.nombre}>'
 
@@ -85,6 +108,11 @@ class Oferta(db.Model):
         return f'<Oferta {self.titulo}>'
 
 class MensajeEnviado(db.Model):
+    __table_args__ = (
+        # Etapa de supresión: ¿recibió este cliente esta plantilla hace poco?
+        db.Index('ix_mensaje_enviado_supresion', 'cliente_id', 'plantilla_id', 'fecha_envio'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
     plantilla_id = db.Column(db.Integer, db.ForeignKey('mensaje_plantilla.id'), nullable=False)
@@ -93,10 +121,124 @@ class MensajeEnviado(db.Model):
     fecha_envio = db.Column(db.DateTime)
     error = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    campana_id = db.Column(db.Integer, db.ForeignKey('campana_envio.id'), nullable=True, index=True)  # Campaña de envío masivo (si aplica)
+    sid = db.Column(db.String(64), unique=True, index=True)  # SID de Twilio del envío
+    estado_entrega = db.Column(db.String(20))  # Último estado del StatusCallback: 'queued', 'sent', 'delivered', 'read', 'failed'...
+    estado_entrega_at = db.Column(db.DateTime)
     
     def __repr__(self):
         return f'<MensajeEnviado {self.id}>'
 
+
+class CampanaEnvio(db.Model):
+    """Trabajo de envío masivo ejecutado en background.
+
+    Las ejecuciones diarias de una ProgramacionMasiva también son campañas
+    (con `programacion_id` y `fecha_programada`): mientras se encolan están en
+    'preparando' y `ultimo_cliente_id` guarda el punto de control para reanudar.
+    """
+    __tablename__ = 'campana_envio'
+    __table_args__ = (
+        db.Index('uq_campana_envio_programacion_fecha', 'programacion_id', 'fecha_programada', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    zona_id = db.Column(db.Integer, db.ForeignKey('zona.id'), nullable=False)
+    plantilla_id = db.Column(db.Integer, db.ForeignKey('mensaje_plantilla.id'), nullable=False)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+    estado = db.Column(db.String(20), default='pendiente', nullable=False, index=True)  # 'pendiente', 'preparando', 'en_curso', 'completada' o 'error'
+    programacion_id = db.Column(db.Integer, db.ForeignKey('programacion_masiva.id', ondelete='SET NULL'), nullable=True)
+    fecha_programada = db.Column(db.Date)
+    ultimo_cliente_id = db.Column(db.Integer)  # Último cliente encolado (punto de control)
+    total = db.Column(db.Integer, default=0, nullable=False)
+    enviados = db.Column(db.Integer, default=0, nullable=False)
+    fallidos = db.Column(db.Integer, default=0, nullable=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    iniciado_at = db.Column(db.DateTime)
+    finalizado_at = db.Column(db.DateTime)
+
+    zona = db.relationship('Zona', backref='campanas_envio')
+    plantilla = db.relationship('MensajePlantilla', backref='campanas_envio')
+    usuario = db.relationship('Usuario', backref='campanas_envio')
+    programacion = db.relationship('ProgramacionMasiva', backref=db.backref('ejecuciones', lazy='dynamic'))
+    mensajes = db.relationship('MensajeEnviado', backref='campana', lazy='dynamic')
+
+    @property
+    def procesados(self) -> int:
+        return (self.enviados or 0) + (self.fallidos or 0)
+
+    @property
+    def finalizada(self) -> bool:
+        return self.estado in ('completada', 'error')
+
+    def __repr__(self):
+        return f'<CampanaEnvio {self.id} {self.estado} {self.procesados}/{self.total}>'
+
+class OutboxMensaje(db.Model):
+    """Cola persistente de mensajes salientes (patrón outbox).
+
+    La web solo encola filas; el worker (`python -m app worker`) las reclama en
+    lotes, las envía y registra el resultado en la misma transacción.
+    """
+    __tablename__ = 'outbox_mensaje'
+
+    id = db.Column(db.Integer, primary_key=True)
+    clave_idempotencia = db.Column(db.String(128), unique=True, nullable=False)
+    origen = db.Column(db.String(32), nullable=False)  # 'campana', 'programacion', 'respuesta' o 'conversacion'
+    telefono = db.Column(db.String(64), nullable=False)
+    mensaje = db.Column(db.Text, nullable=False)
+    media_url = db.Column(db.String(500))
+    estado = db.Column(db.String(20), default='pendiente', nullable=False, index=True)  # 'pendiente', 'procesando', 'enviado' o 'fallido'
+    intentos = db.Column(db.Integer, default=0, nullable=False)
+    bloqueado_por = db.Column(db.String(64), index=True)  # Worker que reclamó la fila
+    bloqueado_hasta = db.Column(db.DateTime)  # Fin del lease; pasado este momento otro worker puede reclamarla
+    disponible_en = db.Column(db.DateTime, index=True)  # Próximo reintento; vacío = en cuanto haya hueco
+    external_id = db.Column(db.String(128))  # SID devuelto por Twilio
+    codigo_error = db.Column(db.Integer)  # Código de error de Twilio del último intento
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    procesado_at = db.Column(db.DateTime)
+
+    # Referencias para registrar el resultado según el origen
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)
+    plantilla_id = db.Column(db.Integer, db.ForeignKey('mensaje_plantilla.id'), nullable=True)
+    campana_id = db.Column(db.Integer, db.ForeignKey('campana_envio.id'), nullable=True, index=True)
+    programacion_id = db.Column(db.Integer, db.ForeignKey('programacion_masiva.id', ondelete='SET NULL'), nullable=True)
+    respuesta_id = db.Column(db.Integer, db.ForeignKey('respuesta_mensaje.id'), nullable=True)
+    # 'conversacion': mensaje del agente ya mostrado; 'respuesta': mensaje entrante que se responde
+    whatsapp_message_id = db.Column(db.Integer, db.ForeignKey('whatsapp_message.id', ondelete='SET NULL'), nullable=True)
+    usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+
+    def __repr__(self):
+        return f'<OutboxMensaje {self.id} {self.origen} {self.estado}>'
+
+
+class OutboxFallido(db.Model):
+    """Cola de mensajes muertos: envíos del outbox que fallaron definitivamente.
+
+    Se puede reencolar en bloque (`python -m app redrive` o desde el panel de
+    envíos) una vez corregida la causa del fallo; al reencolar se borra la fila.
+    """
+    __tablename__ = 'outbox_fallido'
+
+    id = db.Column(db.Integer, primary_key=True)
+    outbox_id = db.Column(db.Integer, db.ForeignKey('outbox_mensaje.id', ondelete='CASCADE'), nullable=False, unique=True)
+    origen = db.Column(db.String(32), nullable=False)
+    telefono = db.Column(db.String(64), nullable=False)
+    campana_id = db.Column(db.Integer, db.ForeignKey('campana_envio.id'), nullable=True, index=True)
+    intentos = db.Column(db.Integer, default=0, nullable=False)
+    codigo_error = db.Column(db.Integer)
+    transitorio = db.Column(db.Boolean, default=False, nullable=False)  # True si se agotaron los reintentos
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    outbox = db.relationship('OutboxMensaje', backref=db.backref('fallido', uselist=False))
+
+    def __repr__(self):
+        return f'<OutboxFallido {self.outbox_id} {self.codigo_error}>'
+
+
 class MensajeOferta(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=False)
@@ -116,6 +258,12 @@ class MensajeOferta(db.Model):
         return f'<MensajeOferta {self.id}>'
 
 class MensajeRecibido(db.Model):
+    """Almacén antiguo de mensajes entrantes.
+
+    Ya no se escribe: los mensajes entrantes solo se guardan como WhatsAppMessage
+    y /mensajes-recibidos se sirve desde ahí. Las filas existentes se pasan con
+    `python -m app migrar-recibidos`.
+    """
     id = db.Column(db.Integer, primary_key=True)
     telefono_remitente = db.Column(db.String(20), nullable=False)
     nombre_remitente = db.Column(db.String(100))
@@ -125,7 +273,7 @@ class MensajeRecibido(db.Model):
     leido = db.Column(db.Boolean, default=False)
     respondido = db.Column(db.Boolean, default=False)
     fecha_recepcion = db.Column(db.DateTime, default=datetime.utcnow)
-    id_mensaje_whatsapp = db.Column(db.String(100))  # ID del mensaje en WhatsApp
+    id_mensaje_whatsapp = db.Column(db.String(100), unique=True, index=True)  # MessageSid de Twilio; único para ignorar reintentos del webhook
     
     # Relación opcional con cliente existente
     cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)
@@ -135,6 +283,7 @@ class MensajeRecibido(db.Model):
         return f'<MensajeRecibido {self.id} de {self.telefono_remitente}>'
 
 class RespuestaMensaje(db.Model):
+    """Respuesta enviada desde /mensajes-recibidos antes del almacén único (solo histórico)."""
     id = db.Column(db.Integer, primary_key=True)
     mensaje_recibido_id = db.Column(db.Integer, db.ForeignKey('mensaje_recibido.id'), nullable=False)
     respuesta = db.Column(db.Text, nullable=False)
@@ -150,6 +299,48 @@ class RespuestaMensaje(db.Model):
         return f'<RespuestaMensaje {self.id}>'
 
 
+class WebhookEntrante(db.Model):
+    """Bandeja de entrada de webhooks de Twilio.
+
+    El webhook solo guarda aquí el payload y responde; un consumidor en segundo
+    plano lo procesa por lotes (cliente, conversación y mensaje) y borra
+    la fila en la misma transacción. Las que fallan varias veces quedan en 'error'.
+    """
+    __tablename__ = 'webhook_entrante'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tipo = db.Column(db.String(20), default='mensaje', nullable=False)  # 'mensaje' o 'estado' (StatusCallback)
+    payload = db.Column(db.Text, nullable=False)  # Campos del webhook en JSON
+    estado = db.Column(db.String(20), default='pendiente', nullable=False, index=True)  # 'pendiente', 'procesando' o 'error'
+    intentos = db.Column(db.Integer, default=0, nullable=False)
+    bloqueado_por = db.Column(db.String(64))  # Consumidor que reclamó la fila
+    bloqueado_hasta = db.Column(db.DateTime)
+    error = db.Column(db.Text)
+    recibido_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<WebhookEntrante {self.id} {self.estado}>'
+
+
+class EstadoEntrega(db.Model):
+    """Último estado de entrega notificado por Twilio para cada SID saliente.
+
+    Los StatusCallback pueden llegar antes de que el worker de outbox guarde el
+    SID en MensajeEnviado/WhatsAppMessage, o desordenados; aquí se acumula el
+    estado más avanzado y desde aquí se copia a esas tablas.
+    """
+    __tablename__ = 'estado_entrega'
+
+    id = db.Column(db.Integer, primary_key=True)
+    sid = db.Column(db.String(64), unique=True, nullable=False, index=True)
+    estado = db.Column(db.String(20), nullable=False)
+    codigo_error = db.Column(db.Integer)
+    actualizado_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<EstadoEntrega {self.sid} {self.estado}>'
+
+
 class ProgramacionMasiva(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     zona_id = db.Column(db.Integer, db.ForeignKey('zona.id'), nullable=False)
@@ -158,6 +349,8 @@ class ProgramacionMasiva(db.Model):
     dias_semana = db.Column(db.String(20), nullable=False)
     # Hora en formato HH:MM (24h)
     hora = db.Column(db.String(5), nullable=False)
+    # Minutos durante los que se reparten los envíos tras la hora (0 = todos a la vez)
+    ventana_minutos = db.Column(db.Integer, default=0, nullable=False)
     activo = db.Column(db.Boolean, default=True)
     ultima_ejecucion = db.Column(db.Date)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -169,6 +362,23 @@ class ProgramacionMasiva(db.Model):
         return f'<ProgramacionMasiva zona={self.zona_id} hora={self.hora} dias={self.dias_semana}>'
 
 
+class LeaseProceso(db.Model):
+    """Lease con latido para que un único proceso de todo el despliegue haga una tarea.
+
+    Lo usa el scheduler de programaciones: quien tiene el lease vigente es el líder
+    y lo renueva periódicamente; si muere, otro proceso lo toma al expirar.
+    """
+    __tablename__ = 'lease_proceso'
+
+    nombre = db.Column(db.String(64), primary_key=True)
+    titular = db.Column(db.String(128), nullable=False)  # host:pid:token del proceso líder
+    expira_at = db.Column(db.DateTime, nullable=False)
+    renovado_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<LeaseProceso {self.nombre} {self.titular}>'
+
+
 class WhatsAppConversation(db.Model):
     __tablename__ = 'whatsapp_conversation'
 
@@ -180,12 +390,26 @@ class WhatsAppConversation(db.Model):
     anotaciones = db.Column(db.Text, nullable=True)  # Campo de texto para anotaciones
     tipo = db.Column(db.String(32), nullable=True, index=True)  # Tipo de conversación (ej: 'administracion')
 
+    # Resumen desnormalizado para el listado de conversaciones; se mantiene al
+    # escribir mensajes y al marcarlos leídos (ver _avanzar_resumen_conversaciones)
+    # y se reconstruye con `python -m app resumen-conversaciones`
+    last_message_id = db.Column(db.Integer)  # Sin FK: whatsapp_message ya apunta a esta tabla
+    last_message_at = db.Column(db.DateTime, index=True)
+    unread_count = db.Column(db.Integer, default=0, nullable=False)  # Mensajes del cliente sin leer
+    last_agent_usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)
+
     messages = db.relationship(
         'WhatsAppMessage',
         backref='conversation',
         lazy='dynamic',
         cascade='all, delete-orphan'
     )
+    ultimo_mensaje = db.relationship(
+        'WhatsAppMessage',
+        primaryjoin='foreign(WhatsAppConversation.last_message_id) == WhatsAppMessage.id',
+        viewonly=True,
+    )
+    ultimo_agente = db.relationship('Usuario', lazy=True)
 
     def last_message(self):
         return self.messages.order_by(WhatsAppMessage.sent_at.desc(), WhatsAppMessage.id.desc()).first()
@@ -194,34 +418,107 @@ class WhatsAppConversation(db.Model):
         """Obtiene el último mensaje enviado por un agente (usuario del sistema)"""
         return self.messages.filter_by(sender_type='agent').order_by(WhatsAppMessage.sent_at.desc(), WhatsAppMessage.id.desc()).first()
 
-    def unread_count(self):
-        return self.messages.filter_by(sender_type='customer', is_read=False).count()
-
     def __repr__(self):
         return f'<WhatsAppConversation {self.contact_number}>'
 
 
 class WhatsAppMessage(db.Model):
     __tablename__ = 'whatsapp_message'
+    __table_args__ = (
+        # Listado de /mensajes-recibidos: entrantes leídos o sin leer, más recientes primero
+        db.Index('ix_whatsapp_message_recibidos', 'sender_type', 'is_read', 'sent_at'),
+        # Último mensaje de una conversación sin recorrerla (resumen de WhatsAppConversation)
+        db.Index('ix_whatsapp_message_conversacion_orden', 'conversation_id', 'sent_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     conversation_id = db.Column(db.Integer, db.ForeignKey('whatsapp_conversation.id'), nullable=False, index=True)
     sender_type = db.Column(db.String(32), nullable=False)  # 'customer' o 'agent'
     message_text = db.Column(db.Text, nullable=False)
     sent_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
-    external_id = db.Column(db.String(128), index=True)
+    external_id = db.Column(db.String(128), unique=True, index=True)  # SID de Twilio
     is_read = db.Column(db.Boolean, default=True, nullable=False, index=True)
     media_type = db.Column(db.String(32))
     media_url = db.Column(db.String(500))
     usuario_id = db.Column(db.Integer, db.ForeignKey('usuario.id'), nullable=True)  # Usuario que envió el mensaje (si es agent)
+    estado_entrega = db.Column(db.String(20))  # Solo mensajes de agente (ver MensajeEnviado.estado_entrega)
+    estado_entrega_at = db.Column(db.DateTime)
+    cliente_id = db.Column(db.Integer, db.ForeignKey('cliente.id'), nullable=True)  # Cliente remitente (solo customer)
+    respondido = db.Column(db.Boolean, default=False, nullable=False)  # Respondido desde /mensajes-recibidos
     
     # Relación con Usuario
     usuario = db.relationship('Usuario', backref='whatsapp_messages', lazy=True)
+    cliente = db.relationship('Cliente', lazy=True)
+
+    # Nombres de MensajeRecibido para las vistas de /mensajes-recibidos
+    @property
+    def telefono_remitente(self):
+        contacto = self.conversation.contact_number if self.conversation else ''
+        return contacto.split('@', 1)[0] if contacto.endswith('@c.us') else contacto
+
+    @property
+    def nombre_remitente(self):
+        return self.conversation.contact_name if self.conversation else None
+
+    @property
+    def mensaje(self):
+        return self.message_text
+
+    @property
+    def tipo_mensaje(self):
+        return self.media_type or 'texto'
+
+    @property
+    def archivo_url(self):
+        return self.media_url
+
+    @property
+    def leido(self):
+        return self.is_read
+
+    @property
+    def fecha_recepcion(self):
+        return self.sent_at
 
     def __repr__(self):
         return f'<WhatsAppMessage {self.id} {self.sender_type}>'
 
 
+class WhatsAppMedia(db.Model):
+    """Adjunto de un mensaje entrante, descargado a un almacén local por contenido.
+
+    Al procesar el webhook se crea una fila por cada MediaUrlN en estado 'pendiente';
+    el descargador la pasa a 'descargado' con la ruta relativa (derivada del SHA-256)
+    y el tamaño, o a 'error' tras agotar los intentos.
+    """
+    __tablename__ = 'whatsapp_media'
+    __table_args__ = (db.UniqueConstraint('message_id', 'indice', name='uq_whatsapp_media_message_indice'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('whatsapp_message.id'), nullable=False, index=True)
+    indice = db.Column(db.Integer, default=0, nullable=False)  # N de MediaUrlN
+    url_origen = db.Column(db.String(500), nullable=False)
+    content_type = db.Column(db.String(100))
+    estado = db.Column(db.String(20), default='pendiente', nullable=False, index=True)  # 'pendiente', 'descargando', 'descargado' o 'error'
+    intentos = db.Column(db.Integer, default=0, nullable=False)
+    bloqueado_por = db.Column(db.String(64))  # Descargador que reclamó la fila
+    bloqueado_hasta = db.Column(db.DateTime)
+    sha256 = db.Column(db.String(64), index=True)
+    ruta = db.Column(db.String(100))  # Relativa a WHATSAPP_MEDIA_FOLDER
+    tamano = db.Column(db.Integer)  # Bytes
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    descargado_at = db.Column(db.DateTime)
+
+    message = db.relationship(
+        'WhatsAppMessage',
+        backref=db.backref('medios', lazy=True, order_by='WhatsAppMedia.indice'),
+    )
+
+    def __repr__(self):
+        return f'<WhatsAppMedia {self.message_id}#{self.indice} {self.estado}>'
+
+
 class PedidoEntreNaves(db.Model):
     __tablename__ = 'pedido_entre_naves'
     
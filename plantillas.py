@@ -0,0 +1,141 @@
+"""
+Compilación y renderizado de plantillas de mensajes (MensajePlantilla.contenido).
+
+Cada plantilla se analiza una sola vez en un plan de renderizado (segmentos de
+texto literal y campos), que se cachea por id de plantilla y hash del contenido.
+Renderizar un destinatario es entonces una simple concatenación.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from string import Formatter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Marcadores disponibles en las plantillas
+CAMPOS_PLANTILLA = (
+    "nombre_cliente",
+    "cliente_nombre",
+    "zona",
+    "zona_nombre",
+    "enlace_web",
+    "link_ofertas",
+    "telefono_cliente",
+    "cliente_telefono",
+)
+
+_CACHE_MAX = 256
+
+
+class PlantillaInvalida(ValueError):
+    """La plantilla no se puede analizar o usa marcadores desconocidos."""
+
+
+class PlanPlantilla:
+    """
+    Plantilla ya analizada: lista de (literal, campo, conversión, formato).
+    Los campos que faltan en el contexto se renderizan vacíos.
+    """
+
+    __slots__ = ("segmentos", "campos")
+
+    def __init__(self, contenido: str):
+        try:
+            partes = list(Formatter().parse(contenido))
+        except ValueError as exc:
+            raise PlantillaInvalida(f"Sintaxis de plantilla inválida: {exc}") from exc
+
+        self.segmentos: List[Tuple[str, Optional[str], Optional[str], str]] = [
+            (literal, campo, conversion, formato or "")
+            for literal, campo, conversion, formato in partes
+        ]
+        self.campos = {campo for _, campo, _, _ in self.segmentos if campo is not None}
+
+    def campos_desconocidos(self) -> List[str]:
+        """Marcadores que no forman parte de CAMPOS_PLANTILLA (incluye `{}` posicionales)."""
+        return sorted(campo or "{}" for campo in self.campos if campo not in CAMPOS_PLANTILLA)
+
+    def render(self, contexto: Dict[str, object]) -> str:
+        partes = []
+        for literal, campo, conversion, formato in self.segmentos:
+            if literal:
+                partes.append(literal)
+            if campo is None:
+                continue
+            valor = contexto.get(campo, "")
+            if valor is None:
+                valor = ""
+            if conversion == "r":
+                valor = repr(valor)
+            elif conversion == "a":
+                valor = ascii(valor)
+            if formato:
+                try:
+                    partes.append(format(valor, formato))
+                except (ValueError, TypeError):
+                    partes.append(str(valor))
+            else:
+                partes.append(str(valor))
+        return "".join(partes)
+
+    def render_many(self, clientes: Iterable, zona, enlace_web: str = "") -> List[str]:
+        """Renderiza la plantilla para cada cliente de la zona, en el mismo orden."""
+        zona_nombre = zona.nombre if zona is not None else ""
+        return [self.render(contexto_cliente(cliente, zona_nombre, enlace_web)) for cliente in clientes]
+
+
+def contexto_cliente(cliente, zona_nombre: str, enlace_web: str = "") -> Dict[str, object]:
+    """Valores de los marcadores para un cliente."""
+    return {
+        "nombre_cliente": cliente.nombre,
+        "cliente_nombre": cliente.nombre,
+        "zona": zona_nombre,
+        "zona_nombre": zona_nombre,
+        "enlace_web": enlace_web,
+        "link_ofertas": enlace_web,
+        "telefono_cliente": cliente.telefono,
+        "cliente_telefono": cliente.telefono,
+    }
+
+
+_cache: "OrderedDict[Tuple[Optional[int], str], PlanPlantilla]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def obtener_plan(plantilla) -> PlanPlantilla:
+    """
+    Plan compilado de una MensajePlantilla, cacheado por (id, hash del contenido)
+    para que editar la plantilla invalide la entrada automáticamente.
+    """
+    contenido = plantilla.contenido or ""
+    clave = (plantilla.id, hashlib.sha1(contenido.encode("utf-8")).hexdigest())
+
+    with _cache_lock:
+        plan = _cache.get(clave)
+        if plan is not None:
+            _cache.move_to_end(clave)
+            return plan
+
+    plan = PlanPlantilla(contenido)
+    with _cache_lock:
+        _cache[clave] = plan
+        while len(_cache) > _CACHE_MAX:
+            _cache.popitem(last=False)
+    return plan
+
+
+def validar_plantilla(contenido: str) -> PlanPlantilla:
+    """
+    Compila el contenido y rechaza marcadores desconocidos.
+    Lanza PlantillaInvalida con un mensaje apto para mostrar al usuario.
+    """
+    plan = PlanPlantilla(contenido)
+    desconocidos = plan.campos_desconocidos()
+    if desconocidos:
+        raise PlantillaInvalida(
+            "Marcadores desconocidos: "
+            + ", ".join(f"{{{campo}}}" if campo != "{}" else campo for campo in desconocidos)
+            + ". Marcadores disponibles: "
+            + ", ".join(f"{{{campo}}}" for campo in CAMPOS_PLANTILLA)
+        )
+    return plan
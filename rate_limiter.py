@@ -0,0 +1,263 @@
+"""
+Limitadores de tasa compartidos entre hilos y procesos (workers de gunicorn,
+worker de outbox) de una misma máquina.
+
+El estado de cada clave vive en un pequeño fichero protegido con un lock del
+sistema operativo (fcntl.flock), así todos los procesos ven el mismo bucket.
+En plataformas sin fcntl (Windows) se usa un estado en memoria por proceso.
+
+Para limitar por muchas claves variables (p. ej. una por IP) está `LimitadorGCRA`,
+que guarda un único float por clave en una tabla SQLite compartida y purga las
+claves inactivas.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = os.environ.get(
+    "RATE_LIMIT_DIR",
+    os.path.join(tempfile.gettempdir(), "recambios_rate_limit"),
+)
+
+
+class _EstadoCompartido:
+    """
+    Estado (dos floats) asociado a una clave y guardado en fichero con lock exclusivo.
+    """
+
+    _locales = {}
+    _locales_lock = threading.Lock()
+
+    def __init__(self, prefijo: str, clave: str, directorio: Optional[str] = None):
+        self.clave = clave
+        digest = hashlib.sha1(clave.encode("utf-8")).hexdigest()[:16]
+        self.directorio = directorio or DEFAULT_DIR
+        self.ruta = os.path.join(self.directorio, f"{prefijo}_{digest}.state")
+        self._lock = threading.Lock()
+        if fcntl is not None:
+            os.makedirs(self.directorio, exist_ok=True)
+
+    def actualizar(self, funcion):
+        """
+        Ejecuta `funcion(estado) -> (nuevo_estado, resultado)` de forma atómica.
+        `estado` es una tupla (a, b) de floats o None si la clave no existe aún.
+        """
+        with self._lock:
+            if fcntl is None:
+                with self._locales_lock:
+                    nuevo, resultado = funcion(self._locales.get(self.ruta))
+                    self._locales[self.ruta] = nuevo
+                return resultado
+
+            with open(self.ruta, "a+") as fichero:
+                fcntl.flock(fichero, fcntl.LOCK_EX)
+                try:
+                    fichero.seek(0)
+                    estado = self._parsear(fichero.read())
+                    nuevo, resultado = funcion(estado)
+                    fichero.seek(0)
+                    fichero.truncate()
+                    fichero.write(f"{nuevo[0]!r} {nuevo[1]!r}")
+                    fichero.flush()
+                finally:
+                    fcntl.flock(fichero, fcntl.LOCK_UN)
+            return resultado
+
+    @staticmethod
+    def _parsear(contenido: str) -> Optional[Tuple[float, float]]:
+        try:
+            a, b = contenido.split()
+            return float(a), float(b)
+        except ValueError:
+            return None
+
+
+class TokenBucket:
+    """
+    Token bucket compartido: `tasa` tokens por segundo con ráfagas de hasta `rafaga`.
+
+    `reservar()` descuenta el token de inmediato y devuelve cuántos segundos hay que
+    esperar para respetar la tasa, de modo que los llamadores concurrentes quedan
+    escalonados en vez de competir por el mismo hueco.
+    """
+
+    def __init__(self, clave: str, tasa: float, rafaga: Optional[float] = None, directorio: Optional[str] = None):
+        self.clave = clave
+        self.tasa = float(tasa)
+        self.rafaga = float(rafaga if rafaga else max(self.tasa, 1.0))
+        self._estado = _EstadoCompartido("bucket", clave, directorio)
+
+    @property
+    def activo(self) -> bool:
+        return self.tasa > 0
+
+    def _rellenar(self, estado, ahora: float) -> float:
+        if estado is None:
+            return self.rafaga
+        tokens, ultimo = estado
+        return min(self.rafaga, tokens + max(0.0, ahora - ultimo) * self.tasa)
+
+    def reservar(self, tokens: float = 1.0) -> float:
+        """Reserva `tokens` y retorna los segundos de espera necesarios (0 si hay saldo)."""
+        if not self.activo:
+            return 0.0
+
+        def _reservar(estado):
+            ahora = time.time()
+            disponibles = self._rellenar(estado, ahora) - tokens
+            espera = 0.0 if disponibles >= 0 else -disponibles / self.tasa
+            return (disponibles, ahora), espera
+
+        return self._estado.actualizar(_reservar)
+
+    def intentar(self, tokens: float = 1.0) -> bool:
+        """Consume `tokens` solo si hay saldo suficiente; nunca deja el bucket en deuda."""
+        if not self.activo:
+            return True
+
+        def _intentar(estado):
+            ahora = time.time()
+            disponibles = self._rellenar(estado, ahora)
+            if disponibles >= tokens:
+                return (disponibles - tokens, ahora), True
+            return (disponibles, ahora), False
+
+        return self._estado.actualizar(_intentar)
+
+    def adquirir(self, tokens: float = 1.0) -> float:
+        """Bloquea hasta disponer de `tokens`. Retorna los segundos esperados."""
+        espera = self.reservar(tokens)
+        if espera > 0:
+            time.sleep(espera)
+        return espera
+
+    def vaciar(self):
+        """Deja el bucket sin saldo (p. ej. tras un 429) para que todos los procesos frenen."""
+        if not self.activo:
+            return
+
+        def _vaciar(estado):
+            ahora = time.time()
+            return (min(0.0, self._rellenar(estado, ahora)), ahora), None
+
+        self._estado.actualizar(_vaciar)
+
+
+class LimitadorGCRA:
+    """
+    Limitador GCRA (Generic Cell Rate Algorithm): como mucho `limite` peticiones
+    por `periodo` segundos y clave, admitiendo la ráfaga completa de golpe.
+
+    Por clave solo se guarda el TAT (instante teórico de la próxima llegada), así
+    que cada comprobación es una lectura y una escritura. Una clave con TAT pasado
+    equivale a una clave nueva, de modo que se puede borrar sin cambiar el
+    resultado: cada `purga_seg` se eliminan todas las claves inactivas.
+
+    El estado vive en una base SQLite propia dentro de `directorio` (no en la de la
+    aplicación, para no competir por su lock de escritura), compartida por todos
+    los procesos de la máquina.
+    """
+
+    def __init__(self, nombre: str, limite: int, periodo: float, directorio: Optional[str] = None,
+                 purga_seg: Optional[float] = None):
+        self.nombre = nombre
+        self.limite = int(limite)
+        self.periodo = float(periodo)
+        self.intervalo = self.periodo / self.limite if self.limite > 0 else 0.0
+        self.purga_seg = float(purga_seg if purga_seg is not None else max(self.periodo, 60.0))
+        self.directorio = directorio or DEFAULT_DIR
+        self.ruta = os.path.join(self.directorio, "gcra.db")
+        self._local = threading.local()
+        self._proxima_purga = 0.0
+        self._purga_lock = threading.Lock()
+
+    @property
+    def activo(self) -> bool:
+        return self.limite > 0 and self.periodo > 0
+
+    def permitir(self, clave: str) -> bool:
+        """Cuenta una petición de `clave` y retorna False si supera el límite."""
+        if not self.activo:
+            return True
+
+        ahora = time.time()
+        conexion = self._conexion()
+        try:
+            conexion.execute("BEGIN IMMEDIATE")
+            fila = conexion.execute(
+                "SELECT tat FROM gcra WHERE nombre = ? AND clave = ?", (self.nombre, clave)
+            ).fetchone()
+            tat = max(fila[0] if fila else ahora, ahora)
+            permitido = tat + self.intervalo - ahora <= self.periodo
+            if permitido:
+                conexion.execute(
+                    "INSERT INTO gcra (nombre, clave, tat) VALUES (?, ?, ?) "
+                    "ON CONFLICT (nombre, clave) DO UPDATE SET tat = excluded.tat",
+                    (self.nombre, clave, tat + self.intervalo),
+                )
+            conexion.execute("COMMIT")
+        except sqlite3.Error as e:
+            # Ante un fallo del almacén compartido se deja pasar: el limitador
+            # protege de abusos, no debe tumbar el webhook
+            logger.warning(f"⚠️ Limitador {self.nombre} no disponible: {e}")
+            try:
+                conexion.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            return True
+
+        if ahora >= self._proxima_purga:
+            with self._purga_lock:
+                toca = ahora >= self._proxima_purga
+                if toca:
+                    self._proxima_purga = ahora + self.purga_seg
+            if toca:
+                self.purgar(ahora)
+        return permitido
+
+    def purgar(self, ahora: Optional[float] = None) -> int:
+        """Borra las claves cuyo TAT ya pasó. Retorna cuántas se eliminaron."""
+        ahora = ahora or time.time()
+        try:
+            cursor = self._conexion().execute(
+                "DELETE FROM gcra WHERE nombre = ? AND tat <= ?", (self.nombre, ahora)
+            )
+            return cursor.rowcount
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ No se pudo purgar el limitador {self.nombre}: {e}")
+            return 0
+
+    def claves(self) -> int:
+        """Número de claves con estado guardado (para métricas)."""
+        return self._conexion().execute(
+            "SELECT COUNT(*) FROM gcra WHERE nombre = ?", (self.nombre,)
+        ).fetchone()[0]
+
+    def _conexion(self) -> sqlite3.Connection:
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None:
+            os.makedirs(self.directorio, exist_ok=True)
+            # isolation_level=None: las transacciones se abren a mano con BEGIN IMMEDIATE
+            conexion = sqlite3.connect(self.ruta, timeout=5, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=OFF")
+            conexion.execute(
+                "CREATE TABLE IF NOT EXISTS gcra ("
+                "nombre TEXT NOT NULL, clave TEXT NOT NULL, tat REAL NOT NULL, "
+                "PRIMARY KEY (nombre, clave)) WITHOUT ROWID"
+            )
+            self._local.conexion = conexion
+        return conexion
@@ -0,0 +1,192 @@
+"""
+Modo simulación de los senders (Twilio y Green-API) configurable para pruebas de carga.
+
+Sin variables de entorno se comporta como la simulación de siempre: respuesta
+instantánea con un 10% de errores genéricos. Para imitar a Twilio:
+
+    SIMULACION_LATENCIA=lognormal:150:600       # distribución:parámetros en ms
+    SIMULACION_ERRORES=429:0.02,21211:0.01,63016:0.005,timeout:0.002
+    SIMULACION_MAX_POR_SEG=80                   # por encima se responde 429
+    SIMULACION_TIMEOUT_SEG=15
+    SIMULACION_SEMILLA=42
+
+Distribuciones de latencia: `fija:MS`, `uniforme:MIN:MAX`, `normal:MEDIA:DESV`,
+`lognormal:MEDIANA:P95` y `exponencial:MEDIA`.
+Errores: códigos de Twilio (429 equivale a 20429), `timeout` y `generico`.
+"""
+
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from rate_limiter import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Mensaje y estado HTTP con los que responde Twilio a cada código simulado
+_ERRORES_CONOCIDOS: Dict[str, Tuple[int, Optional[int], str]] = {
+    "429": (429, 20429, "Too Many Requests"),
+    "20429": (429, 20429, "Too Many Requests"),
+    "20500": (500, 20500, "Internal Server Error"),
+    "20503": (503, 20503, "Service Unavailable"),
+    "21211": (400, 21211, "The 'To' number is not a valid phone number."),
+    "21608": (400, 21608, "The 'To' phone number is not verified for this account."),
+    "63007": (400, 63007, "Twilio could not find a Channel with the specified From address."),
+    "63016": (400, 63016, "Failed to send freeform message because you are outside the allowed window."),
+    "63018": (429, 63018, "Rate limit exceeded for the sender."),
+    # Como la simulación de siempre: un fallo definitivo, que no se reintenta
+    "generico": (400, None, "Error simulado en el envío"),
+}
+
+
+class EnvioSimulado(NamedTuple):
+    """Resultado simulado de un envío; `status` es el código HTTP (None en timeouts)."""
+    success: bool
+    sid: str = ""
+    error: Optional[str] = None
+    codigo: Optional[int] = None
+    status: Optional[int] = None
+    timeout: bool = False
+
+
+class SimuladorEnvios:
+    """
+    Genera latencias y resultados según la configuración de simulación.
+    `muestrear()` solo decide (para código asíncrono); `simular()` además espera.
+    """
+
+    def __init__(
+        self,
+        latencia: str = "fija:0",
+        errores: str = "generico:0.1",
+        max_por_seg: float = 0,
+        timeout_seg: float = 15,
+        semilla: Optional[int] = None,
+    ):
+        self.latencia = latencia
+        self._muestrear_latencia = self._parsear_latencia(latencia)
+        self.errores = self._parsear_errores(errores)
+        self.max_por_seg = float(max_por_seg or 0)
+        self.timeout_seg = float(timeout_seg)
+        self._aleatorio = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._limitadores: Dict[str, TokenBucket] = {}
+
+    @classmethod
+    def desde_entorno(cls) -> "SimuladorEnvios":
+        semilla = os.environ.get("SIMULACION_SEMILLA")
+        return cls(
+            latencia=os.environ.get("SIMULACION_LATENCIA", "fija:0"),
+            errores=os.environ.get("SIMULACION_ERRORES", "generico:0.1"),
+            max_por_seg=float(os.environ.get("SIMULACION_MAX_POR_SEG", 0)),
+            timeout_seg=float(os.environ.get("SIMULACION_TIMEOUT_SEG", 15)),
+            semilla=int(semilla) if semilla else None,
+        )
+
+    def muestrear(self, canal: str) -> Tuple[float, EnvioSimulado]:
+        """
+        Decide el resultado de un envío por `canal` ('twilio', 'green_api'...).
+        Retorna (segundos de espera, resultado).
+        """
+        if self.max_por_seg > 0 and not self._limitador(canal).intentar():
+            status, codigo, texto = _ERRORES_CONOCIDOS["429"]
+            return self._latencia(), EnvioSimulado(False, error=f"Error Twilio {codigo}: {texto}", codigo=codigo, status=status)
+
+        with self._lock:
+            tirada = self._aleatorio.random()
+        acumulado = 0.0
+        for nombre, probabilidad in self.errores:
+            acumulado += probabilidad
+            if tirada < acumulado:
+                if nombre == "timeout":
+                    return self.timeout_seg, EnvioSimulado(
+                        False, error=f"Error de conexión Twilio: timeout simulado tras {self.timeout_seg:.0f}s", timeout=True
+                    )
+                if nombre in _ERRORES_CONOCIDOS:
+                    status, codigo, texto = _ERRORES_CONOCIDOS[nombre]
+                else:
+                    status, codigo, texto = 400, int(nombre), "Error simulado"
+                error = texto if codigo is None else f"Error Twilio {codigo}: {texto}"
+                return self._latencia(), EnvioSimulado(False, error=error, codigo=codigo, status=status)
+
+        return self._latencia(), EnvioSimulado(True, sid=f"SM{uuid.uuid4().hex}", status=201)
+
+    def simular(self, canal: str) -> EnvioSimulado:
+        """Versión bloqueante: espera la latencia simulada y retorna el resultado."""
+        espera, resultado = self.muestrear(canal)
+        if espera > 0:
+            time.sleep(espera)
+        return resultado
+
+    def _latencia(self) -> float:
+        with self._lock:
+            return max(0.0, self._muestrear_latencia(self._aleatorio)) / 1000.0
+
+    def _limitador(self, canal: str) -> TokenBucket:
+        limitador = self._limitadores.get(canal)
+        if limitador is None:
+            limitador = TokenBucket(f"simulacion:{canal}", self.max_por_seg)
+            self._limitadores[canal] = limitador
+        return limitador
+
+    @staticmethod
+    def _parsear_latencia(especificacion: str):
+        tipo, _, resto = (especificacion or "fija:0").partition(":")
+        try:
+            valores = [float(v) for v in resto.split(":") if v.strip()]
+            if tipo == "fija":
+                ms = valores[0] if valores else 0.0
+                return lambda aleatorio: ms
+            if tipo == "uniforme":
+                minimo, maximo = valores
+                return lambda aleatorio: aleatorio.uniform(minimo, maximo)
+            if tipo == "normal":
+                media, desviacion = valores
+                return lambda aleatorio: aleatorio.gauss(media, desviacion)
+            if tipo == "lognormal":
+                # Parametrizada por mediana y p95, más fácil de leer en métricas reales
+                mediana, p95 = valores
+                mu = math.log(mediana)
+                sigma = max(1e-6, (math.log(p95) - mu) / 1.6449)
+                return lambda aleatorio: aleatorio.lognormvariate(mu, sigma)
+            if tipo == "exponencial":
+                media = valores[0]
+                return lambda aleatorio: aleatorio.expovariate(1.0 / media) if media > 0 else 0.0
+        except (ValueError, IndexError):
+            pass
+        raise ValueError(f"SIMULACION_LATENCIA inválida: {especificacion!r}")
+
+    @staticmethod
+    def _parsear_errores(especificacion: str):
+        errores = []
+        for parte in (especificacion or "").split(","):
+            if not parte.strip():
+                continue
+            nombre, _, probabilidad = parte.strip().partition(":")
+            nombre = nombre.strip().lower()
+            if nombre not in _ERRORES_CONOCIDOS and nombre != "timeout" and not nombre.isdigit():
+                raise ValueError(f"Error simulado desconocido en SIMULACION_ERRORES: {nombre!r}")
+            errores.append((nombre, float(probabilidad)))
+        if sum(p for _, p in errores) > 1:
+            raise ValueError("Las probabilidades de SIMULACION_ERRORES suman más de 1")
+        return errores
+
+
+# Instancia compartida por twilio_sender y whatsapp_sender
+simulador = SimuladorEnvios.desde_entorno()
+
+
+def configurar_simulacion(**opciones) -> SimuladorEnvios:
+    """
+    Sustituye la configuración de simulación en caliente (p. ej. desde un script
+    de benchmark). Acepta los mismos argumentos que SimuladorEnvios.
+    """
+    global simulador
+    simulador = SimuladorEnvios(**opciones)
+    logger.info(f"Simulación configurada: latencia={simulador.latencia}, errores={simulador.errores}, máx/s={simulador.max_por_seg}")
+    return simulador
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Pruebas de los StatusCallback de Twilio: orden de estados y estadísticas por campaña
+"""
+
+from datetime import datetime, timedelta
+
+from models import db, Zona, Cliente, MensajePlantilla, CampanaEnvio, MensajeEnviado, EstadoEntrega
+
+
+def _crear_envios(sids):
+    zona = Zona(nombre='Sur')
+    plantilla = MensajePlantilla(nombre='Aviso', contenido='Aviso')
+    db.session.add_all([zona, plantilla])
+    db.session.flush()
+    cliente = Cliente(nombre='Cliente', telefono='600000001', zona_id=zona.id)
+    campana = CampanaEnvio(zona_id=zona.id, plantilla_id=plantilla.id, estado='en_curso', total=len(sids))
+    db.session.add_all([cliente, campana])
+    db.session.flush()
+    for sid in sids:
+        db.session.add(MensajeEnviado(cliente_id=cliente.id, plantilla_id=plantilla.id, mensaje_final='Aviso',
+                                      enviado=True, fecha_envio=datetime.utcnow(), campana_id=campana.id, sid=sid))
+    db.session.commit()
+    return campana
+
+
+def _callbacks(app_db, *eventos):
+    """Aplica un StatusCallback por lote, como el consumidor de webhooks."""
+    momento = datetime.utcnow()
+    for sid, estado, *codigo in eventos:
+        momento += timedelta(seconds=1)
+        datos = {'MessageSid': sid, 'MessageStatus': estado}
+        if codigo:
+            datos['ErrorCode'] = str(codigo[0])
+        app_db._registrar_estados_entrega([app_db._leer_estado_entrega(datos, momento)])
+        db.session.commit()
+
+
+def _estado(sid):
+    return MensajeEnviado.query.filter_by(sid=sid).one().estado_entrega
+
+
+def test_rango_estados_entrega(app_db):
+    rango = app_db._RANGO_ESTADO_ENTREGA
+    assert rango['queued'] < rango['sent'] < rango['failed'] < rango['delivered'] < rango['read']
+    assert rango['failed'] == rango['undelivered'] == rango['canceled']
+
+
+def test_fallo_tras_entrega_no_degrada_el_estado(app_db):
+    _crear_envios(['SM1'])
+    _callbacks(app_db, ('SM1', 'sent'), ('SM1', 'delivered'), ('SM1', 'read'), ('SM1', 'failed', 30008))
+
+    assert _estado('SM1') == 'read'
+    fila = EstadoEntrega.query.filter_by(sid='SM1').one()
+    assert fila.estado == 'read'
+    assert fila.codigo_error == 30008
+
+
+def test_fallo_y_entrega_en_el_mismo_lote(app_db):
+    _crear_envios(['SM1'])
+    momento = datetime.utcnow()
+    app_db._registrar_estados_entrega([
+        app_db._leer_estado_entrega({'MessageSid': 'SM1', 'MessageStatus': 'delivered'}, momento),
+        app_db._leer_estado_entrega({'MessageSid': 'SM1', 'MessageStatus': 'undelivered', 'ErrorCode': '30003'}, momento),
+    ])
+    db.session.commit()
+
+    assert _estado('SM1') == 'delivered'
+    assert EstadoEntrega.query.filter_by(sid='SM1').one().codigo_error == 30003
+
+
+def test_estados_desordenados_y_estadisticas(app_db):
+    campana = _crear_envios(['SM1', 'SM2', 'SM3', 'SM4'])
+    _callbacks(
+        app_db,
+        ('SM1', 'delivered'), ('SM1', 'sent'),          # llega desordenado
+        ('SM2', 'sent'), ('SM2', 'failed', 30006),      # fallo real
+        ('SM3', 'read'), ('SM3', 'undelivered', 30003),  # fallo tardío tras leerse
+        ('SM4', 'queued'),
+    )
+
+    assert [_estado(sid) for sid in ('SM1', 'SM2', 'SM3', 'SM4')] == ['delivered', 'failed', 'read', 'queued']
+    datos = app_db._estadisticas_entrega([campana.id])[campana.id]
+    assert (datos['aceptados'], datos['entregados'], datos['leidos'], datos['no_entregados'], datos['sin_confirmar']) == (4, 2, 1, 1, 1)
+    assert datos['tasa_entrega'] == 50.0
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Pruebas del descargador de adjuntos entrantes contra un servidor HTTP local
+"""
+
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from models import db, WhatsAppConversation, WhatsAppMedia
+
+
+class _Adjuntos(BaseHTTPRequestHandler):
+    """/N sirve N bytes con Content-Length; /sin-longitud/N los sirve sin declararlo."""
+
+    def do_GET(self):
+        partes = self.path.strip('/').split('/')
+        tamano = int(partes[-1])
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        if partes[0] != 'sin-longitud':
+            self.send_header('Content-Length', str(tamano))
+        self.end_headers()
+        self.wfile.write(b'x' * tamano)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def servidor():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Adjuntos)
+    hilo = threading.Thread(target=httpd.serve_forever, daemon=True)
+    hilo.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_descarga_dentro_del_limite(app_db, servidor, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_db, '_MEDIA_MAX_BYTES', 1000)
+    sha256, ruta, tamano, content_type = app_db._descargar_medio(f'{servidor}/1000', str(tmp_path))
+    assert tamano == 1000 and content_type == 'image/jpeg'
+    assert os.path.getsize(tmp_path / ruta) == 1000
+
+
+@pytest.mark.parametrize('ruta', ['/5000', '/sin-longitud/5000'])
+def test_descarga_demasiado_grande_se_corta(app_db, servidor, tmp_path, monkeypatch, ruta):
+    monkeypatch.setattr(app_db, '_MEDIA_MAX_BYTES', 1000)
+    with pytest.raises(app_db.MedioDemasiadoGrande):
+        app_db._descargar_medio(servidor + ruta, str(tmp_path))
+    # No queda ningún fichero temporal a medias
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_adjunto_demasiado_grande_queda_en_error_sin_reintentos(app_db, servidor, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_db, '_MEDIA_MAX_BYTES', 1000)
+    monkeypatch.setitem(app_db.app.config, 'WHATSAPP_MEDIA_FOLDER', str(tmp_path))
+    conversation = WhatsAppConversation(contact_number='34600000001@c.us')
+    db.session.add(conversation)
+    db.session.flush()
+    mensaje = app_db._append_whatsapp_message(conversation, 'customer', '[Imagen]', is_read=False)
+    db.session.add(WhatsAppMedia(message_id=mensaje.id, indice=0, url_origen=f'{servidor}/sin-longitud/5000'))
+    db.session.commit()
+
+    assert app_db._procesar_lote_medios() == 1
+    medio = WhatsAppMedia.query.one()
+    assert medio.estado == 'error' and medio.intentos == 1
+    assert 'más de 1000 bytes' in medio.error
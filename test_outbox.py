@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la cola de salida (outbox): idempotencia al encolar y leases del worker
+"""
+
+from datetime import datetime, timedelta
+
+from models import db, LeaseProceso, OutboxMensaje, OutboxFallido, WhatsAppConversation, WhatsAppMessage
+from twilio_sender import ResultadoEnvio
+
+
+def _fila(clave, **extra):
+    return {'clave_idempotencia': clave, 'origen': 'campana', 'telefono': '600000001', 'mensaje': 'Hola', **extra}
+
+
+def test_encolar_mensajes_es_idempotente(app_db):
+    assert app_db._encolar_mensajes([_fila('campana:1:1'), _fila('campana:1:2')]) == 2
+    db.session.commit()
+
+    # Claves ya encoladas (en otra transacción) o repetidas en la misma llamada se ignoran
+    assert app_db._encolar_mensajes([_fila('campana:1:2'), _fila('campana:1:3'), _fila('campana:1:3')]) == 1
+    db.session.commit()
+    assert app_db._encolar_mensajes([_fila('campana:1:1')]) == 0
+
+    assert sorted(clave for (clave,) in db.session.query(OutboxMensaje.clave_idempotencia)) == [
+        'campana:1:1', 'campana:1:2', 'campana:1:3',
+    ]
+
+
+def test_reclamar_respeta_disponible_en_y_el_lease(app_db):
+    app_db._encolar_mensajes([
+        _fila('a'),
+        _fila('b', disponible_en=datetime.utcnow() + timedelta(hours=1)),
+        _fila('c'),
+    ])
+    db.session.commit()
+
+    reclamadas = app_db._reclamar_lote_outbox(10)
+    assert [fila.clave_idempotencia for fila in reclamadas] == ['a', 'c']
+    assert all(fila.estado == 'procesando' and fila.bloqueado_hasta > datetime.utcnow() for fila in reclamadas)
+    # Con el lease vigente nadie más las reclama
+    assert app_db._reclamar_lote_outbox(10) == []
+
+
+def test_lease_vencido_se_vuelve_a_reclamar(app_db):
+    app_db._encolar_mensajes([_fila('a'), _fila('b')])
+    db.session.commit()
+    primera = app_db._reclamar_lote_outbox(1)
+    assert [fila.clave_idempotencia for fila in primera] == ['a']
+    token = primera[0].bloqueado_por
+
+    # El worker que la tenía muere: su lease vence y otro worker la recupera
+    OutboxMensaje.query.filter_by(clave_idempotencia='a').update(
+        {'bloqueado_hasta': datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False)
+    db.session.commit()
+
+    segunda = app_db._reclamar_lote_outbox(10)
+    assert [fila.clave_idempotencia for fila in segunda] == ['a', 'b']
+    assert segunda[0].bloqueado_por != token
+    assert segunda[0].bloqueado_hasta > datetime.utcnow()
+
+
+def test_solo_un_proceso_web_arranca_el_worker_embebido(app_db, monkeypatch):
+    arrancados = []
+    monkeypatch.setattr(app_db, '_OUTBOX_WORKER_EMBEDDED', 'auto')
+    monkeypatch.setattr(app_db, '_outbox_inicio_proceso', -1e9)
+    monkeypatch.setattr(app_db, '_iniciar_outbox_embebido', lambda: arrancados.append(app_db._OUTBOX_WORKER_ID))
+
+    # Tres procesos web sin worker separado comprueban a la vez: solo el primero lo arranca
+    for proceso in ('web:1', 'web:2', 'web:3'):
+        monkeypatch.setattr(app_db, '_OUTBOX_WORKER_ID', proceso)
+        monkeypatch.setattr(app_db, '_outbox_ultima_comprobacion', -1e9)
+        app_db._asegurar_outbox_embebido()
+    assert arrancados == ['web:1']
+
+    # Si ese proceso muere y su latido vence, otro toma el relevo
+    LeaseProceso.query.filter_by(nombre=app_db._OUTBOX_LATIDO).update(
+        {'expira_at': datetime.utcnow() - timedelta(seconds=1)}, synchronize_session=False)
+    db.session.commit()
+    monkeypatch.setattr(app_db, '_outbox_ultima_comprobacion', -1e9)
+    app_db._asegurar_outbox_embebido()
+    assert arrancados == ['web:1', 'web:3']
+
+
+def test_fallo_definitivo_de_conversacion_marca_el_mensaje(app_db):
+    conversation = WhatsAppConversation(contact_number='34600000001@c.us')
+    db.session.add(conversation)
+    db.session.flush()
+    mensaje = app_db._append_whatsapp_message(conversation, 'agent', 'Hola')
+    app_db._encolar_mensaje_conversacion(mensaje, '600000001', 'Hola')
+    db.session.commit()
+
+    fila = app_db._reclamar_lote_outbox(10)[0]
+    app_db._registrar_resultado_outbox(fila, ResultadoEnvio(False, error='Error Twilio 21211', codigo=21211),
+                                       {}, app_db._EscritorResultados())
+    db.session.commit()
+    assert db.session.get(WhatsAppMessage, mensaje.id).estado_entrega == 'failed'
+    assert OutboxFallido.query.count() == 1
+
+    # Al reencolarlo deja de mostrarse como fallido
+    assert app_db._reencolar_fallidos() == 1
+    db.session.commit()
+    db.session.expire_all()
+    assert db.session.get(WhatsAppMessage, mensaje.id).estado_entrega is None
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Pruebas de las ejecuciones de programaciones masivas (reanudación por bloques)
+"""
+
+from datetime import date
+
+import pytest
+
+from models import db, Zona, Cliente, MensajePlantilla, ProgramacionMasiva, OutboxMensaje
+
+
+def _crear_programacion(ventana_minutos=60):
+    zona = Zona(nombre='Norte')
+    plantilla = MensajePlantilla(nombre='Oferta', contenido='Oferta de la semana')
+    db.session.add_all([zona, plantilla])
+    db.session.flush()
+    telefonos = ['600000001', '600000002', '600000002', '600000003', '600000004', '600000005', '600000006']
+    for numero, telefono in enumerate(telefonos, start=1):
+        db.session.add(Cliente(nombre=f'Cliente {numero}', telefono=telefono, zona_id=zona.id))
+    prog = ProgramacionMasiva(zona_id=zona.id, plantilla_id=plantilla.id, dias_semana='0,1,2,3,4,5,6',
+                              hora='09:00', ventana_minutos=ventana_minutos)
+    db.session.add(prog)
+    db.session.commit()
+    return prog
+
+
+def _turnos_encolados(campana_id):
+    return {
+        fila.cliente_id: fila.disponible_en
+        for fila in OutboxMensaje.query.filter_by(campana_id=campana_id)
+    }
+
+
+def _ejecutar(modulo_app, monkeypatch, interrumpir):
+    prog = _crear_programacion()
+    ejecucion = modulo_app._iniciar_ejecucion_programacion(prog, date(2024, 5, 6))
+    monkeypatch.setattr(modulo_app, '_PROGRAMACION_BLOQUE', 2)
+    if interrumpir:
+        # Se pierde el liderazgo tras el primer bloque; otro proceso reanuda la ejecución
+        monkeypatch.setattr(modulo_app, '_sigo_siendo_lider', lambda: False)
+        with pytest.raises(modulo_app.LiderazgoPerdido):
+            modulo_app._completar_ejecucion_programacion(prog, ejecucion)
+        assert ejecucion.ultimo_cliente_id == 2
+        monkeypatch.setattr(modulo_app, '_sigo_siendo_lider', lambda: True)
+    modulo_app._completar_ejecucion_programacion(prog, ejecucion)
+    return ejecucion.iniciado_at, _turnos_encolados(ejecucion.id)
+
+
+def test_reanudar_ejecucion_conserva_turnos(app_db, monkeypatch):
+    inicio_completo, completo = _ejecutar(app_db, monkeypatch, interrumpir=False)
+    db.drop_all()
+    db.create_all()
+    inicio_reanudado, reanudado = _ejecutar(app_db, monkeypatch, interrumpir=True)
+
+    # El teléfono duplicado (cliente 3) no se encola; el resto conserva su turno relativo al inicio
+    assert sorted(completo) == [1, 2, 4, 5, 6, 7]
+    assert sorted(reanudado) == sorted(completo)
+    for cliente_id in completo:
+        assert reanudado[cliente_id] - inicio_reanudado == completo[cliente_id] - inicio_completo
+
+
+def test_cambiar_hora_tras_ejecutar_hoy_no_repite(app_db, cliente_web, monkeypatch):
+    prog = _crear_programacion()
+    hoy = app_db._now().date()
+    ejecucion = app_db._iniciar_ejecucion_programacion(prog, hoy)
+    app_db._completar_ejecucion_programacion(prog, ejecucion)
+    encolados = OutboxMensaje.query.count()
+    monkeypatch.setattr(app_db, '_invalidar_programaciones', lambda: None)
+
+    respuesta = cliente_web.post(f'/programaciones/{prog.id}/editar', data={
+        'zona_id': prog.zona_id, 'plantilla_id': prog.plantilla_id,
+        'dias_semana': ['0', '1', '2', '3', '4', '5', '6'], 'hora': '23:59', 'ventana_minutos': '0',
+    }, follow_redirects=True)
+    assert 'la nueva hora se aplicará desde el próximo día' in respuesta.get_data(as_text=True)
+
+    # La ejecución de hoy se conserva: ni se vuelve a disparar hoy ni se encola de nuevo
+    prog = db.session.get(ProgramacionMasiva, prog.id)
+    assert prog.hora == '23:59' and prog.ultima_ejecucion == hoy
+    assert app_db._siguiente_disparo(prog, app_db._now()).date() > hoy
+    assert app_db._completar_ejecucion_programacion(prog, app_db._iniciar_ejecucion_programacion(prog, hoy)) == 0
+    assert OutboxMensaje.query.count() == encolados
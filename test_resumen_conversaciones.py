@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Pruebas del resumen por conversación (último mensaje, no leídos y último agente)
+"""
+
+from datetime import datetime, timedelta
+
+from models import db, Usuario, WhatsAppConversation
+
+
+def _resumen(conversation_id):
+    conversation = db.session.get(WhatsAppConversation, conversation_id)
+    db.session.refresh(conversation)
+    return (conversation.last_message_id, conversation.last_message_at,
+            conversation.unread_count, conversation.last_agent_usuario_id)
+
+
+def _crear_conversacion():
+    agente = Usuario(username='agente', password_hash='x')
+    conversation = WhatsAppConversation(contact_number='whatsapp:+34600000001')
+    db.session.add_all([agente, conversation])
+    db.session.commit()
+    return agente, conversation
+
+
+def test_avanzar_coincide_con_recalcular(app_db):
+    agente, conversation = _crear_conversacion()
+    base = datetime(2024, 5, 6, 10, 0)
+    # Incluye mensajes que llegan desordenados respecto a sent_at
+    for sender_type, minutos, is_read in [
+        ('customer', 0, False),
+        ('agent', 5, True),
+        ('customer', 10, False),
+        ('customer', 3, False),   # llega tarde: no es el último
+        ('agent', 2, True),       # tampoco cambia el último agente
+        ('customer', 12, True),
+    ]:
+        app_db._append_whatsapp_message(conversation, sender_type, f'{sender_type} {minutos}',
+                                        sent_at=base + timedelta(minutes=minutos), is_read=is_read,
+                                        usuario_id=agente.id)
+    db.session.commit()
+    incremental = _resumen(conversation.id)
+
+    WhatsAppConversation.query.update({'last_message_id': None, 'last_message_at': None,
+                                       'unread_count': 0, 'last_agent_usuario_id': None})
+    assert app_db._recalcular_resumen_conversaciones([conversation.id]) == 1
+    db.session.commit()
+
+    assert _resumen(conversation.id) == incremental
+    assert incremental[2] == 3
+    assert incremental[3] == agente.id
+
+
+def test_marcar_leidos_corrige_contador_desfasado(app_db):
+    _agente, conversation = _crear_conversacion()
+    app_db._append_whatsapp_message(conversation, 'customer', 'hola', is_read=False)
+    db.session.commit()
+
+    # Contador a 0 aunque hay un mensaje sin leer (y al revés tras marcarlo)
+    WhatsAppConversation.query.update({'unread_count': 0})
+    db.session.commit()
+    assert app_db._marcar_leidos(conversation.id) == 1
+    WhatsAppConversation.query.update({'unread_count': 4})
+    db.session.commit()
+    assert app_db._marcar_leidos(conversation.id) == 0
+    db.session.commit()
+
+    assert _resumen(conversation.id)[2] == 0
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Pruebas del cálculo de disparos del scheduler de programaciones masivas
+"""
+
+from datetime import date, datetime
+
+from models import db, Zona, MensajePlantilla, ProgramacionMasiva, CampanaEnvio
+
+
+def _prog(dias='0,2', hora='09:30', ultima_ejecucion=None):
+    # Lunes y miércoles a las 09:30
+    return ProgramacionMasiva(id=1, zona_id=1, plantilla_id=1, dias_semana=dias, hora=hora,
+                              ultima_ejecucion=ultima_ejecucion)
+
+
+def test_siguiente_disparo(app_db):
+    tz = app_db._scheduler_tz
+    lunes = datetime(2024, 5, 6, 8, 0, tzinfo=tz)
+
+    assert app_db._siguiente_disparo(_prog(), lunes) == datetime(2024, 5, 6, 9, 30, tzinfo=tz)
+    # Dentro del minuto del disparo todavía cuenta; pasado el minuto, toca el miércoles
+    assert app_db._siguiente_disparo(_prog(), lunes.replace(hour=9, minute=30, second=40)) == datetime(2024, 5, 6, 9, 30, tzinfo=tz)
+    assert app_db._siguiente_disparo(_prog(), lunes.replace(hour=9, minute=31)) == datetime(2024, 5, 8, 9, 30, tzinfo=tz)
+    # El día ya ejecutado se salta
+    assert app_db._siguiente_disparo(_prog(ultima_ejecucion=date(2024, 5, 6)), lunes) == datetime(2024, 5, 8, 9, 30, tzinfo=tz)
+    # Solo los lunes, ya ejecutado hoy: el lunes siguiente
+    assert app_db._siguiente_disparo(_prog(dias='0', ultima_ejecucion=date(2024, 5, 6)), lunes) == datetime(2024, 5, 13, 9, 30, tzinfo=tz)
+
+
+def test_siguiente_disparo_sin_dias_o_con_hora_invalida(app_db):
+    lunes = datetime(2024, 5, 6, 8, 0, tzinfo=app_db._scheduler_tz)
+    assert app_db._siguiente_disparo(_prog(dias=''), lunes) is None
+    assert app_db._siguiente_disparo(_prog(hora='9h'), lunes) is None
+
+
+def test_ultimo_disparo_perdido(app_db):
+    tz = app_db._scheduler_tz
+    miercoles = datetime(2024, 5, 8, 8, 0, tzinfo=tz)
+    lunes_930 = datetime(2024, 5, 6, 9, 30, tzinfo=tz)
+
+    assert app_db._ultimo_disparo_perdido(_prog(), miercoles) == lunes_930
+    # El disparo del minuto en curso no es perdido; uno ya pasado sí, y supera a los anteriores
+    assert app_db._ultimo_disparo_perdido(_prog(), miercoles.replace(hour=9, minute=30, second=20)) == lunes_930
+    assert app_db._ultimo_disparo_perdido(_prog(), miercoles.replace(hour=9, minute=31)) == datetime(2024, 5, 8, 9, 30, tzinfo=tz)
+    assert app_db._ultimo_disparo_perdido(_prog(ultima_ejecucion=date(2024, 5, 6)), miercoles) is None
+
+
+def test_ultimo_disparo_perdido_ya_ejecutado_o_anterior_al_alta(app_db):
+    tz = app_db._scheduler_tz
+    miercoles = datetime(2024, 5, 8, 8, 0, tzinfo=tz)
+
+    # Creada después del disparo del lunes (09:30 en Madrid son las 07:30 UTC)
+    prog = _prog()
+    prog.created_at = datetime(2024, 5, 6, 8, 0)
+    assert app_db._ultimo_disparo_perdido(prog, miercoles) is None
+
+    # Con la ejecución del lunes registrada (aunque no llegara a fijar ultima_ejecucion)
+    zona = Zona(nombre='Norte')
+    plantilla = MensajePlantilla(nombre='Oferta', contenido='Oferta')
+    db.session.add_all([zona, plantilla])
+    db.session.flush()
+    prog = _prog()
+    prog.zona_id, prog.plantilla_id, prog.created_at = zona.id, plantilla.id, datetime(2024, 1, 1)
+    db.session.add(prog)
+    db.session.flush()
+    assert app_db._ultimo_disparo_perdido(prog, miercoles) == datetime(2024, 5, 6, 9, 30, tzinfo=tz)
+    db.session.add(CampanaEnvio(zona_id=zona.id, plantilla_id=plantilla.id, programacion_id=prog.id,
+                                fecha_programada=date(2024, 5, 6), estado='preparando'))
+    db.session.commit()
+    assert app_db._ultimo_disparo_perdido(prog, miercoles) is None
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Pruebas del modo simulación de los senders
+"""
+
+import uuid
+
+import pytest
+
+from simulacion import SimuladorEnvios
+from twilio_sender import TwilioSender, es_limite_de_ritmo
+
+
+def test_error_generico_por_defecto_es_definitivo():
+    simulador = SimuladorEnvios(errores="generico:1", semilla=1)
+    simulado = simulador.simular("twilio")
+    assert not simulado.success and simulado.codigo is None
+
+    resultado = TwilioSender().resultado_simulado(simulado, "600000001")
+    assert not resultado.success
+    assert resultado.transitorio is False
+
+
+def test_configuracion_por_defecto_solo_produce_errores_genericos():
+    assert [nombre for nombre, _ in SimuladorEnvios().errores] == ["generico"]
+
+
+@pytest.mark.parametrize("status, codigo, limite", [
+    (429, None, True),
+    (429, 20429, True),
+    (400, 63018, True),
+    (500, 20500, False),
+    (400, 21211, False),
+])
+def test_codigos_de_limite_de_ritmo(status, codigo, limite):
+    assert es_limite_de_ritmo(status, codigo) is limite
+
+
+def test_limite_simulado_vacia_el_bucket_del_remitente():
+    # Número propio por prueba: el estado del bucket se comparte en RATE_LIMIT_DIR
+    sender = TwilioSender(whatsapp_number=f"whatsapp:+34{uuid.uuid4().int % 10**9:09d}")
+    simulado = SimuladorEnvios(errores="63018:1").simular("twilio")
+
+    resultado = sender.resultado_simulado(simulado, "600000001")
+    assert resultado.transitorio
+    assert not sender._limitador().intentar()
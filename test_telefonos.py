@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la normalización de teléfonos (clientes y remitentes de WhatsApp)
+"""
+
+import pytest
+
+from models import normalizar_telefono
+
+
+@pytest.mark.parametrize("telefono, esperado", [
+    ("612345678", "34612345678"),   # móvil
+    ("712345678", "34712345678"),   # móvil (rango 7)
+    ("812345678", "34812345678"),   # fijo
+    ("912345678", "34912345678"),   # fijo
+    ("612 34 56 78", "34612345678"),
+    ("+34 612345678", "34612345678"),
+    ("+34912345678", "34912345678"),
+    ("0034712345678", "34712345678"),
+    ("0034 812 345 678", "34812345678"),
+    ("whatsapp:+34612345678", "34612345678"),
+])
+def test_numeros_espanoles(telefono, esperado):
+    assert normalizar_telefono(telefono) == esperado
+
+
+@pytest.mark.parametrize("telefono, esperado", [
+    ("600123456789", "600123456789"),  # 12 dígitos: no se toca
+    ("512345678", "512345678"),        # 9 dígitos fuera de los rangos españoles
+    ("+447911123456", "447911123456"),
+    ("", ""),
+    (None, ""),
+])
+def test_otros_numeros_no_se_alteran(telefono, esperado):
+    assert normalizar_telefono(telefono) == esperado
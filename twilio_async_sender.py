@@ -0,0 +1,233 @@
+"""
+Envío asíncrono de mensajes de WhatsApp contra la API REST de Twilio.
+
+Usa un único httpx.AsyncClient (conexiones keep-alive reutilizadas, HTTP/2 si
+está disponible) que vive en un event loop propio en un hilo de fondo, de modo
+que el worker de outbox puede lanzar lotes de cientos de envíos concurrentes
+sin abrir una conexión por mensaje. Comparte configuración, ritmo de envío y
+clasificación de errores con `TwilioSender`.
+
+httpx es opcional: si no está instalado `disponible` es False y la aplicación
+sigue usando el envío por hilos de `twilio_sender`.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+try:
+    import httpx
+except ImportError:  # Dependencia opcional
+    httpx = None
+
+import simulacion
+from twilio_sender import TWILIO_STATUS_CALLBACK_URL, ResultadoEnvio, TwilioSender, es_error_transitorio, twilio_sender
+
+logger = logging.getLogger(__name__)
+
+TWILIO_API_URL = os.environ.get("TWILIO_API_URL", "https://api.twilio.com/2010-04-01")
+TWILIO_ASYNC_CONCURRENCIA = max(1, int(os.environ.get("TWILIO_ASYNC_CONCURRENCIA", 50)))
+TWILIO_ASYNC_TIMEOUT = float(os.environ.get("TWILIO_ASYNC_TIMEOUT", 15))
+TWILIO_HTTP2 = os.environ.get("TWILIO_HTTP2", "False").lower() == "true"
+
+
+class AsyncTwilioSender:
+    """
+    Sender asíncrono con pool de conexiones persistente y concurrencia acotada.
+    """
+
+    def __init__(self, sender: TwilioSender, concurrencia: int = TWILIO_ASYNC_CONCURRENCIA, http2: bool = TWILIO_HTTP2):
+        """
+        Args:
+            sender: TwilioSender del que se toman credenciales, número y limitador
+            concurrencia: Peticiones simultáneas máximas contra Twilio
+            http2: Usar HTTP/2 (requiere el paquete `h2`)
+        """
+        self.sender = sender
+        self.concurrencia = concurrencia
+        self.http2 = http2
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cliente = None
+        self._credenciales: Optional[Tuple[str, str]] = None
+        self._semaforo: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+
+    @property
+    def disponible(self) -> bool:
+        return httpx is not None
+
+    async def enviar(self, phone_number: str, message: str, media_url: Optional[str] = None) -> ResultadoEnvio:
+        """
+        Enviar un mensaje (o imagen) y retornar el resultado detallado.
+        """
+        if self.sender.simulate_mode:
+            return await self._simular(phone_number)
+
+        error_config = self._error_configuracion()
+        if error_config:
+            logger.error(error_config)
+            return ResultadoEnvio(False, error=error_config)
+
+        cliente = self._obtener_cliente()
+        datos = {
+            "From": self.sender.whatsapp_number,
+            "To": self.sender._format_phone_number(phone_number),
+            "Body": message or "",
+        }
+        if media_url:
+            datos["MediaUrl"] = media_url
+        if TWILIO_STATUS_CALLBACK_URL:
+            datos["StatusCallback"] = TWILIO_STATUS_CALLBACK_URL
+
+        async with self._semaforo:
+            espera = self.sender._limitador().reservar()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            try:
+                respuesta = await cliente.post(
+                    f"{TWILIO_API_URL}/Accounts/{self.sender.account_sid}/Messages.json",
+                    data=datos,
+                )
+            except (httpx.TimeoutException, httpx.TransportError) as e:
+                error_msg = f"Error de conexión Twilio: {str(e) or e.__class__.__name__}"
+                logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
+                return ResultadoEnvio(False, error=error_msg, transitorio=True)
+            except Exception as e:
+                error_msg = f"Error inesperado: {str(e)}"
+                logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
+                return ResultadoEnvio(False, error=error_msg)
+
+        return self._interpretar_respuesta(phone_number, respuesta)
+
+    async def _simular(self, phone_number: str) -> ResultadoEnvio:
+        """Simulación sin bloquear el loop: la latencia simulada se espera con asyncio.sleep."""
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.concurrencia)
+        async with self._semaforo:
+            espera = self.sender._limitador().reservar()
+            if espera > 0:
+                await asyncio.sleep(espera)
+            latencia, simulado = simulacion.simulador.muestrear("twilio")
+            if latencia > 0:
+                await asyncio.sleep(latencia)
+        return self.sender.resultado_simulado(simulado, phone_number)
+
+    async def send_message(self, phone_number: str, message: str) -> Tuple[bool, str]:
+        """
+        Mismo contrato que `TwilioSender.send_message`: `(success, sid_o_error)`.
+        """
+        return (await self.enviar(phone_number, message)).como_tupla()
+
+    async def enviar_lote(self, envios: Iterable[Tuple[str, str, Optional[str]]]) -> List[ResultadoEnvio]:
+        """
+        Enviar concurrentemente una lista de (teléfono, mensaje, media_url).
+        Los resultados se devuelven en el mismo orden.
+        """
+        tareas = [self.enviar(telefono, mensaje, media_url) for telefono, mensaje, media_url in envios]
+        resultados = await asyncio.gather(*tareas, return_exceptions=True)
+        return [
+            resultado if isinstance(resultado, ResultadoEnvio)
+            else ResultadoEnvio(False, error=f"Error inesperado: {resultado}")
+            for resultado in resultados
+        ]
+
+    def enviar_lote_sync(self, envios: Iterable[Tuple[str, str, Optional[str]]]) -> List[ResultadoEnvio]:
+        """
+        Versión bloqueante de `enviar_lote` para código síncrono (p. ej. el worker
+        de outbox). Los envíos se ejecutan en el loop de fondo del sender, así las
+        conexiones se reutilizan entre lotes.
+        """
+        futuro = asyncio.run_coroutine_threadsafe(self.enviar_lote(list(envios)), self._obtener_loop())
+        return futuro.result()
+
+    def cerrar(self):
+        """Cierra el pool de conexiones y detiene el loop de fondo."""
+        with self._lock:
+            loop, cliente = self._loop, self._cliente
+            self._loop = self._cliente = self._semaforo = self._credenciales = None
+        if loop is None:
+            return
+        if cliente is not None:
+            asyncio.run_coroutine_threadsafe(cliente.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+
+    def _obtener_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                hilo = threading.Thread(target=loop.run_forever, name="twilio_async", daemon=True)
+                hilo.start()
+                self._loop = loop
+            return self._loop
+
+    def _obtener_cliente(self):
+        """
+        Cliente httpx compartido (creado dentro del loop). Se recrea si cambian
+        las credenciales, p. ej. tras `configurar_twilio`.
+        """
+        credenciales = (self.sender.account_sid, self.sender.auth_token)
+        if self._cliente is not None and self._credenciales == credenciales:
+            return self._cliente
+
+        if self._cliente is not None:
+            asyncio.ensure_future(self._cliente.aclose())
+
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("⚠️ TWILIO_HTTP2 activo pero el paquete 'h2' no está instalado; se usa HTTP/1.1")
+                http2 = False
+
+        self._cliente = httpx.AsyncClient(
+            auth=credenciales,
+            http2=http2,
+            timeout=TWILIO_ASYNC_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=self.concurrencia,
+                max_keepalive_connections=self.concurrencia,
+            ),
+        )
+        self._credenciales = credenciales
+        self._semaforo = asyncio.Semaphore(self.concurrencia)
+        return self._cliente
+
+    def _error_configuracion(self) -> Optional[str]:
+        if not self.sender.account_sid or not self.sender.auth_token:
+            return "Cliente Twilio no inicializado"
+        if not self.sender.whatsapp_number:
+            return "Número de WhatsApp no configurado. Configura TWILIO_WHATSAPP_NUMBER (formato: whatsapp:+34612345678)"
+        if not self.sender.whatsapp_number.startswith("whatsapp:"):
+            return (
+                "Formato incorrecto del número From. Debe empezar con 'whatsapp:'. "
+                f"Actual: {self.sender.whatsapp_number}. Ejemplo correcto: whatsapp:+34612345678"
+            )
+        return None
+
+    def _interpretar_respuesta(self, phone_number: str, respuesta) -> ResultadoEnvio:
+        try:
+            cuerpo = respuesta.json()
+        except ValueError:
+            cuerpo = {}
+
+        if respuesta.status_code < 400 and cuerpo.get("sid"):
+            logger.info(f"✓ Mensaje enviado exitosamente a {phone_number}. SID: {cuerpo['sid']}")
+            return ResultadoEnvio(True, sid=cuerpo["sid"])
+
+        codigo = cuerpo.get("code")
+        error_msg = f"Error Twilio {codigo}: {cuerpo.get('message') or respuesta.text[:200]}"
+        logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
+        self.sender._notificar_limite(respuesta.status_code, codigo)
+        return ResultadoEnvio(
+            False,
+            error=error_msg,
+            codigo=codigo,
+            transitorio=es_error_transitorio(respuesta.status_code, codigo),
+        )
+
+
+# Instancia global ligada al sender de Twilio de la aplicación
+twilio_async_sender = AsyncTwilioSender(twilio_sender)
@@ -5,11 +5,15 @@ Módulo para el envío de mensajes de WhatsApp usando Twilio
 import json
 import logging
 import os
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+import requests
 from twilio.rest import Client
 from twilio.base.exceptions import TwilioException, TwilioRestException
 
+import simulacion
+from rate_limiter import TokenBucket
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -45,6 +49,67 @@ def _load_default_config() -> Dict[str, Optional[str]]:
     return config
 
 
+# Ritmo máximo de envíos por número remitente (compartido entre hilos y procesos)
+TWILIO_RATE_PER_SEC = float(os.environ.get("TWILIO_RATE_PER_SEC", 10))
+TWILIO_RATE_BURST = float(os.environ.get("TWILIO_RATE_BURST", 0)) or None
+
+
+# URL pública de /webhook/whatsapp/estado; si está definida Twilio notifica ahí el
+# estado de entrega (queued, sent, delivered, read, failed...) de cada envío
+TWILIO_STATUS_CALLBACK_URL = os.environ.get("TWILIO_STATUS_CALLBACK_URL") or None
+
+
+def opciones_status_callback() -> Dict[str, str]:
+    """Argumentos extra de `messages.create` para pedir los callbacks de estado."""
+    return {"status_callback": TWILIO_STATUS_CALLBACK_URL} if TWILIO_STATUS_CALLBACK_URL else {}
+
+
+# Códigos de Twilio que indican saturación o un fallo temporal del servicio
+CODIGOS_TRANSITORIOS = {
+    20429,  # Too Many Requests
+    20500,  # Internal Server Error
+    20503,  # Service Unavailable
+    30001,  # Queue overflow
+    63018,  # Rate limit del remitente de WhatsApp
+}
+
+
+def es_error_transitorio(status: Optional[int], codigo: Optional[int]) -> bool:
+    """
+    Indica si merece la pena reintentar un error de la API de Twilio.
+    Los 429/5xx y los códigos de saturación se reintentan; el resto de errores
+    (número inválido 21211, remitente no configurado 63007, etc.) son definitivos.
+    """
+    if codigo in CODIGOS_TRANSITORIOS:
+        return True
+    return status == 429 or (status is not None and status >= 500)
+
+
+# Códigos con los que Twilio indica que se está enviando demasiado rápido
+CODIGOS_LIMITE = {20429, 63018}
+
+
+def es_limite_de_ritmo(status: Optional[int], codigo: Optional[int]) -> bool:
+    """Indica si la respuesta de Twilio es un aviso de ritmo excesivo (429/20429/63018)."""
+    return status == 429 or codigo in CODIGOS_LIMITE
+
+
+class ResultadoEnvio(NamedTuple):
+    """
+    Resultado detallado de un envío: SID si tuvo éxito o error, código de Twilio
+    y si el fallo es transitorio (se puede reintentar).
+    """
+    success: bool
+    sid: str = ""
+    error: Optional[str] = None
+    codigo: Optional[int] = None
+    transitorio: bool = False
+
+    def como_tupla(self) -> Tuple[bool, str]:
+        """Formato clásico `(success, sid_o_error)`."""
+        return self.success, (self.sid if self.success else (self.error or ""))
+
+
 class TwilioSender:
     """
     Clase para manejar el envío de mensajes de WhatsApp usando Twilio
@@ -68,6 +133,7 @@ class TwilioSender:
         self.auth_token = auth_token
         self.whatsapp_number = whatsapp_number
         self._client = None
+        self._limitadores: Dict[str, TokenBucket] = {}
         self._update_simulation_mode()
 
         if not self.simulate_mode:
@@ -78,62 +144,67 @@ class TwilioSender:
                 logger.error(f"Error inicializando cliente Twilio: {e}")
                 self.simulate_mode = True
 
-    def send_message(self, phone_number: str, message: str) -> Tuple[bool, str]:
+    def enviar(self, phone_number: str, message: str, media_url: Optional[str] = None) -> ResultadoEnvio:
         """
-        Enviar un mensaje de WhatsApp usando Twilio
+        Enviar un mensaje (o una imagen si se indica `media_url`) y retornar el
+        resultado detallado, con la clasificación del error si lo hubo.
         """
+        if media_url:
+            if self.simulate_mode:
+                return self._simulate_send_image(phone_number, media_url, message)
+            return self._twilio_send_media(phone_number, media_url, message, media_type="image")
         if self.simulate_mode:
             return self._simulate_send(phone_number, message)
         return self._twilio_send(phone_number, message)
 
+    def send_message(self, phone_number: str, message: str) -> Tuple[bool, str]:
+        """
+        Enviar un mensaje de WhatsApp usando Twilio
+        """
+        return self.enviar(phone_number, message).como_tupla()
+
     def send_image(self, phone_number: str, image_url: str, caption: str = "") -> Tuple[bool, str]:
         """
         Enviar una imagen de WhatsApp usando Twilio
         Nota: Twilio requiere que la imagen esté en una URL pública
         """
-        if self.simulate_mode:
-            return self._simulate_send_image(phone_number, image_url, caption)
-        return self._twilio_send_media(phone_number, image_url, caption, media_type="image")
+        return self.enviar(phone_number, caption, media_url=image_url).como_tupla()
 
-    def _simulate_send(self, phone_number: str, message: str) -> Tuple[bool, str]:
+    def _simulate_send(self, phone_number: str, message: str) -> ResultadoEnvio:
         """
-        Simular envío de mensaje (para desarrollo/testing)
+        Simular envío de mensaje (para desarrollo/testing y pruebas de carga)
         """
         logger.info(f"SIMULANDO envío a {phone_number}: {message[:50]}...")
+        self._esperar_turno()
+        return self.resultado_simulado(simulacion.simulador.simular("twilio"), phone_number, "Mensaje")
 
-        # Simular éxito/error aleatorio para testing
-        import random
-
-        success = random.random() > 0.1  # 90% de éxito
-
-        if success:
-            logger.info(f"✓ Mensaje enviado exitosamente a {phone_number}")
-            return True, ""
-
-        error_msg = "Error simulado en el envío"
-        logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
-        return False, error_msg
-
-    def _simulate_send_image(self, phone_number: str, image_url: str, caption: str) -> Tuple[bool, str]:
+    def _simulate_send_image(self, phone_number: str, image_url: str, caption: str) -> ResultadoEnvio:
         """
-        Simular envío de imagen (para desarrollo/testing)
+        Simular envío de imagen (para desarrollo/testing y pruebas de carga)
         """
         logger.info(f"SIMULANDO envío de imagen a {phone_number}: {image_url}")
+        self._esperar_turno()
+        return self.resultado_simulado(simulacion.simulador.simular("twilio"), phone_number, "Imagen")
 
-        # Simular éxito/error aleatorio para testing
-        import random
-
-        success = random.random() > 0.1  # 90% de éxito
-
-        if success:
-            logger.info(f"✓ Imagen enviada exitosamente a {phone_number}")
-            return True, ""
-
-        error_msg = "Error simulado en el envío de imagen"
-        logger.error(f"✗ Error enviando imagen a {phone_number}: {error_msg}")
-        return False, error_msg
+    def resultado_simulado(self, simulado: "simulacion.EnvioSimulado", phone_number: str, que: str = "Mensaje") -> ResultadoEnvio:
+        """
+        Convierte un resultado de la simulación en ResultadoEnvio, aplicando la
+        misma clasificación de errores y reacción a 429 que un envío real.
+        """
+        if simulado.success:
+            logger.info(f"✓ {que} enviado exitosamente a {phone_number}. SID: {simulado.sid}")
+            return ResultadoEnvio(True, sid=simulado.sid)
+
+        logger.error(f"✗ Error enviando a {phone_number}: {simulado.error}")
+        self._notificar_limite(simulado.status, simulado.codigo)
+        return ResultadoEnvio(
+            False,
+            error=simulado.error,
+            codigo=simulado.codigo,
+            transitorio=simulado.timeout or es_error_transitorio(simulado.status, simulado.codigo),
+        )
 
-    def _twilio_send(self, phone_number: str, message: str) -> Tuple[bool, str]:
+    def _twilio_send(self, phone_number: str, message: str) -> ResultadoEnvio:
         """
         Envío real usando Twilio
         """
@@ -141,18 +212,18 @@ class TwilioSender:
             if not self._client:
                 error_msg = "Cliente Twilio no inicializado"
                 logger.error(error_msg)
-                return False, error_msg
+                return ResultadoEnvio(False, error=error_msg)
             
             if not self.whatsapp_number:
                 error_msg = "Número de WhatsApp no configurado. Configura TWILIO_WHATSAPP_NUMBER (formato: whatsapp:+34612345678)"
                 logger.error(error_msg)
-                return False, error_msg
+                return ResultadoEnvio(False, error=error_msg)
 
             # Verificar formato del número From
             if not self.whatsapp_number.startswith('whatsapp:'):
                 error_msg = f"Formato incorrecto del número From. Debe empezar con 'whatsapp:'. Actual: {self.whatsapp_number}. Ejemplo correcto: whatsapp:+34612345678"
                 logger.error(error_msg)
-                return False, error_msg
+                return ResultadoEnvio(False, error=error_msg)
 
             # Formatear número de teléfono para Twilio (formato: whatsapp:+34612345678)
             formatted_number = self._format_phone_number(phone_number)
@@ -166,19 +237,25 @@ class TwilioSender:
             if not self.whatsapp_number or self.whatsapp_number == 'whatsapp:+34619639616':
                 logger.warning(f"⚠️ El número From puede no estar configurado en Twilio. Verifica en el panel de Twilio.")
 
+            # Respetar el ritmo de envío del número remitente
+            self._esperar_turno()
+
             # Enviar mensaje usando Twilio
             message_obj = self._client.messages.create(
                 body=message,
                 from_=self.whatsapp_number,  # Formato: whatsapp:+34612345678
                 to=formatted_number,  # Formato: whatsapp:+34612345678
+                **opciones_status_callback(),
             )
 
             logger.info(f"✓ Mensaje enviado exitosamente a {phone_number}. SID: {message_obj.sid}")
-            return True, message_obj.sid
+            return ResultadoEnvio(True, sid=message_obj.sid)
 
         except TwilioRestException as e:
             error_msg = f"Error Twilio {e.code}: {e.msg}"
             logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
+            transitorio = es_error_transitorio(e.status, e.code)
+            self._notificar_limite(e.status, e.code)
             
             # Mensajes de error más descriptivos
             if e.code == 63007:
@@ -188,17 +265,17 @@ class TwilioSender:
             elif e.code == 21608:
                 error_msg = f"Error 21608: No tienes permiso para enviar a este número. Si usas Sandbox, asegúrate de que el número esté verificado."
             
-            return False, error_msg
-        except TwilioException as e:
+            return ResultadoEnvio(False, error=error_msg, codigo=e.code, transitorio=transitorio)
+        except (TwilioException, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
             error_msg = f"Error de conexión Twilio: {str(e)}"
             logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
-            return False, error_msg
+            return ResultadoEnvio(False, error=error_msg, transitorio=True)
         except Exception as e:
             error_msg = f"Error inesperado: {str(e)}"
             logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
-            return False, error_msg
+            return ResultadoEnvio(False, error=error_msg)
 
-    def _twilio_send_media(self, phone_number: str, media_url: str, caption: str = "", media_type: str = "image") -> Tuple[bool, str]:
+    def _twilio_send_media(self, phone_number: str, media_url: str, caption: str = "", media_type: str = "image") -> ResultadoEnvio:
         """
         Envío real de media usando Twilio
         """
@@ -206,31 +283,66 @@ class TwilioSender:
             if not self._client or not self.whatsapp_number:
                 error_msg = "Twilio no está configurado correctamente"
                 logger.error(error_msg)
-                return False, error_msg
+                return ResultadoEnvio(False, error=error_msg)
 
             formatted_number = self._format_phone_number(phone_number)
 
             # Construir el mensaje con media
             body = caption if caption else ""
+
+            self._esperar_turno()
             
             message_obj = self._client.messages.create(
                 body=body,
                 media_url=[media_url],  # Twilio acepta lista de URLs
                 from_=self.whatsapp_number,
                 to=formatted_number,
+                **opciones_status_callback(),
             )
 
             logger.info(f"✓ {media_type.capitalize()} enviado exitosamente a {phone_number}. SID: {message_obj.sid}")
-            return True, message_obj.sid
+            return ResultadoEnvio(True, sid=message_obj.sid)
 
         except TwilioRestException as e:
             error_msg = f"Error Twilio {e.code}: {e.msg}"
             logger.error(f"✗ Error enviando {media_type} a {phone_number}: {error_msg}")
-            return False, error_msg
+            self._notificar_limite(e.status, e.code)
+            return ResultadoEnvio(False, error=error_msg, codigo=e.code, transitorio=es_error_transitorio(e.status, e.code))
+        except (TwilioException, requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error_msg = f"Error de conexión Twilio: {str(e)}"
+            logger.error(f"✗ Error enviando {media_type} a {phone_number}: {error_msg}")
+            return ResultadoEnvio(False, error=error_msg, transitorio=True)
         except Exception as e:
             error_msg = f"Error inesperado: {str(e)}"
             logger.error(f"✗ Error enviando {media_type} a {phone_number}: {error_msg}")
-            return False, error_msg
+            return ResultadoEnvio(False, error=error_msg)
+
+    def _limitador(self) -> TokenBucket:
+        """
+        Token bucket del número remitente actual, compartido entre hilos y workers.
+        """
+        clave = self.whatsapp_number or ""
+        limitador = self._limitadores.get(clave)
+        if limitador is None:
+            limitador = TokenBucket(f"twilio:{clave}", TWILIO_RATE_PER_SEC, TWILIO_RATE_BURST)
+            self._limitadores[clave] = limitador
+        return limitador
+
+    def _notificar_limite(self, status: Optional[int], codigo: Optional[int]):
+        """
+        Si Twilio avisa de ritmo excesivo, vacía el token bucket del remitente para
+        que todos los hilos y workers frenen. Común a envíos síncronos, asíncronos y simulados.
+        """
+        if es_limite_de_ritmo(status, codigo):
+            self._limitador().vaciar()
+
+    def _esperar_turno(self):
+        """
+        Bloquear hasta que el número remitente tenga cupo de envío.
+        """
+        espera = self._limitador().adquirir()
+        if espera > 0.5:
+            logger.info(f"⏳ Ritmo de envío limitado: esperados {espera:.2f}s para {self.whatsapp_number}")
 
     def _format_phone_number(self, phone_number: str) -> str:
         """
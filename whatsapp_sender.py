@@ -9,6 +9,8 @@ from typing import Dict, List, Optional, Tuple
 
 import requests
 
+import simulacion
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -115,41 +117,31 @@ class GreenAPISender:
 
     def _simulate_send(self, phone_number: str, message: str) -> Tuple[bool, str]:
         """
-        Simular envío de mensaje (para desarrollo/testing)
+        Simular envío de mensaje (para desarrollo/testing y pruebas de carga)
         """
         logger.info(f"SIMULANDO envío a {phone_number}: {message[:50]}...")
 
-        # Simular éxito/error aleatorio para testing
-        import random
-
-        success = random.random() > 0.1  # 90% de éxito
-
-        if success:
+        simulado = simulacion.simulador.simular("green_api")
+        if simulado.success:
             logger.info(f"✓ Mensaje enviado exitosamente a {phone_number}")
             return True, ""
 
-        error_msg = "Error simulado en el envío"
-        logger.error(f"✗ Error enviando a {phone_number}: {error_msg}")
-        return False, error_msg
+        logger.error(f"✗ Error enviando a {phone_number}: {simulado.error}")
+        return False, simulado.error
 
     def _simulate_send_image(self, phone_number: str, image_path: str, caption: str) -> Tuple[bool, str]:
         """
-        Simular envío de imagen (para desarrollo/testing)
+        Simular envío de imagen (para desarrollo/testing y pruebas de carga)
         """
         logger.info(f"SIMULANDO envío de imagen a {phone_number}: {image_path}")
 
-        # Simular éxito/error aleatorio para testing
-        import random
-
-        success = random.random() > 0.1  # 90% de éxito
-
-        if success:
+        simulado = simulacion.simulador.simular("green_api")
+        if simulado.success:
             logger.info(f"✓ Imagen enviada exitosamente a {phone_number}")
             return True, ""
 
-        error_msg = "Error simulado en el envío de imagen"
-        logger.error(f"✗ Error enviando imagen a {phone_number}: {error_msg}")
-        return False, error_msg
+        logger.error(f"✗ Error enviando imagen a {phone_number}: {simulado.error}")
+        return False, simulado.error
 
     def _green_api_send(self, phone_number: str, message: str) -> Tuple[bool, str]:
         """